@@ -1,87 +1,184 @@
-import network
-import time
-from umqtt.simple import MQTTClient
-
-WIFI_SSID   = "XXXXXX"
-WIFI_PASS   = "XXXXXX"
-BROKER_IP   = "XXXXXX"
-CLIENT_ID   = "controlador_cruce_escenario1"
-
-TOPICO_SOLICITUD = b"cruce/solicitud"
-TOPICO_RESPUESTA = b"cruce/respuesta"
-TOPICO_REPORTES  = b"cruce/reportes"
-
-cruce_ocupado = False
-active_robot = None
-cola_espera = []
-client = None
-
-def conectar_wifi():
-    print("Activando WiFi...")
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    wlan.connect(WIFI_SSID, WIFI_PASS)
-    print("Conectando a WiFi...")
-    while not wlan.isconnected():
-        time.sleep(1)
-    print("Conectado a WiFi:", wlan.ifconfig())
-
-def extraer_robot_id(msg):
-    return msg.split(":")[0].strip()
-
-def sub_cb(topic, msg):
-    global cruce_ocupado, active_robot, cola_espera
-    t = topic.decode()
-    m = msg.decode()
-    print("Mensaje recibido en", t, ":", m)
-    if t == "cruce/solicitud":
-        robot_id = extraer_robot_id(m)
-        print("Solicitud de paso recibida de:", robot_id)
-        if not cruce_ocupado:
-            cruce_ocupado = True
-            active_robot = robot_id
-            print("Cruce libre. Autorizando paso a:", robot_id)
-            client.publish(TOPICO_RESPUESTA, (robot_id + ":pasar").encode())
-        else:
-            print("Cruce ocupado por:", active_robot)
-            if robot_id != active_robot and robot_id not in cola_espera:
-                cola_espera.append(robot_id)
-                print("Añadiendo a cola de espera:", robot_id)
-            client.publish(TOPICO_RESPUESTA, (robot_id + ":esperar").encode())
-    elif t == "cruce/reportes":
-        parts = m.split(":")
-        if len(parts) >= 2 and parts[1].strip() == "cruce_liberado":
-            print("Reporte de cruce liberado por:", parts[0].strip())
-            if parts[0].strip() == active_robot:
-                cruce_ocupado = False
-                active_robot = None
-                print("Cruce liberado. Revisando cola de espera...")
-                if cola_espera:
-                    siguiente = cola_espera.pop(0)
-                    cruce_ocupado = True
-                    active_robot = siguiente
-                    print("Autorizando paso a siguiente robot en cola:", siguiente)
-                    client.publish(TOPICO_RESPUESTA, (siguiente + ":pasar").encode())
-
-def main():
-    global client
-    conectar_wifi()
-    print("Conectando al broker MQTT...")
-    client = MQTTClient(CLIENT_ID, BROKER_IP)
-    client.set_callback(sub_cb)
-    client.connect()
-    print("Conectado al broker MQTT")
-
-    client.subscribe(TOPICO_SOLICITUD)
-    client.subscribe(TOPICO_REPORTES)
-    print("Suscrito a los tópicos:", TOPICO_SOLICITUD.decode(), "y", TOPICO_REPORTES.decode())
-
-    client.publish(TOPICO_REPORTES, b"controlador_cruce_escenario1:listo")
-    print("Mensaje de inicio publicado")
-    
-    while True:
-        client.check_msg()
-        time.sleep(0.1)
-
-if __name__ == '__main__':
-    main()
\ No newline at end of file
+import network
+import time
+import select
+from umqtt.simple import MQTTClient
+
+WIFI_SSID   = "XXXXXX"
+WIFI_PASS   = "XXXXXX"
+BROKER_IP   = "XXXXXX"
+CLIENT_ID   = "controlador_cruce_escenario1"
+
+# Con CRUCE_ID los topics llevan el identificador del cruce (cruce/<id>/...),
+# así varios cruces comparten broker. Vacío, son los de un cruce solo.
+CRUCE_ID = ""
+
+def configurar_topicos():
+    global TOPICO_SOLICITUD, TOPICO_RESPUESTA, TOPICO_REPORTES
+    cruce = b"cruce/" + CRUCE_ID.encode() + b"/" if CRUCE_ID else b"cruce/"
+    TOPICO_SOLICITUD = cruce + b"solicitud"
+    TOPICO_RESPUESTA = cruce + b"respuesta"
+    TOPICO_REPORTES  = cruce + b"reportes"
+
+configurar_topicos()
+
+# Cada robot recibe sus respuestas en TOPICO_RESPUESTA + b"/" + su id. Con
+# MODO_COMPATIBLE se publican también en TOPICO_RESPUESTA, para los robots
+# con el firmware anterior, que escuchan todos ese topic.
+MODO_COMPATIBLE = False
+
+PRESUPUESTO_MENSAJES = 32
+PAUSA_INACTIVO = 0.1
+
+cruce_ocupado = False
+active_robot = None
+client = None
+_sock_sondeado = None
+_sondeo = None
+
+def conectar_wifi():
+    print("Activando WiFi...")
+    wlan = network.WLAN(network.STA_IF)
+    wlan.active(True)
+    wlan.connect(WIFI_SSID, WIFI_PASS)
+    print("Conectando a WiFi...")
+    while not wlan.isconnected():
+        time.sleep(1)
+    print("Conectado a WiFi:", wlan.ifconfig())
+
+def extraer_robot_id(msg):
+    return msg.split(":")[0].strip()
+
+ACTIVO = "activo"
+
+class RegistroRobots:
+    # Interna los identificadores ("robot3") en enteros pequeños y guarda dónde
+    # está cada robot: el nombre de la cola en la que espera, ACTIVO o None.
+    def __init__(self):
+        self.ids = []
+        self.ubicacion = []
+        self._handles = {}
+        self._respuestas = []
+        self._topicos = []
+
+    def handle(self, robot_id):
+        h = self._handles.get(robot_id)
+        if h is None:
+            h = len(self.ids)
+            self._handles[robot_id] = h
+            self.ids.append(robot_id)
+            self.ubicacion.append(None)
+            self._respuestas.append({})
+            self._topicos.append(None)
+        return h
+
+    def respuesta(self, h, orden):
+        # Mensaje "robot3:pasar" ya codificado: se construye una vez por robot
+        # y orden, y después se reutiliza.
+        cache = self._respuestas[h]
+        msg = cache.get(orden)
+        if msg is None:
+            msg = cache[orden] = (self.ids[h] + ":" + orden).encode()
+        return msg
+
+    def topico(self, h):
+        t = self._topicos[h]
+        if t is None:
+            t = self._topicos[h] = TOPICO_RESPUESTA + b"/" + self.ids[h].encode()
+        return t
+
+    def buscar(self, robot_id):
+        return self._handles.get(robot_id)
+
+    def donde(self, robot_id):
+        h = self._handles.get(robot_id)
+        return None if h is None else self.ubicacion[h]
+
+registro = RegistroRobots()
+# Por orden de llegada: una lista de handles. Quién está ya en ella lo dice
+# registro.ubicacion, sin recorrerla.
+EN_COLA = "espera"
+cola_espera = []
+
+def responder(h, orden):
+    msg = registro.respuesta(h, orden)
+    client.publish(registro.topico(h), msg)
+    if MODO_COMPATIBLE:
+        client.publish(TOPICO_RESPUESTA, msg)
+
+def sub_cb(topic, msg):
+    global cruce_ocupado, active_robot, cola_espera
+    t = topic.decode()
+    m = msg.decode()
+    print("Mensaje recibido en", t, ":", m)
+    if topic == TOPICO_SOLICITUD:
+        robot_id = extraer_robot_id(m)
+        h = registro.handle(robot_id)
+        print("Solicitud de paso recibida de:", robot_id)
+        if not cruce_ocupado:
+            cruce_ocupado = True
+            active_robot = robot_id
+            registro.ubicacion[h] = ACTIVO
+            print("Cruce libre. Autorizando paso a:", robot_id)
+            responder(h, "pasar")
+        else:
+            print("Cruce ocupado por:", active_robot)
+            if registro.ubicacion[h] is None:
+                cola_espera.append(h)
+                registro.ubicacion[h] = EN_COLA
+                print("Añadiendo a cola de espera:", robot_id)
+            responder(h, "esperar")
+    elif topic == TOPICO_REPORTES:
+        parts = m.split(":")
+        if len(parts) >= 2 and parts[1].strip() == "cruce_liberado":
+            print("Reporte de cruce liberado por:", parts[0].strip())
+            if parts[0].strip() == active_robot:
+                registro.ubicacion[registro.buscar(active_robot)] = None
+                cruce_ocupado = False
+                active_robot = None
+                print("Cruce liberado. Revisando cola de espera...")
+                if cola_espera:
+                    h = cola_espera.pop(0)
+                    siguiente = registro.ids[h]
+                    cruce_ocupado = True
+                    active_robot = siguiente
+                    registro.ubicacion[h] = ACTIVO
+                    print("Autorizando paso a siguiente robot en cola:", siguiente)
+                    responder(h, "pasar")
+
+def drenar_mensajes():
+    # Atiende todo lo pendiente en el socket MQTT, hasta PRESUPUESTO_MENSAJES
+    # por pasada. Devuelve True si se agotó el presupuesto y puede quedar más.
+    global _sock_sondeado, _sondeo
+    if client.sock is not _sock_sondeado:
+        _sock_sondeado = client.sock
+        _sondeo = select.poll()
+        _sondeo.register(_sock_sondeado, select.POLLIN)
+    for _ in range(PRESUPUESTO_MENSAJES):
+        if not _sondeo.poll(0):
+            return False
+        client.check_msg()
+    return True
+
+def main():
+    global client
+    configurar_topicos()
+    conectar_wifi()
+    print("Conectando al broker MQTT...")
+    client = MQTTClient(CLIENT_ID, BROKER_IP)
+    client.set_callback(sub_cb)
+    client.connect()
+    print("Conectado al broker MQTT")
+
+    client.subscribe(TOPICO_SOLICITUD)
+    client.subscribe(TOPICO_REPORTES)
+    print("Suscrito a los tópicos:", TOPICO_SOLICITUD.decode(), "y", TOPICO_REPORTES.decode())
+
+    client.publish(TOPICO_REPORTES, b"controlador_cruce_escenario1:listo")
+    print("Mensaje de inicio publicado")
+    
+    while True:
+        if not drenar_mensajes():
+            time.sleep(PAUSA_INACTIVO)
+
+if __name__ == '__main__':
+    main()
@@ -1,105 +1,159 @@
-from machine import Pin, PWM
-import time
-from umqtt.simple import MQTTClient
-import network
-
-WIFI_SSID   = "XXXXXXX"
-WIFI_PASS   = "XXXXXXX" 
-BROKER_IP   = "XXXXXXX"
-CLIENT_ID   = "robotX"
-
-TOPICO_SOLICITUD = b"cruce/solicitud"
-TOPICO_RESPUESTA = b"cruce/respuesta"
-TOPICO_REPORTES  = b"cruce/reportes"
-
-PIN_SERVO_IZQ = 13
-PIN_SERVO_DER = 14
-
-led = Pin(2, Pin.OUT)
-
-servo_izq = PWM(Pin(PIN_SERVO_IZQ), freq=50)
-servo_der = PWM(Pin(PIN_SERVO_DER), freq=50)
-
-en_cruce = False
-
-def mover(d_izq, d_der):
-    servo_izq.duty_u16(d_izq)
-    servo_der.duty_u16(d_der)
-
-def avanzar():
-    print("[ROBOT] Avanzando...")
-    mover(4940, 4413)
-
-def detener():
-    print("[ROBOT] Detenido.")
-    mover(4700, 4800)
-
-def led_parpadeo(intervalo, veces=None):
-    count = 0
-    while veces is None or count < veces:
-        led.on()
-        time.sleep(intervalo)
-        led.off()
-        time.sleep(intervalo)
-        count += 1
-        
-def led_encendido():
-    led.on()
-
-def led_apagado():
-    led.off()
-
-def conectar_wifi():
-    print("[ROBOT] Conectando a WiFi...")
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    wlan.connect(WIFI_SSID, WIFI_PASS)
-    while not wlan.isconnected():
-        led_parpadeo(0.2, 1)
-        time.sleep(1)
-    print("[ROBOT] WiFi conectado:", wlan.ifconfig())
-    led_encendido()
-
-def on_mensaje(topic, msg):
-    global en_cruce
-    print(f"[ROBOT] Mensaje recibido en {topic}: {msg}")
-    if msg.decode().startswith(CLIENT_ID + ":pasar"):
-        print("[ROBOT] Permiso para cruzar recibido.")
-        en_cruce = True
-
-def main():
-    detener()
-    conectar_wifi()
-    print("[ROBOT] Conectando al broker MQTT...")
-    client = MQTTClient(CLIENT_ID, BROKER_IP)
-    client.set_callback(on_mensaje)
-    client.connect()
-    print("[ROBOT] Conectado al broker como", CLIENT_ID)
-    client.subscribe(TOPICO_RESPUESTA)
-    print("[ROBOT] Suscrito a:", TOPICO_RESPUESTA)
-    time.sleep(2)
-    avanzar()
-    time.sleep(4)
-    detener()
-    client.publish(TOPICO_SOLICITUD, CLIENT_ID.encode() + b":solicitud")
-    print("[ROBOT] Solicitud de cruce enviada.")
-    print("[ROBOT] Esperando permiso para cruzar...")
-    while not en_cruce:
-        client.check_msg()
-        time.sleep(0.1)
-    avanzar()
-    time.sleep(4)
-    detener()
-    client.publish(TOPICO_REPORTES, CLIENT_ID.encode() + b":llego")
-    print("[ROBOT] Reporte enviado: llego")
-    client.publish(TOPICO_REPORTES, CLIENT_ID.encode() + b":cruce_liberado")
-    print("[ROBOT] Reporte enviado: cruce liberado")
-    time.sleep(2)
-    avanzar()
-    time.sleep(4)
-    detener()
-    print("[ROBOT] Cruce completado.")
-    time.sleep(1000)
-
-if __name__ == '__main__':
-    main()
\ No newline at end of file
+from machine import Pin, PWM
+import time
+from umqtt.simple import MQTTClient
+import network
+import select
+
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+WIFI_SSID   = "XXXXXXX"
+WIFI_PASS   = "XXXXXXX" 
+BROKER_IP   = "XXXXXXX"
+CLIENT_ID   = "robotX"
+
+# Con CRUCE_ID los topics llevan el identificador del cruce (cruce/<id>/...),
+# así varios cruces comparten broker. Vacío, son los de un cruce solo.
+CRUCE_ID = ""
+
+def configurar_topicos():
+    global TOPICO_SOLICITUD, TOPICO_RESPUESTA, TOPICO_REPORTES
+    cruce = b"cruce/" + CRUCE_ID.encode() + b"/" if CRUCE_ID else b"cruce/"
+    TOPICO_SOLICITUD = cruce + b"solicitud"
+    TOPICO_RESPUESTA = cruce + b"respuesta"
+    TOPICO_REPORTES  = cruce + b"reportes"
+
+configurar_topicos()
+
+# Con un controlador anterior a los topics por robot, las respuestas llegan
+# a todos por TOPICO_RESPUESTA.
+RESPUESTAS_COMPARTIDAS = False
+
+PIN_SERVO_IZQ = 13
+PIN_SERVO_DER = 14
+
+led = Pin(2, Pin.OUT)
+
+servo_izq = PWM(Pin(PIN_SERVO_IZQ), freq=50)
+servo_der = PWM(Pin(PIN_SERVO_DER), freq=50)
+
+# Movimiento como datos: cada tramo es (duty izquierdo, duty derecho, ms).
+# ejecutar() los recorre atendiendo el socket MQTT mientras tanto.
+AVANCE = (4940, 4413)
+PARADA = (4700, 4800)
+PLAN_APROXIMACION = (PARADA + (2000,), AVANCE + (4000,), PARADA + (0,))
+PLAN_CRUCE = (AVANCE + (4000,), PARADA + (0,))
+PLAN_SALIDA = (PARADA + (2000,), AVANCE + (4000,), PARADA + (0,))
+
+en_cruce = False
+client = None
+permiso = b""
+
+def mover(d_izq, d_der):
+    servo_izq.duty_u16(d_izq)
+    servo_der.duty_u16(d_der)
+
+def avanzar():
+    print("[ROBOT] Avanzando...")
+    mover(*AVANCE)
+
+def detener():
+    print("[ROBOT] Detenido.")
+    mover(*PARADA)
+
+def led_parpadeo(intervalo, veces=None):
+    count = 0
+    while veces is None or count < veces:
+        led.on()
+        time.sleep(intervalo)
+        led.off()
+        time.sleep(intervalo)
+        count += 1
+        
+def led_encendido():
+    led.on()
+
+def led_apagado():
+    led.off()
+
+def conectar_wifi():
+    print("[ROBOT] Conectando a WiFi...")
+    wlan = network.WLAN(network.STA_IF)
+    wlan.active(True)
+    wlan.connect(WIFI_SSID, WIFI_PASS)
+    while not wlan.isconnected():
+        led_parpadeo(0.2, 1)
+        time.sleep(1)
+    print("[ROBOT] WiFi conectado:", wlan.ifconfig())
+    led_encendido()
+
+def on_mensaje(topic, msg):
+    global en_cruce
+    print(f"[ROBOT] Mensaje recibido en {topic}: {msg}")
+    if msg.startswith(permiso):
+        print("[ROBOT] Permiso para cruzar recibido.")
+        en_cruce = True
+
+def ejecutar(plan):
+    # Entre un cambio de tramo y el siguiente espera en el socket en lugar de
+    # dormir; los plazos se cuentan desde el inicio del plan.
+    sondeo = select.poll()
+    sondeo.register(client.sock, select.POLLIN)
+    inicio = ticks_ms()
+    fin = 0
+    for d_izq, d_der, ms in plan:
+        mover(d_izq, d_der)
+        fin += ms
+        restante = fin - ticks_diff(ticks_ms(), inicio)
+        while restante > 0:
+            if sondeo.poll(restante):
+                client.check_msg()
+            restante = fin - ticks_diff(ticks_ms(), inicio)
+
+def esperar_permiso():
+    # Bloquea en el socket MQTT: despierta en cuanto llega un mensaje.
+    sondeo = select.poll()
+    sondeo.register(client.sock, select.POLLIN)
+    while not en_cruce:
+        if sondeo.poll():
+            client.check_msg()
+
+def main():
+    global client, permiso
+    configurar_topicos()
+    # El permiso se compara como bytes, sin decodificar cada mensaje.
+    permiso = CLIENT_ID.encode() + b":pasar"
+    detener()
+    conectar_wifi()
+    print("[ROBOT] Conectando al broker MQTT...")
+    client = MQTTClient(CLIENT_ID, BROKER_IP)
+    client.set_callback(on_mensaje)
+    client.connect()
+    print("[ROBOT] Conectado al broker como", CLIENT_ID)
+    topico = TOPICO_RESPUESTA
+    if not RESPUESTAS_COMPARTIDAS:
+        topico = TOPICO_RESPUESTA + b"/" + CLIENT_ID.encode()
+    client.subscribe(topico)
+    print("[ROBOT] Suscrito a:", topico)
+    ejecutar(PLAN_APROXIMACION)
+    client.publish(TOPICO_SOLICITUD, CLIENT_ID.encode() + b":solicitud")
+    print("[ROBOT] Solicitud de cruce enviada.")
+    print("[ROBOT] Esperando permiso para cruzar...")
+    esperar_permiso()
+    ejecutar(PLAN_CRUCE)
+    client.publish(TOPICO_REPORTES, CLIENT_ID.encode() + b":llego")
+    print("[ROBOT] Reporte enviado: llego")
+    client.publish(TOPICO_REPORTES, CLIENT_ID.encode() + b":cruce_liberado")
+    print("[ROBOT] Reporte enviado: cruce liberado")
+    ejecutar(PLAN_SALIDA)
+    print("[ROBOT] Cruce completado.")
+    time.sleep(1000)
+
+if __name__ == '__main__':
+    main()
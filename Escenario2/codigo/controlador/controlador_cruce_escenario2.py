@@ -1,99 +1,300 @@
-import network
-import time
-from umqtt.simple import MQTTClient
-
-WIFI_SSID   = "XXXXX"
-WIFI_PASS   = "XXXXX"
-BROKER_IP   = "XXXXX"
-CLIENT_ID   = "controlador_cruce1_escenario2"
-
-TOPICO_SOLICITUD = b"cruce/solicitud"
-TOPICO_RESPUESTA = b"cruce/respuesta"
-TOPICO_REPORTES  = b"cruce/reportes"
-
-cruce_ocupado = False
-active_robot = None
-cola_espera = []
-prioridades = {
-    "robot1": 1,
-    "robot2": 2,
-    "robot3": 3,
-    "robot4": 4
-}
-client = None
-
-def conectar_wifi():
-    print("Activando WiFi...")
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    wlan.connect(WIFI_SSID, WIFI_PASS)
-    print("Conectando a WiFi...")
-    while not wlan.isconnected():
-        time.sleep(1)
-    print("Conectado a WiFi:", wlan.ifconfig())
-
-def extraer_robot_id(msg):
-    return msg.split(":")[0].strip()
-
-def obtener_prioridad(robot_id):
-    if robot_id in prioridades:
-        return prioridades[robot_id]
-    else:
-        return 99
-
-def sub_cb(topic, msg):
-    global cruce_ocupado, active_robot, cola_espera
-    t = topic.decode()
-    m = msg.decode()
-    print("Mensaje recibido en", t, ":", m)
-    if t == "cruce/solicitud":
-        robot_id = extraer_robot_id(m)
-        print("Solicitud de paso recibida de:", robot_id)
-        if not cruce_ocupado:
-            cruce_ocupado = True
-            active_robot = robot_id
-            print("Cruce libre. Autorizando paso a:", robot_id)
-            client.publish(TOPICO_RESPUESTA, (robot_id + ":pasar").encode())
-        else:
-            print("Cruce ocupado por:", active_robot)
-            if robot_id != active_robot and robot_id not in cola_espera:
-                cola_espera.append(robot_id)
-                print("Añadiendo a cola de espera:", robot_id)
-            client.publish(TOPICO_RESPUESTA, (robot_id + ":esperar").encode())
-    elif t == "cruce/reportes":
-        parts = m.split(":")
-        if len(parts) >= 2 and parts[1].strip() == "cruce_liberado":
-            print("Reporte de cruce liberado por:", parts[0].strip())
-            if parts[0].strip() == active_robot:
-                cruce_ocupado = False
-                active_robot = None
-                print("Cruce liberado. Revisando cola de espera...")
-                if cola_espera:
-                    ordenados = sorted(cola_espera, key=obtener_prioridad)
-                    siguiente = ordenados[0]
-                    cola_espera.remove(siguiente)
-                    cruce_ocupado = True
-                    active_robot = siguiente
-                    print("Autorizando paso a robot con prioridad:", siguiente)
-                    client.publish(TOPICO_RESPUESTA, (siguiente + ":pasar").encode())
-
-def main():
-    global client
-    conectar_wifi()
-    print("Conectando al broker MQTT...")
-    client = MQTTClient(CLIENT_ID, BROKER_IP)
-    client.set_callback(sub_cb)
-    client.connect()
-    print("Conectado al broker MQTT")
-    client.subscribe(TOPICO_SOLICITUD)
-    client.subscribe(TOPICO_REPORTES)
-    print("Suscrito a los tópicos:", TOPICO_SOLICITUD.decode(), "y", TOPICO_REPORTES.decode())
-    client.publish(TOPICO_REPORTES, b"controlador_cruce1_escenario2:listo")
-    print("Mensaje de inicio publicado")
-    
-    while True:
-        client.check_msg()
-        time.sleep(0.1)
-
-if __name__ == '__main__':
-    main()
\ No newline at end of file
+import network
+import time
+import heapq
+import select
+from umqtt.simple import MQTTClient
+
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+WIFI_SSID   = "XXXXX"
+WIFI_PASS   = "XXXXX"
+BROKER_IP   = "XXXXX"
+CLIENT_ID   = "controlador_cruce1_escenario2"
+
+# Con CRUCE_ID los topics llevan el identificador del cruce (cruce/<id>/...),
+# así varios cruces comparten broker. Vacío, son los de un cruce solo.
+CRUCE_ID = ""
+
+def configurar_topicos():
+    global TOPICO_SOLICITUD, TOPICO_RESPUESTA, TOPICO_REPORTES
+    cruce = b"cruce/" + CRUCE_ID.encode() + b"/" if CRUCE_ID else b"cruce/"
+    TOPICO_SOLICITUD = cruce + b"solicitud"
+    TOPICO_RESPUESTA = cruce + b"respuesta"
+    TOPICO_REPORTES  = cruce + b"reportes"
+
+configurar_topicos()
+
+# Cada robot recibe sus respuestas en TOPICO_RESPUESTA + b"/" + su id. Con
+# MODO_COMPATIBLE se publican también en TOPICO_RESPUESTA, para los robots
+# con el firmware anterior, que escuchan todos ese topic.
+MODO_COMPATIBLE = False
+
+# Orden de las colas de espera. "prioridad" (el original): siempre el mejor
+# según `prioridades`, aunque los demás esperen sin límite. "fifo": por orden de
+# llegada, como el Escenario 1. "envejecimiento": la prioridad mejora con la
+# espera, un nivel cada ENVEJECIMIENTO_MS, y a un robot solo pueden
+# adelantarle los que llegan menos de ADELANTO_MAXIMO_MS después que él.
+POLITICA = "prioridad"
+ENVEJECIMIENTO_MS  = 2000
+ADELANTO_MAXIMO_MS = 10000
+
+PRESUPUESTO_MENSAJES = 32
+PAUSA_INACTIVO = 0.1
+
+cruce_ocupado = False
+active_robot = None
+prioridades = {
+    "robot1": 1,
+    "robot2": 2,
+    "robot3": 3,
+    "robot4": 4
+}
+client = None
+_sock_sondeado = None
+_sondeo = None
+_tick = ticks_ms()
+_ahora = 0
+
+def conectar_wifi():
+    print("Activando WiFi...")
+    wlan = network.WLAN(network.STA_IF)
+    wlan.active(True)
+    wlan.connect(WIFI_SSID, WIFI_PASS)
+    print("Conectando a WiFi...")
+    while not wlan.isconnected():
+        time.sleep(1)
+    print("Conectado a WiFi:", wlan.ifconfig())
+
+ACTIVO = "activo"
+
+class RegistroRobots:
+    # Interna los identificadores ("robot3") en enteros pequeños y guarda dónde
+    # está cada robot: el nombre de la cola en la que espera, ACTIVO o None.
+    def __init__(self):
+        self.ids = []
+        self.ubicacion = []
+        self._handles = {}
+        self._respuestas = []
+        self._topicos = []
+
+    def handle(self, robot_id):
+        h = self._handles.get(robot_id)
+        if h is None:
+            h = len(self.ids)
+            self._handles[robot_id] = h
+            self.ids.append(robot_id)
+            self.ubicacion.append(None)
+            self._respuestas.append({})
+            self._topicos.append(None)
+        return h
+
+    def respuesta(self, h, orden):
+        # Mensaje "robot3:pasar" ya codificado: se construye una vez por robot
+        # y orden, y después se reutiliza.
+        cache = self._respuestas[h]
+        msg = cache.get(orden)
+        if msg is None:
+            msg = cache[orden] = (self.ids[h] + ":" + orden).encode()
+        return msg
+
+    def topico(self, h):
+        t = self._topicos[h]
+        if t is None:
+            t = self._topicos[h] = TOPICO_RESPUESTA + b"/" + self.ids[h].encode()
+        return t
+
+    def buscar(self, robot_id):
+        return self._handles.get(robot_id)
+
+    def donde(self, robot_id):
+        h = self._handles.get(robot_id)
+        return None if h is None else self.ubicacion[h]
+
+class ColaPrioridad:
+    # Montículo de [prioridad, orden, handle] con índice por handle. Mantiene al
+    # día la ubicación del robot en el registro. Las bajas son perezosas: la
+    # entrada se marca y se descarta al llegar a la cima. Las entradas que
+    # salen del montículo se reutilizan, así que un alta no reserva memoria.
+    def __init__(self, nombre, registro, prioridad):
+        self.nombre = nombre
+        self._registro = registro
+        self._prioridad = prioridad
+        self._heap = []
+        self._entradas = {}
+        self._libres = []
+        self._orden = 0
+
+    def __len__(self):
+        return len(self._entradas)
+
+    def __contains__(self, h):
+        return h in self._entradas
+
+    def push(self, h):
+        if h in self._entradas:
+            return False
+        entrada = self._libres.pop() if self._libres else [0, 0, None]
+        entrada[0] = self._prioridad(self._registro.ids[h])
+        entrada[1] = self._orden
+        entrada[2] = h
+        self._orden += 1
+        self._entradas[h] = entrada
+        heapq.heappush(self._heap, entrada)
+        self._registro.ubicacion[h] = self.nombre
+        return True
+
+    def remove(self, h):
+        entrada = self._entradas.pop(h, None)
+        if entrada is None:
+            return False
+        entrada[2] = None
+        self._registro.ubicacion[h] = None
+        if len(self._heap) > 2 * len(self._entradas) + 8:
+            self._heap = [e for e in self._heap if e[2] is not None]
+            heapq.heapify(self._heap)
+        return True
+
+    def peek(self):
+        heap = self._heap
+        while heap and heap[0][2] is None:
+            self._libres.append(heapq.heappop(heap))
+        return heap[0][2] if heap else None
+
+    def pop(self):
+        h = self.peek()
+        if h is not None:
+            self._libres.append(heapq.heappop(self._heap))
+            del self._entradas[h]
+            self._registro.ubicacion[h] = None
+        return h
+
+    def clear(self):
+        for h in self._entradas:
+            self._registro.ubicacion[h] = None
+        self._heap = []
+        self._entradas.clear()
+
+    def ordenados(self):
+        ids = self._registro.ids
+        return [ids[e[2]] for e in sorted(self._heap) if e[2] is not None]
+
+def extraer_robot_id(msg):
+    return msg.split(":")[0].strip()
+
+def obtener_prioridad(robot_id):
+    if robot_id in prioridades:
+        return prioridades[robot_id]
+    else:
+        return 99
+
+def ahora_ms():
+    # Reloj en milisegundos que acumula ticks_diff: no da la vuelta como ticks_ms.
+    global _tick, _ahora
+    t = ticks_ms()
+    _ahora += ticks_diff(t, _tick)
+    _tick = t
+    return _ahora
+
+def clave_espera(robot_id):
+    # Clave de la cola según POLITICA; a igual clave, el que llegó antes. Con
+    # envejecimiento es la hora de llegada más un retraso por cada nivel de
+    # prioridad (limitado a ADELANTO_MAXIMO_MS): ordenar por ella equivale a
+    # ordenar por la prioridad mejorada con la espera, y no cambia mientras
+    # el robot espera.
+    if POLITICA == "prioridad":
+        return obtener_prioridad(robot_id)
+    if POLITICA == "fifo":
+        return ahora_ms()
+    retraso = (obtener_prioridad(robot_id) - 1) * ENVEJECIMIENTO_MS
+    return ahora_ms() + min(retraso, ADELANTO_MAXIMO_MS)
+
+registro = RegistroRobots()
+cola_espera = ColaPrioridad("espera", registro, clave_espera)
+
+def responder(h, orden):
+    msg = registro.respuesta(h, orden)
+    client.publish(registro.topico(h), msg)
+    if MODO_COMPATIBLE:
+        client.publish(TOPICO_RESPUESTA, msg)
+
+def sub_cb(topic, msg):
+    global cruce_ocupado, active_robot, cola_espera
+    t = topic.decode()
+    m = msg.decode()
+    print("Mensaje recibido en", t, ":", m)
+    if topic == TOPICO_SOLICITUD:
+        robot_id = extraer_robot_id(m)
+        h = registro.handle(robot_id)
+        print("Solicitud de paso recibida de:", robot_id)
+        if not cruce_ocupado:
+            cruce_ocupado = True
+            active_robot = robot_id
+            registro.ubicacion[h] = ACTIVO
+            print("Cruce libre. Autorizando paso a:", robot_id)
+            responder(h, "pasar")
+        else:
+            print("Cruce ocupado por:", active_robot)
+            if registro.ubicacion[h] is None:
+                cola_espera.push(h)
+                print("Añadiendo a cola de espera:", robot_id)
+            responder(h, "esperar")
+    elif topic == TOPICO_REPORTES:
+        parts = m.split(":")
+        if len(parts) >= 2 and parts[1].strip() == "cruce_liberado":
+            print("Reporte de cruce liberado por:", parts[0].strip())
+            if parts[0].strip() == active_robot:
+                registro.ubicacion[registro.buscar(active_robot)] = None
+                cruce_ocupado = False
+                active_robot = None
+                print("Cruce liberado. Revisando cola de espera...")
+                h = cola_espera.pop()
+                if h is not None:
+                    siguiente = registro.ids[h]
+                    cruce_ocupado = True
+                    active_robot = siguiente
+                    registro.ubicacion[h] = ACTIVO
+                    print("Autorizando paso a robot con prioridad:", siguiente)
+                    responder(h, "pasar")
+
+def drenar_mensajes():
+    # Atiende todo lo pendiente en el socket MQTT, hasta PRESUPUESTO_MENSAJES
+    # por pasada. Devuelve True si se agotó el presupuesto y puede quedar más.
+    global _sock_sondeado, _sondeo
+    if client.sock is not _sock_sondeado:
+        _sock_sondeado = client.sock
+        _sondeo = select.poll()
+        _sondeo.register(_sock_sondeado, select.POLLIN)
+    for _ in range(PRESUPUESTO_MENSAJES):
+        if not _sondeo.poll(0):
+            return False
+        client.check_msg()
+    return True
+
+def main():
+    global client
+    configurar_topicos()
+    conectar_wifi()
+    print("Conectando al broker MQTT...")
+    client = MQTTClient(CLIENT_ID, BROKER_IP)
+    client.set_callback(sub_cb)
+    client.connect()
+    print("Conectado al broker MQTT")
+    client.subscribe(TOPICO_SOLICITUD)
+    client.subscribe(TOPICO_REPORTES)
+    print("Suscrito a los tópicos:", TOPICO_SOLICITUD.decode(), "y", TOPICO_REPORTES.decode())
+    client.publish(TOPICO_REPORTES, b"controlador_cruce1_escenario2:listo")
+    print("Mensaje de inicio publicado")
+    
+    while True:
+        if not drenar_mensajes():
+            time.sleep(PAUSA_INACTIVO)
+
+if __name__ == '__main__':
+    main()
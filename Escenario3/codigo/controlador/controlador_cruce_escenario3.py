@@ -1,202 +1,800 @@
-import network
-import time
-import machine
-from umqtt.robust import MQTTClient
-
-WIFI_SSID     = "XXXXX"
-WIFI_PASS     = "XXXXX"
-BROKER_IP     = "XXXXX"
-CLIENT_ID     = b"controlador_cruce1_escenario3"
-
-TOPICO_SOLICITUD   = b"cruce/solicitud"
-TOPICO_RESPUESTA   = b"cruce/respuesta"
-TOPICO_REPORTES    = b"cruce/reportes"
-TOPICO_ESTADO_ACT  = b"cruce/estado/active_robot"
-TOPICO_ESTADO_COLA = b"cruce/estado/cola"
-TOPICO_SYNC        = b"robots/solicitar_estado"
-
-cruce_ocupado = False
-active_robot  = None
-cola_espera   = []
-prioridades   = { "robot1":1, "robot2":2, "robot3":3, "robot4":4 }
-client = None
-
-TIEMPO_MAX_CRUCE = 10
-tiempo_inicio_cruce = 0
-wdt = machine.WDT(timeout=150000)
-
-def conectar_wifi():
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    wlan.connect(WIFI_SSID, WIFI_PASS)
-    while not wlan.isconnected():
-        time.sleep(1)
-    print("WiFi OK", wlan.ifconfig())
-
-def verificar_wifi():
-    wlan = network.WLAN(network.STA_IF)
-    if not wlan.isconnected():
-        print("WiFi desconectado. Reconectando...")
-        wlan.active(True)
-        wlan.connect(WIFI_SSID, WIFI_PASS)
-        while not wlan.isconnected():
-            time.sleep(1)
-        print("WiFi reconectado:", wlan.ifconfig())
-
-def extraer_robot_id(msg: bytes) -> str:
-    return msg.decode().split(":", 1)[0].strip()
-
-def obtener_prioridad(robot_id: str) -> int:
-    return prioridades.get(robot_id, 99)
-
-def publicar_estado():
-    if active_robot:
-        client.publish(TOPICO_ESTADO_ACT, active_robot.encode(), qos=1, retain=True)
-    else:
-        client.publish(TOPICO_ESTADO_ACT, b"", qos=1, retain=True)
-
-    if cola_espera:
-        cola_str = ",".join(cola_espera)
-        client.publish(TOPICO_ESTADO_COLA, cola_str.encode(), qos=1, retain=True)
-    else:
-        client.publish(TOPICO_ESTADO_COLA, b"", qos=1, retain=True)
-
-def restaurar_estado(topic, msg):
-    global active_robot, cola_espera, cruce_ocupado, tiempo_inicio_cruce
-    if topic == TOPICO_ESTADO_ACT:
-        if msg and len(msg.strip()) > 0:
-            active_robot = msg.decode().strip()
-            cruce_ocupado = True
-            tiempo_inicio_cruce = time.time()
-            print("Estado restaurado: active_robot =", active_robot)
-        else:
-            active_robot = None
-            cruce_ocupado = False
-            print("Estado restaurado: sin robot activo")
-    elif topic == TOPICO_ESTADO_COLA:
-        if msg and len(msg.strip()) > 0:
-            cola_espera[:] = msg.decode().strip().split(",")
-            print("Estado restaurado: cola_espera =", sorted(cola_espera, key=obtener_prioridad))
-        else:
-            cola_espera.clear()
-            print("Estado restaurado: cola vacía")
-
-def procesar_mensaje(topic, msg):
-    global cruce_ocupado, active_robot, cola_espera, tiempo_inicio_cruce
-    if topic == TOPICO_SOLICITUD:
-        if not msg or len(msg.strip()) == 0:
-            return
-        r = extraer_robot_id(msg)
-        if r == active_robot:
-            print("Solicitud repetida de robot activo, ignorando.")
-            return
-        print("Solicitud de paso recibida de:", r)
-        if not cruce_ocupado:
-            cruce_ocupado = True
-            active_robot = r
-            tiempo_inicio_cruce = time.time()
-            print("Cruce libre. Autorizando paso a:", r)
-            client.publish(TOPICO_RESPUESTA, f"{r}:pasar".encode(), qos=1)
-            publicar_estado()
-            client.publish(TOPICO_SOLICITUD, b"", qos=1, retain=True)
-        else:
-            print("Cruce ocupado por:", active_robot)
-            if r != active_robot and r not in cola_espera:
-                cola_espera.append(r)
-                print("Añadiendo a cola de espera:", r)
-            print("Cola de espera actual:", sorted(cola_espera, key=obtener_prioridad))
-            client.publish(TOPICO_RESPUESTA, f"{r}:esperar".encode(), qos=1)
-    elif topic == TOPICO_REPORTES:
-        origen, evento = msg.decode().split(":", 1)
-        if evento == "cruce_liberado" and origen == active_robot:
-            print("Cruce liberado por:", origen)
-            cruce_ocupado = False
-            active_robot = None
-            tiempo_inicio_cruce = 0
-            publicar_estado()
-            if cola_espera:
-                siguiente = sorted(cola_espera, key=obtener_prioridad)[0]
-                cola_espera.remove(siguiente)
-                cruce_ocupado = True
-                active_robot = siguiente
-                tiempo_inicio_cruce = time.time()
-                print("Autorizando paso a robot con prioridad:", siguiente)
-                client.publish(TOPICO_RESPUESTA, f"{siguiente}:pasar".encode(), qos=1)
-                publicar_estado()
-            print("Cola de espera actual:", sorted(cola_espera, key=obtener_prioridad))
-
-def revisar_timeout():
-    global cruce_ocupado, active_robot, tiempo_inicio_cruce
-    if cruce_ocupado and active_robot:
-        ahora = time.time()
-        if ahora - tiempo_inicio_cruce > TIEMPO_MAX_CRUCE:
-            print("Timeout:", active_robot, "ha tardado demasiado. Liberando el cruce.")
-            client.publish(TOPICO_REPORTES, f"{active_robot}:timeout".encode(), qos=1)
-            client.publish(TOPICO_RESPUESTA, f"{active_robot}:expulsado".encode(), qos=1)
-            cruce_ocupado = False
-            active_robot = None
-            tiempo_inicio_cruce = 0
-            publicar_estado()
-            if cola_espera:
-                siguiente = sorted(cola_espera, key=obtener_prioridad)[0]
-                cola_espera.remove(siguiente)
-                cruce_ocupado = True
-                active_robot = siguiente
-                tiempo_inicio_cruce = time.time()
-                print("Autorizando paso a robot con prioridad:", siguiente)
-                client.publish(TOPICO_RESPUESTA, f"{siguiente}:pasar".encode(), qos=1)
-                publicar_estado()
-            print("Cola de espera actual:", sorted(cola_espera, key=obtener_prioridad))
-            
-def conectar_broker():
-    global client
-    while True:
-        try:
-            client = MQTTClient(client_id=CLIENT_ID, server=BROKER_IP, keepalive=60)
-            client.set_last_will(topic=TOPICO_REPORTES, msg=CLIENT_ID + b":offline", retain=True, qos=1)
-            client.connect(clean_session=False)
-            print("Conectado al broker MQTT")
-            break
-        except OSError as e:
-            print("Broker no disponible. Reintentando en 5s...", e)
-            time.sleep(5)
-
-def inicializar_mqtt():
-    global tiempo_inicio_cruce
-    client.set_callback(restaurar_estado)
-    client.subscribe(TOPICO_ESTADO_ACT, qos=1)
-    client.subscribe(TOPICO_ESTADO_COLA, qos=1)
-    client.check_msg()
-    client.publish(TOPICO_SYNC, b"reanunciar", qos=1)
-    client.set_callback(procesar_mensaje)
-    client.subscribe(TOPICO_SOLICITUD, qos=1)
-    client.subscribe(TOPICO_REPORTES, qos=1)
-    client.publish(TOPICO_REPORTES, CLIENT_ID + b":online", qos=1, retain=True)
-    publicar_estado()
-    print("Estado inicial publicado.")
-    if cruce_ocupado and active_robot:
-        tiempo_inicio_cruce = time.time()
-        print("Reconexión: reinicio contador de cruce para", active_robot)
-
-def main():
-    global client
-    conectar_wifi()
-    conectar_broker()
-    inicializar_mqtt()
-    while True:
-        try:
-            verificar_wifi()
-            client.check_msg()
-            revisar_timeout()
-        except OSError as e:
-            print("MQTT desconectado. Reintentando en 5s...", e)
-            time.sleep(5)
-            conectar_broker()
-            inicializar_mqtt()
-        except Exception as e:
-            print("Error de bucle:", e)
-        wdt.feed()
-        time.sleep(0.5)
-
-if __name__ == "__main__":
-    main()
\ No newline at end of file
+import network
+import os
+import sys
+import time
+import heapq
+import select
+import machine
+from umqtt.robust import MQTTClient
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+WIFI_SSID     = "XXXXX"
+WIFI_PASS     = "XXXXX"
+BROKER_IP     = "XXXXX"
+CLIENT_ID     = b"controlador_cruce1_escenario3"
+
+# Con CRUCE_ID los topics llevan el identificador del cruce (cruce/<id>/...
+# y robots/<id>/solicitar_estado), así varios cruces comparten broker. Vacío,
+# son los de un cruce solo.
+CRUCE_ID = ""
+
+def configurar_topicos():
+    global TOPICO_SOLICITUD, TOPICO_RESPUESTA, TOPICO_RESPUESTA_BIN, TOPICO_REPORTES
+    global TOPICO_ESTADO_ACT, TOPICO_ESTADO_COLA, TOPICO_SYNC
+    cruce = b"cruce/" + CRUCE_ID.encode() + b"/" if CRUCE_ID else b"cruce/"
+    robots = b"robots/" + CRUCE_ID.encode() + b"/" if CRUCE_ID else b"robots/"
+    TOPICO_SOLICITUD   = cruce + b"solicitud"
+    TOPICO_RESPUESTA   = cruce + b"respuesta"
+    TOPICO_RESPUESTA_BIN = cruce + b"respuesta/bin"
+    TOPICO_REPORTES    = cruce + b"reportes"
+    TOPICO_ESTADO_ACT  = cruce + b"estado/active_robot"
+    TOPICO_ESTADO_COLA = cruce + b"estado/cola"
+    TOPICO_SYNC        = robots + b"solicitar_estado"
+
+configurar_topicos()
+
+# Cada robot recibe sus respuestas, de texto o binarias, en TOPICO_RESPUESTA +
+# b"/" + su id. Con MODO_COMPATIBLE se publican también en los topics
+# compartidos, para los robots con el firmware anterior.
+MODO_COMPATIBLE = False
+
+# Orden de las colas de espera. "prioridad" (el original): siempre el mejor
+# según `prioridades`, aunque los demás esperen sin límite. "fifo": por orden de
+# llegada, como el Escenario 1. "envejecimiento": la prioridad mejora con la
+# espera, un nivel cada ENVEJECIMIENTO_MS, y a un robot solo pueden
+# adelantarle los que llegan menos de ADELANTO_MAXIMO_MS después que él.
+POLITICA = "prioridad"
+ENVEJECIMIENTO_MS  = 2000
+ADELANTO_MAXIMO_MS = 10000
+
+PRESUPUESTO_MENSAJES = 32
+ESPERA_SOCKET_S      = 1
+PERIODO_WATCHDOG_S   = 5
+PERIODO_CONEXION_S   = 1
+PERIODO_PING_S       = 30
+
+# Al arrancar o reconectar, el controlador pide a los robots que repitan su
+# solicitud con "reanunciar:<ventana ms>[:<robots recuperados>]" en
+# TOPICO_SYNC. Los que ya recuperó del estado retenido no la repiten; los
+# demás la mandan tras un retardo al azar dentro de la ventana, para que no
+# lleguen todas a la vez. La ventana crece MS_POR_ROBOT_SYNC por robot
+# conocido (al menos FLOTA_SYNC) hasta VENTANA_MAXIMA_SYNC_MS; con 0 repiten
+# en cuanto les llega el aviso y sin SYNC_CON_LISTA la repiten todos.
+FLOTA_SYNC             = 100
+MS_POR_ROBOT_SYNC      = 5
+VENTANA_MAXIMA_SYNC_MS = 10000
+SYNC_CON_LISTA         = True
+ESPERA_RETENIDOS_MS    = 500
+
+cruce_ocupado = False
+active_robot  = None
+prioridades   = { "robot1":1, "robot2":2, "robot3":3, "robot4":4 }
+client = None
+_sock_sondeado = None
+_sondeo = None
+reconectando = False
+aviso_plazos = asyncio.Event()
+estado_pendiente = False
+salida = []
+version_estado = 0
+versiones_estado = {}
+estado_publicado = {}
+cambios_cola_publicados = -1
+solicitudes_leidas = {}
+reportes_leidos = {}
+
+TIEMPO_MAX_CRUCE_MS = 10000
+wdt = machine.WDT(timeout=150000)
+
+def conectar_wifi():
+    wlan = network.WLAN(network.STA_IF)
+    wlan.active(True)
+    wlan.connect(WIFI_SSID, WIFI_PASS)
+    while not wlan.isconnected():
+        time.sleep(1)
+    print("WiFi OK", wlan.ifconfig())
+
+def verificar_wifi():
+    wlan = network.WLAN(network.STA_IF)
+    if not wlan.isconnected():
+        print("WiFi desconectado. Reconectando...")
+        wlan.active(True)
+        wlan.connect(WIFI_SSID, WIFI_PASS)
+        while not wlan.isconnected():
+            time.sleep(1)
+        print("WiFi reconectado:", wlan.ifconfig())
+
+ACTIVO = "activo"
+
+# Protocolo binario opcional. Una trama empieza por MAGICO (0xFF no aparece en
+# UTF-8, así que no se confunde con un mensaje de texto) y sigue con el tipo,
+# el movimiento, la época del controlador, el handle del robot y un número de
+# secuencia (2 bytes cada uno). Mientras el robot no conoce su handle añade su
+# id detrás de la cabecera, y el controlador hace lo mismo en sus respuestas.
+MAGICO      = 0xFF
+T_SOLICITUD = 1
+T_PASAR     = 2
+T_ESPERAR   = 3
+T_LLEGO     = 4
+T_LIBERADO  = 5
+T_EXPULSADO = 6
+T_PREPARARSE = 8
+SIN_HANDLE  = 0xFFFF
+TEXTO          = 0
+BINARIO        = 1
+BINARIO_CON_ID = 2
+ORDENES_BIN = {"pasar": T_PASAR, "esperar": T_ESPERAR, "expulsado": T_EXPULSADO,
+               "prepararse": T_PREPARARSE}
+EPOCA = os.urandom(1)[0] or 1
+_trama = bytearray(8)
+
+class RegistroRobots:
+    # Interna los identificadores ("robot3") en enteros pequeños y guarda dónde
+    # está cada robot: el nombre de la cola en la que espera, ACTIVO o None.
+    # También el protocolo con el que habla, su última secuencia binaria y el
+    # número de su última solicitud atendida.
+    def __init__(self):
+        self.ids = []
+        self.ubicacion = []
+        self.protocolo = []
+        self.secuencia = []
+        self.solicitud = []
+        self._handles = {}
+        self._respuestas = []
+        self._topicos = []
+
+    def handle(self, robot_id):
+        h = self._handles.get(robot_id)
+        if h is None:
+            h = len(self.ids)
+            self._handles[robot_id] = h
+            self.ids.append(robot_id)
+            self.ubicacion.append(None)
+            self._respuestas.append({})
+            self._topicos.append(None)
+            self.protocolo.append(TEXTO)
+            self.secuencia.append(0)
+            self.solicitud.append(None)
+        return h
+
+    def respuesta(self, h, orden):
+        # Mensaje "robot3:pasar" ya codificado: se construye una vez por robot
+        # y orden, y después se reutiliza.
+        cache = self._respuestas[h]
+        msg = cache.get(orden)
+        if msg is None:
+            msg = cache[orden] = (self.ids[h] + ":" + orden).encode()
+        return msg
+
+    def topico(self, h):
+        t = self._topicos[h]
+        if t is None:
+            t = self._topicos[h] = TOPICO_RESPUESTA + b"/" + self.ids[h].encode()
+        return t
+
+    def buscar(self, robot_id):
+        return self._handles.get(robot_id)
+
+    def donde(self, robot_id):
+        h = self._handles.get(robot_id)
+        return None if h is None else self.ubicacion[h]
+
+class ColaPrioridad:
+    # Montículo de [prioridad, orden, handle] con índice por handle. Mantiene al
+    # día la ubicación del robot en el registro. Las bajas son perezosas: la
+    # entrada se marca y se descarta al llegar a la cima. `cambios` crece con
+    # cada alta o baja, para saber si hay que volver a publicar la cola. Las
+    # entradas que salen del montículo se reutilizan, así que un alta no
+    # reserva memoria.
+    def __init__(self, nombre, registro, prioridad):
+        self.nombre = nombre
+        self._registro = registro
+        self._prioridad = prioridad
+        self._heap = []
+        self._entradas = {}
+        self._libres = []
+        self._orden = 0
+        self.cambios = 0
+
+    def __len__(self):
+        return len(self._entradas)
+
+    def __contains__(self, h):
+        return h in self._entradas
+
+    def push(self, h):
+        if h in self._entradas:
+            return False
+        entrada = self._libres.pop() if self._libres else [0, 0, None]
+        entrada[0] = self._prioridad(self._registro.ids[h])
+        entrada[1] = self._orden
+        entrada[2] = h
+        self._orden += 1
+        self._entradas[h] = entrada
+        heapq.heappush(self._heap, entrada)
+        self._registro.ubicacion[h] = self.nombre
+        self.cambios += 1
+        return True
+
+    def remove(self, h):
+        entrada = self._entradas.pop(h, None)
+        if entrada is None:
+            return False
+        entrada[2] = None
+        self._registro.ubicacion[h] = None
+        self.cambios += 1
+        if len(self._heap) > 2 * len(self._entradas) + 8:
+            self._heap = [e for e in self._heap if e[2] is not None]
+            heapq.heapify(self._heap)
+        return True
+
+    def peek(self):
+        heap = self._heap
+        while heap and heap[0][2] is None:
+            self._libres.append(heapq.heappop(heap))
+        return heap[0][2] if heap else None
+
+    def pop(self):
+        h = self.peek()
+        if h is not None:
+            self._libres.append(heapq.heappop(self._heap))
+            del self._entradas[h]
+            self._registro.ubicacion[h] = None
+            self.cambios += 1
+        return h
+
+    def clear(self):
+        for h in self._entradas:
+            self._registro.ubicacion[h] = None
+        self._heap = []
+        self._entradas.clear()
+        self.cambios += 1
+
+    def ordenados(self):
+        ids = self._registro.ids
+        return [ids[e[2]] for e in sorted(self._heap) if e[2] is not None]
+
+class Plazos:
+    # Min-montículo de [vencimiento_ms, orden, handle] sobre un reloj propio en
+    # milisegundos que acumula ticks_diff, de modo que la vuelta de ticks_ms no
+    # desordena el montículo. Cancelar es O(1): la entrada se marca y se
+    # descarta al llegar a la cima, y después se reutiliza.
+    def __init__(self):
+        self._heap = []
+        self._entradas = {}
+        self._libres = []
+        self._orden = 0
+        self._tick = ticks_ms()
+        self._ahora = 0
+
+    def __len__(self):
+        return len(self._entradas)
+
+    def __contains__(self, h):
+        return h in self._entradas
+
+    def ahora(self):
+        t = ticks_ms()
+        self._ahora += ticks_diff(t, self._tick)
+        self._tick = t
+        return self._ahora
+
+    def programar(self, h, espera_ms):
+        self.cancelar(h)
+        entrada = self._libres.pop() if self._libres else [0, 0, None]
+        entrada[0] = self.ahora() + espera_ms
+        entrada[1] = self._orden
+        entrada[2] = h
+        self._orden += 1
+        self._entradas[h] = entrada
+        heapq.heappush(self._heap, entrada)
+
+    def cancelar(self, h):
+        entrada = self._entradas.pop(h, None)
+        if entrada is None:
+            return False
+        entrada[2] = None
+        if len(self._heap) > 2 * len(self._entradas) + 8:
+            self._heap = [e for e in self._heap if e[2] is not None]
+            heapq.heapify(self._heap)
+        return True
+
+    def restante_ms(self):
+        heap = self._heap
+        while heap and heap[0][2] is None:
+            self._libres.append(heapq.heappop(heap))
+        if not heap:
+            return None
+        return max(0, heap[0][0] - self.ahora())
+
+    def vencido(self):
+        # Handle de un plazo ya vencido, o None. Solo se mira la cima.
+        if self.restante_ms() != 0:
+            return None
+        entrada = heapq.heappop(self._heap)
+        self._libres.append(entrada)
+        h = entrada[2]
+        del self._entradas[h]
+        return h
+
+def extraer_robot_id(msg: bytes) -> str:
+    return msg.decode().split(":", 1)[0].strip()
+
+def obtener_prioridad(robot_id: str) -> int:
+    return prioridades.get(robot_id, 99)
+
+def clave_espera(robot_id):
+    # Clave de la cola según POLITICA; a igual clave, el que llegó antes. Con
+    # envejecimiento es la hora de llegada más un retraso por cada nivel de
+    # prioridad (limitado a ADELANTO_MAXIMO_MS): ordenar por ella equivale a
+    # ordenar por la prioridad mejorada con la espera, y no cambia mientras
+    # el robot espera.
+    if POLITICA == "prioridad":
+        return obtener_prioridad(robot_id)
+    if POLITICA == "fifo":
+        return plazos.ahora()
+    retraso = (obtener_prioridad(robot_id) - 1) * ENVEJECIMIENTO_MS
+    return plazos.ahora() + min(retraso, ADELANTO_MAXIMO_MS)
+
+registro = RegistroRobots()
+plazos = Plazos()
+cola_espera = ColaPrioridad("espera", registro, clave_espera)
+
+def fijar_activo(robot_id):
+    global active_robot, cruce_ocupado
+    if active_robot is not None:
+        h = registro.handle(active_robot)
+        registro.ubicacion[h] = None
+        plazos.cancelar(h)
+    active_robot = robot_id
+    cruce_ocupado = robot_id is not None
+    if robot_id is not None:
+        h = registro.handle(robot_id)
+        registro.ubicacion[h] = ACTIVO
+        plazos.programar(h, TIEMPO_MAX_CRUCE_MS)
+
+def encolar(topic, msg, retain=False):
+    salida.append((topic, msg, retain))
+
+def enviar_salida():
+    # Un publish con QoS 1 atiende los mensajes entrantes mientras espera su
+    # PUBACK. Si el manejador de uno de ellos publicara a su vez, ese publish
+    # se quedaría con el PUBACK del primero y el primero no volvería nunca;
+    # por eso los manejadores solo encolan y lo que encolen mientras tanto
+    # sale en esta misma vuelta.
+    i = 0
+    try:
+        while i < len(salida):
+            topic, msg, retain = salida[i]
+            client.publish(topic, msg, qos=1, retain=retain)
+            i += 1
+    finally:
+        del salida[:i]
+
+def publicar_estado():
+    # Solo marca el estado como pendiente: volcar_estado() lo publica una vez
+    # por pasada del bucle.
+    global estado_pendiente
+    estado_pendiente = True
+
+def volcar_estado():
+    # Publica en cada topic solo si su contenido ha cambiado, con una versión
+    # creciente delante ("<versión>:<estado>") para descartar retenidos viejos.
+    global estado_pendiente, version_estado, cambios_cola_publicados
+    enviar_salida()
+    if not estado_pendiente:
+        return
+    nuevos = []
+    activo = active_robot.encode() if active_robot else b""
+    if activo != estado_publicado.get(TOPICO_ESTADO_ACT):
+        nuevos.append((TOPICO_ESTADO_ACT, activo))
+    if cola_espera.cambios != cambios_cola_publicados:
+        cola = ",".join(cola_espera.ordenados()).encode()
+        if cola != estado_publicado.get(TOPICO_ESTADO_COLA):
+            nuevos.append((TOPICO_ESTADO_COLA, cola))
+    cambios_cola_publicados = cola_espera.cambios
+    estado_pendiente = False
+    if nuevos:
+        version_estado += 1
+        prefijo = str(version_estado).encode() + b":"
+        for topic, estado in nuevos:
+            # Se anota antes de publicar: mientras publish() espera el PUBACK
+            # pueden llegar el propio retenido y otros mensajes, que no deben
+            # tomarlo por un estado ajeno ni perder lo que cambien.
+            estado_publicado[topic] = estado
+            versiones_estado[topic] = version_estado
+            client.publish(topic, prefijo + estado, qos=1, retain=True)
+    enviar_salida()
+
+def leer_estado(topic, msg):
+    # Estado de una instantánea retenida, o None si no es más nueva que la
+    # última aplicada o publicada en ese topic. Sin versión (formato
+    # anterior) cuenta como la versión 0.
+    global version_estado
+    texto = msg.decode().strip()
+    version, sep, estado = texto.partition(":")
+    if sep and version.isdigit():
+        version = int(version)
+    else:
+        version, estado = 0, texto
+    if version <= versiones_estado.get(topic, -1):
+        return None
+    versiones_estado[topic] = version
+    version_estado = max(version_estado, version)
+    estado_publicado[topic] = estado.encode()
+    return estado
+
+def restaurar_estado(topic, msg):
+    global active_robot, cola_espera, cruce_ocupado
+    texto = leer_estado(topic, msg)
+    if texto is None:
+        return
+    if topic == TOPICO_ESTADO_ACT:
+        if texto:
+            fijar_activo(texto)
+            print("Estado restaurado: active_robot =", active_robot)
+        else:
+            fijar_activo(None)
+            print("Estado restaurado: sin robot activo")
+    elif topic == TOPICO_ESTADO_COLA:
+        if texto:
+            cola_espera.clear()
+            for r in texto.split(","):
+                if r and registro.donde(r) != ACTIVO:
+                    cola_espera.push(registro.handle(r))
+            print("Estado restaurado: cola_espera =", cola_espera.ordenados())
+        else:
+            cola_espera.clear()
+            print("Estado restaurado: cola vacía")
+
+def leer_trama(msg):
+    # Lee la cabecera indexando el mensaje recibido, sin copiarlo (vale igual
+    # para bytes, bytearray o memoryview). Devuelve el tipo y el handle, o
+    # SIN_HANDLE si la trama no identifica a ningún robot.
+    if len(msg) < 8:
+        return None, SIN_HANDLE
+    if len(msg) > 8:
+        h = registro.handle(bytes(msg[8:]).decode())
+        registro.protocolo[h] = BINARIO_CON_ID
+    else:
+        h = msg[4] << 8 | msg[5]
+        if msg[3] != EPOCA or h >= len(registro.ids):
+            return msg[1], SIN_HANDLE
+        registro.protocolo[h] = BINARIO
+    registro.secuencia[h] = msg[6] << 8 | msg[7]
+    return msg[1], h
+
+def trama(tipo, h, movimiento=0):
+    t = _trama
+    s = registro.secuencia[h]
+    t[0] = MAGICO
+    t[1] = tipo
+    t[2] = movimiento
+    t[3] = EPOCA
+    t[4] = h >> 8
+    t[5] = h & 0xFF
+    t[6] = s >> 8
+    t[7] = s & 0xFF
+    if registro.protocolo[h] == BINARIO_CON_ID:
+        return t + registro.ids[h].encode()
+    return t
+
+def responder(h, orden):
+    # Contesta a cada robot en su topic y en el formato con el que pidió paso.
+    if registro.protocolo[h] != TEXTO:
+        msg = bytes(trama(ORDENES_BIN[orden], h))
+        compartido = TOPICO_RESPUESTA_BIN
+    else:
+        msg = registro.respuesta(h, orden)
+        compartido = TOPICO_RESPUESTA
+    encolar(registro.topico(h), msg)
+    if MODO_COMPATIBLE:
+        encolar(compartido, msg)
+
+def solicitud_repetida(h, numero):
+    # El robot numera cada solicitud y repite el número al reenviarla (por
+    # tiempo, al reconectar o tras el sync); QoS 1 también puede entregarla
+    # dos veces. Una repetida no pasa por la cola ni cambia el estado: al
+    # activo se le vuelve a mandar el pasar, por si lo perdió, y al que espera
+    # nada, porque el esperar no cambia lo que hace. Sin número (robots
+    # anteriores) todas cuentan como nuevas.
+    if numero is None or numero != registro.solicitud[h]:
+        registro.solicitud[h] = numero
+        return False
+    print("Solicitud repetida de", registro.ids[h] + ", ya atendida.")
+    if registro.ubicacion[h] == ACTIVO:
+        responder(h, "pasar")
+    return True
+
+def atender_solicitud(h):
+    r = registro.ids[h]
+    if registro.ubicacion[h] == ACTIVO:
+        print("Solicitud repetida de robot activo, ignorando.")
+        return
+    print("Solicitud de paso recibida de:", r)
+    if not cruce_ocupado:
+        fijar_activo(r)
+        print("Cruce libre. Autorizando paso a:", r)
+        responder(h, "pasar")
+        publicar_estado()
+        encolar(TOPICO_SOLICITUD, b"", True)
+    else:
+        print("Cruce ocupado por:", active_robot)
+        if registro.ubicacion[h] is None:
+            cola_espera.push(h)
+            publicar_estado()
+            print("Añadiendo a cola de espera:", r)
+        print("Robots en cola de espera:", len(cola_espera))
+        responder(h, "esperar")
+
+def ceder_turno():
+    fijar_activo(None)
+    publicar_estado()
+    h = cola_espera.pop()
+    if h is not None:
+        siguiente = registro.ids[h]
+        fijar_activo(siguiente)
+        print("Autorizando paso a robot con prioridad:", siguiente)
+        responder(h, "pasar")
+        publicar_estado()
+    print("Robots en cola de espera:", len(cola_espera))
+
+def avisar_siguiente():
+    # El activo avisa con llego de que está a punto de dejar el cruce: el
+    # primero de la cola se prepara para arrancar en cuanto le llegue el pasar.
+    h = cola_espera.peek()
+    if h is not None:
+        responder(h, "prepararse")
+
+def procesar_trama(msg):
+    tipo, h = leer_trama(msg)
+    if h == SIN_HANDLE:
+        print("Trama de un robot desconocido, ignorando.")
+        return
+    if tipo == T_SOLICITUD:
+        if not solicitud_repetida(h, registro.secuencia[h]):
+            atender_solicitud(h)
+    elif tipo == T_LIBERADO and registro.ubicacion[h] == ACTIVO:
+        print("Cruce liberado por:", registro.ids[h])
+        ceder_turno()
+    elif tipo == T_LLEGO and registro.ubicacion[h] == ACTIVO:
+        avisar_siguiente()
+
+def recordar(cache, msg, valor):
+    # Un robot manda siempre los mismos mensajes de texto ("robot3:solicitud",
+    # y la solicitud repetida con el mismo número), así que basta con
+    # trocearlos la primera vez. Si la caché se llena de
+    # mensajes que no se repiten, se vacía.
+    if len(cache) > 8 * len(registro.ids) + 64:
+        cache.clear()
+    cache[msg] = valor
+    return valor
+
+def procesar_mensaje(topic, msg):
+    if msg and msg[0] == MAGICO and topic in (TOPICO_SOLICITUD, TOPICO_REPORTES):
+        procesar_trama(msg)
+    elif topic == TOPICO_SOLICITUD:
+        # "robot3:solicitud#<número>"; sin "#" es una solicitud sin numerar.
+        leido = solicitudes_leidas.get(msg)
+        if leido is None:
+            if not msg or len(msg.strip()) == 0:
+                return
+            numero = msg.decode().partition("#")[2].strip()
+            leido = recordar(solicitudes_leidas, msg, (registro.handle(extraer_robot_id(msg)),
+                                                       int(numero) if numero.isdigit() else None))
+        h, numero = leido
+        registro.protocolo[h] = TEXTO
+        if not solicitud_repetida(h, numero):
+            atender_solicitud(h)
+    elif topic in (TOPICO_ESTADO_ACT, TOPICO_ESTADO_COLA):
+        # Retenidos que llegan tarde y el eco de las propias publicaciones.
+        restaurar_estado(topic, msg)
+    elif topic == TOPICO_REPORTES:
+        leido = reportes_leidos.get(msg)
+        if leido is None:
+            partes = msg.decode().split(":", 1)
+            if len(partes) != 2:
+                print("Reporte con formato inválido:", msg)
+                return
+            leido = recordar(reportes_leidos, msg, partes)
+        origen, evento = leido
+        if evento == "cruce_liberado" and origen == active_robot:
+            print("Cruce liberado por:", origen)
+            ceder_turno()
+        elif evento == "llego" and origen == active_robot:
+            avisar_siguiente()
+
+def revisar_timeout():
+    h = plazos.vencido()
+    if h is not None:
+        if registro.ubicacion[h] == ACTIVO:
+            print("Timeout:", active_robot, "ha tardado demasiado. Liberando el cruce.")
+            encolar(TOPICO_REPORTES, registro.respuesta(h, "timeout"))
+            responder(h, "expulsado")
+            # Si vuelve con la misma solicitud, es nueva.
+            registro.solicitud[h] = None
+            ceder_turno()
+            
+def conectar_broker():
+    global client
+    while True:
+        try:
+            client = MQTTClient(client_id=CLIENT_ID, server=BROKER_IP, keepalive=60)
+            client.set_last_will(topic=TOPICO_REPORTES, msg=CLIENT_ID + b":offline", retain=True, qos=1)
+            client.connect(clean_session=False)
+            print("Conectado al broker MQTT")
+            break
+        except OSError as e:
+            print("Broker no disponible. Reintentando en 5s...", e)
+            time.sleep(5)
+
+def esperar_retenidos():
+    # Los retenidos de estado llegan tras la suscripción: se esperan hasta
+    # ESPERA_RETENIDOS_MS para que el aviso de sync ya lleve a los robots
+    # recuperados. En el primer arranque no hay retenidos y se agota el plazo.
+    inicio = ticks_ms()
+    sondeo = select.poll()
+    sondeo.register(client.sock, select.POLLIN)
+    while TOPICO_ESTADO_ACT not in versiones_estado or TOPICO_ESTADO_COLA not in versiones_estado:
+        restante = ESPERA_RETENIDOS_MS - ticks_diff(ticks_ms(), inicio)
+        if restante <= 0 or not sondeo.poll(restante):
+            return
+        client.check_msg()
+
+def aviso_sync():
+    recuperados = [registro.ids[h] for h in range(len(registro.ids)) if registro.ubicacion[h] is not None]
+    flota = max(FLOTA_SYNC, len(registro.ids))
+    ventana = min(VENTANA_MAXIMA_SYNC_MS, MS_POR_ROBOT_SYNC * flota)
+    msg = b"reanunciar:" + str(ventana).encode()
+    if SYNC_CON_LISTA and recuperados:
+        msg += b":" + ",".join(recuperados).encode()
+    return msg
+
+def inicializar_mqtt():
+    client.set_callback(restaurar_estado)
+    client.subscribe(TOPICO_ESTADO_ACT, qos=1)
+    client.subscribe(TOPICO_ESTADO_COLA, qos=1)
+    esperar_retenidos()
+    client.set_callback(procesar_mensaje)
+    client.subscribe(TOPICO_SOLICITUD, qos=1)
+    client.subscribe(TOPICO_REPORTES, qos=1)
+    client.publish(TOPICO_REPORTES, CLIENT_ID + b":online", qos=1, retain=True)
+    client.publish(TOPICO_SYNC, aviso_sync(), qos=1)
+    # Lo atendido mientras se suscribía se publica ya, sin esperar al bucle.
+    publicar_estado()
+    volcar_estado()
+    print("Estado inicial publicado.")
+    if cruce_ocupado and active_robot:
+        plazos.programar(registro.handle(active_robot), TIEMPO_MAX_CRUCE_MS)
+        print("Reconexión: reinicio contador de cruce para", active_robot)
+
+def drenar_mensajes():
+    # Atiende todo lo pendiente en el socket MQTT, hasta PRESUPUESTO_MENSAJES
+    # por pasada. Devuelve True si se agotó el presupuesto y puede quedar más.
+    global _sock_sondeado, _sondeo
+    if client.sock is not _sock_sondeado:
+        _sock_sondeado = client.sock
+        _sondeo = select.poll()
+        _sondeo.register(_sock_sondeado, select.POLLIN)
+    for _ in range(PRESUPUESTO_MENSAJES):
+        if not _sondeo.poll(0):
+            return False
+        client.check_msg()
+        enviar_salida()
+    return True
+
+if sys.implementation.name == "micropython":
+    async def esperar_lectura(sock):
+        yield asyncio.core._io_queue.queue_read(sock)
+else:
+    async def esperar_lectura(sock):
+        loop = asyncio.get_running_loop()
+        listo = loop.create_future()
+        loop.add_reader(sock, lambda: listo.done() or listo.set_result(None))
+        try:
+            await listo
+        finally:
+            loop.remove_reader(sock)
+
+async def reconectar(e):
+    global reconectando
+    if reconectando:
+        return
+    reconectando = True
+    try:
+        print("MQTT desconectado. Reintentando en 5s...", e)
+        await asyncio.sleep(5)
+        conectar_broker()
+        inicializar_mqtt()
+        aviso_plazos.set()
+    finally:
+        reconectando = False
+
+async def tarea_mensajes():
+    # Despierta en cuanto el socket tiene datos: un cruce_liberado se convierte
+    # en el siguiente pasar sin esperar a ninguna pausa. El plazo de espera
+    # solo sirve para volver a mirar client.sock tras una reconexión.
+    while True:
+        try:
+            try:
+                await asyncio.wait_for(esperar_lectura(client.sock), ESPERA_SOCKET_S)
+            except asyncio.TimeoutError:
+                volcar_estado()
+                continue
+            while drenar_mensajes():
+                volcar_estado()
+                await asyncio.sleep(0)
+            volcar_estado()
+            aviso_plazos.set()
+        except OSError as e:
+            await reconectar(e)
+        except Exception as e:
+            print("Error en tarea de mensajes:", e)
+
+async def tarea_plazos():
+    # Duerme hasta el próximo vencimiento, o hasta que los mensajes cambien los plazos.
+    while True:
+        aviso_plazos.clear()
+        restante = plazos.restante_ms()
+        if restante is None:
+            await aviso_plazos.wait()
+        elif restante > 0:
+            try:
+                await asyncio.wait_for(aviso_plazos.wait(), restante / 1000)
+            except asyncio.TimeoutError:
+                pass
+        try:
+            revisar_timeout()
+            volcar_estado()
+        except OSError as e:
+            await reconectar(e)
+        except Exception as e:
+            print("Error en tarea de plazos:", e)
+
+async def tarea_watchdog():
+    while True:
+        wdt.feed()
+        await asyncio.sleep(PERIODO_WATCHDOG_S)
+
+async def tarea_conexion():
+    # Comprueba la WiFi y mantiene viva la sesión MQTT con un PINGREQ periódico.
+    desde_ping = 0
+    while True:
+        await asyncio.sleep(PERIODO_CONEXION_S)
+        desde_ping += PERIODO_CONEXION_S
+        try:
+            verificar_wifi()
+            if desde_ping >= PERIODO_PING_S:
+                client.ping()
+                desde_ping = 0
+        except OSError as e:
+            await reconectar(e)
+
+async def principal():
+    configurar_topicos()
+    conectar_wifi()
+    conectar_broker()
+    inicializar_mqtt()
+    asyncio.create_task(tarea_plazos())
+    asyncio.create_task(tarea_watchdog())
+    asyncio.create_task(tarea_conexion())
+    await tarea_mensajes()
+
+def main():
+    asyncio.run(principal())
+
+if __name__ == "__main__":
+    main()
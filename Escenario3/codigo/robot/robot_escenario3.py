@@ -1,198 +1,425 @@
-from machine import Pin, PWM
-import time, machine
-from umqtt.robust import MQTTClient
-import network
-
-WIFI_SSID   = "XXXXX"
-WIFI_PASS   = "XXXXX"
-BROKER_IP   = "XXXXX"
-CLIENT_ID   = "robotX"
-
-TOPICO_SOLICITUD  = b"cruce/solicitud"
-TOPICO_RESPUESTA  = b"cruce/respuesta"
-TOPICO_REPORTES   = b"cruce/reportes"
-TOPICO_SYNC       = b"robots/solicitar_estado"
-
-PIN_SERVO_IZQ = 13
-PIN_SERVO_DER = 14
-led = Pin(2, Pin.OUT)
-servo_izq = PWM(Pin(PIN_SERVO_IZQ), freq=50)
-servo_der = PWM(Pin(PIN_SERVO_DER), freq=50)
-en_cruce = False
-autorizado = False
-esperando_autorizacion = False
-preparado_para_preguntar = False
-client = None
-
-def mover(d_izq, d_der):
-    servo_izq.duty_u16(d_izq)
-    servo_der.duty_u16(d_der)
-
-def avanzar():
-    print("[ROBOT] Avanzando...")
-    mover(5060, 4390)
-
-def detener():
-    print("[ROBOT] Detenido.")
-    mover(4800, 4700)
-
-def led_parpadeo(intervalo, veces=None):
-    count = 0
-    while veces is None or count < veces:
-        led.on(); time.sleep(intervalo)
-        led.off(); time.sleep(intervalo)
-        count += 1
-
-def led_encendido():
-    led.on()
-    
-def led_apagado():
-    led.off()
-
-def conectar_wifi():
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    wlan.connect(WIFI_SSID, WIFI_PASS)
-    while not wlan.isconnected():
-        led_parpadeo(0.2, 1)
-        time.sleep(1)
-    print("WiFi conectado:", wlan.ifconfig())
-    led_encendido()
-
-def verificar_wifi():
-    wlan = network.WLAN(network.STA_IF)
-    if not wlan.isconnected():
-        print("WiFi desconectado. Reconectando...")
-        wlan.active(True)
-        wlan.connect(WIFI_SSID, WIFI_PASS)
-        while not wlan.isconnected():
-            time.sleep(1)
-        print("WiFi reconectado:", wlan.ifconfig())
-        led_encendido()
-
-def procesar_mensaje(topic, msg):
-    global autorizado, esperando_autorizacion
-    if topic == TOPICO_RESPUESTA:
-        try:
-            who, orden = msg.split(b":", 1)
-        except ValueError:
-            return
-        if who.decode() != CLIENT_ID:
-            return
-        orden = orden.decode()
-        if orden == "pasar":
-            print("Permiso recibido.")
-            autorizado = True
-            esperando_autorizacion = False
-        elif orden == "expulsado":
-            print("Expulsado por timeout.")
-            autorizado = False
-            esperando_autorizacion = False
-            client.disconnect()
-            machine.deepsleep()
-    elif topic == TOPICO_SYNC:
-        if esperando_autorizacion and preparado_para_preguntar:
-            print("Controlador solicita estado -> reenviando solicitud")
-            solicitar_cruce()
-
-def suscribir_temas():
-    client.subscribe(TOPICO_RESPUESTA, qos=1)
-    client.subscribe(TOPICO_SYNC, qos=1)
-
-def conectar_mqtt():
-    global client
-    verificar_wifi()
-    client = MQTTClient(client_id=CLIENT_ID, server=BROKER_IP, keepalive=60)
-    client.set_last_will(topic=TOPICO_REPORTES, msg=(CLIENT_ID + ":offline").encode(), retain=True, qos=1)
-    client.set_callback(procesar_mensaje)
-    client.connect(clean_session=False)
-    suscribir_temas()
-    print("MQTT conectado y suscrito.")
-
-def reconectar_mqtt():
-    while True:
-        try:
-            print("Reconectando MQTT...")
-            client.set_callback(procesar_mensaje)
-            client.connect(clean_session=False)
-            suscribir_temas()
-            if esperando_autorizacion and not autorizado:
-                solicitar_cruce()
-            client.publish(TOPICO_REPORTES, (CLIENT_ID + ":online").encode(), qos=1, retain=True)
-            print("MQTT reconectado.")
-            return
-        except Exception as e:
-            print("Fallo reconexión:", e)
-            time.sleep(2)
-
-def solicitar_cruce():
-    global esperando_autorizacion, autorizado
-    verificar_wifi()
-    autorizado = False
-    esperando_autorizacion = True
-    try:
-        client.publish(TOPICO_SOLICITUD, CLIENT_ID.encode() + b":solicitud", qos=1)
-        print("Solicitud enviada.")
-    except Exception:
-        reconectar_mqtt()
-        client.publish(TOPICO_SOLICITUD, CLIENT_ID.encode() + b":solicitud", qos=1)
-
-def esperar_autorizacion(resend_interval_s=60):
-    global autorizado
-    print("Esperando autorización...")
-    t0 = time.time()
-    ultimo_envio = t0
-    while not autorizado:
-        try:
-            client.check_msg()
-        except Exception:
-            reconectar_mqtt()
-        ahora = time.time()
-        if ahora - ultimo_envio >= resend_interval_s:
-            print("No hay autorización tras 1 minuto, reenviando solicitud...")
-            solicitar_cruce()
-            ultimo_envio = ahora
-        time.sleep(0.1)
-    return True
-
-def reportar_llegada():
-    verificar_wifi()
-    try:
-        client.publish(TOPICO_REPORTES, CLIENT_ID.encode() + b":llego", qos=1)
-        print("He llegado.")
-        client.publish(TOPICO_REPORTES, CLIENT_ID.encode() + b":cruce_liberado", qos=1)
-        print("Cruce liberado.")
-    except Exception:
-        reconectar_mqtt()
-        client.publish(TOPICO_REPORTES, CLIENT_ID.encode() + b":llego", qos=1)
-        client.publish(TOPICO_REPORTES, CLIENT_ID.encode() + b":cruce_liberado", qos=1)
-
-def main():
-    global en_cruce
-    detener()
-    conectar_wifi()
-    conectar_mqtt()
-    avanzar();
-    time.sleep(4);
-    detener()
-    preparado_para_preguntar = True
-    solicitar_cruce()
-    esperar_autorizacion(resend_interval_s=60)
-    en_cruce = True
-    avanzar()
-    time.sleep(4)
-    detener()
-    reportar_llegada()
-    en_cruce = False
-    print("Cruce completado.")
-    avanzar()
-    time.sleep(2)
-    detener()
-    try:
-        client.disconnect()
-        print("Desconectado del broker MQTT.")
-    except Exception as e:
-        print("Error al desconectar:", e)
-
-if __name__ == "__main__":
-    main()
\ No newline at end of file
+from machine import Pin, PWM
+import time, machine
+import select
+import random
+from umqtt.robust import MQTTClient
+import network
+
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+WIFI_SSID   = "XXXXX"
+WIFI_PASS   = "XXXXX"
+BROKER_IP   = "XXXXX"
+CLIENT_ID   = "robotX"
+PROTOCOLO_BINARIO = False
+# El cruce dura TIEMPO_CRUCE_MS; AVISO_LLEGO_MS antes del final el robot
+# manda llego, para que el controlador prepare al siguiente de la cola.
+TIEMPO_CRUCE_MS = 4000
+AVISO_LLEGO_MS  = 1000
+# Con keepalive=60 el broker cierra la sesión tras 90 s sin oír al robot.
+PERIODO_PING_MS = 30000
+# Con un controlador anterior a los topics por robot, las respuestas llegan
+# a todos por los topics compartidos.
+RESPUESTAS_COMPARTIDAS = False
+
+# Con CRUCE_ID los topics llevan el identificador del cruce (cruce/<id>/...
+# y robots/<id>/solicitar_estado), así varios cruces comparten broker. Vacío,
+# son los de un cruce solo.
+CRUCE_ID = ""
+
+def configurar_topicos():
+    global TOPICO_SOLICITUD, TOPICO_RESPUESTA, TOPICO_RESPUESTA_BIN
+    global TOPICO_REPORTES, TOPICO_SYNC
+    cruce = b"cruce/" + CRUCE_ID.encode() + b"/" if CRUCE_ID else b"cruce/"
+    robots = b"robots/" + CRUCE_ID.encode() + b"/" if CRUCE_ID else b"robots/"
+    TOPICO_SOLICITUD  = cruce + b"solicitud"
+    TOPICO_RESPUESTA  = cruce + b"respuesta"
+    TOPICO_RESPUESTA_BIN = cruce + b"respuesta/bin"
+    TOPICO_REPORTES   = cruce + b"reportes"
+    TOPICO_SYNC       = robots + b"solicitar_estado"
+
+configurar_topicos()
+
+# Trama binaria: MAGICO, tipo, movimiento, época del controlador, handle y
+# secuencia. Mientras no conoce su handle, el robot añade su id detrás. La
+# secuencia es el número de la solicitud en curso, el mismo en sus reenvíos.
+MAGICO      = 0xFF
+T_SOLICITUD = 1
+T_LLEGO     = 4
+T_LIBERADO  = 5
+SIN_HANDLE  = 0xFFFF
+ORDENES_BIN = {2: "pasar", 3: "esperar", 6: "expulsado", 8: "prepararse"}
+
+# Movimiento como datos: cada tramo es (duty izquierdo, duty derecho, ms,
+# aviso al terminarlo o None). ejecutar() los recorre sin dejar de atender
+# MQTT, así que el robot oye al controlador mientras se mueve.
+AVANCE = (5060, 4390)
+PARADA = (4800, 4700)
+PLAN_APROXIMACION = (AVANCE + (4000, None), PARADA + (0, None))
+PLAN_CRUCE = (AVANCE + (TIEMPO_CRUCE_MS - AVISO_LLEGO_MS, "llego"),
+              AVANCE + (AVISO_LLEGO_MS, None), PARADA + (0, None))
+PLAN_SALIDA = (AVANCE + (2000, None), PARADA + (0, None))
+
+PIN_SERVO_IZQ = 13
+PIN_SERVO_DER = 14
+led = Pin(2, Pin.OUT)
+servo_izq = PWM(Pin(PIN_SERVO_IZQ), freq=50)
+servo_der = PWM(Pin(PIN_SERVO_DER), freq=50)
+en_cruce = False
+autorizado = False
+esperando_autorizacion = False
+preparado_para_preguntar = False
+armado = False
+client = None
+mi_id = b""
+mi_topico = b""
+mensajes_texto = {}
+mi_handle = SIN_HANDLE
+mi_epoca = 0
+secuencia = random.getrandbits(16)
+_trama = bytearray(8)
+_sock = None
+_sondeo = None
+ultimo_ping = 0
+resolicitud = None
+
+def mover(d_izq, d_der):
+    servo_izq.duty_u16(d_izq)
+    servo_der.duty_u16(d_der)
+
+def avanzar():
+    print("[ROBOT] Avanzando...")
+    mover(*AVANCE)
+
+def detener():
+    print("[ROBOT] Detenido.")
+    mover(*PARADA)
+
+def led_parpadeo(intervalo, veces=None):
+    count = 0
+    while veces is None or count < veces:
+        led.on(); time.sleep(intervalo)
+        led.off(); time.sleep(intervalo)
+        count += 1
+
+def led_encendido():
+    led.on()
+    
+def led_apagado():
+    led.off()
+
+def conectar_wifi():
+    wlan = network.WLAN(network.STA_IF)
+    wlan.active(True)
+    wlan.connect(WIFI_SSID, WIFI_PASS)
+    while not wlan.isconnected():
+        led_parpadeo(0.2, 1)
+        time.sleep(1)
+    print("WiFi conectado:", wlan.ifconfig())
+    led_encendido()
+
+def verificar_wifi():
+    wlan = network.WLAN(network.STA_IF)
+    if not wlan.isconnected():
+        print("WiFi desconectado. Reconectando...")
+        wlan.active(True)
+        wlan.connect(WIFI_SSID, WIFI_PASS)
+        while not wlan.isconnected():
+            time.sleep(1)
+        print("WiFi reconectado:", wlan.ifconfig())
+        led_encendido()
+
+def trama(tipo):
+    t = _trama
+    t[0] = MAGICO
+    t[1] = tipo
+    t[2] = 0
+    t[3] = mi_epoca
+    t[4] = mi_handle >> 8
+    t[5] = mi_handle & 0xFF
+    t[6] = secuencia >> 8
+    t[7] = secuencia & 0xFF
+    if mi_handle == SIN_HANDLE:
+        return t + mi_id
+    return t
+
+def es_mi_id(msg):
+    # Compara el id que sigue a la cabecera byte a byte, sin copiarlo.
+    n = len(mi_id)
+    if len(msg) != 8 + n:
+        return False
+    for i in range(n):
+        if msg[8 + i] != mi_id[i]:
+            return False
+    return True
+
+def leer_trama(msg):
+    # Devuelve la orden si la trama va dirigida a este robot; una trama con id
+    # le da a conocer su handle y la época del controlador. Indexa el mensaje
+    # sin copiarlo, así que vale igual para bytes o memoryview.
+    global mi_handle, mi_epoca
+    if len(msg) < 8 or msg[0] != MAGICO:
+        return None
+    h = msg[4] << 8 | msg[5]
+    if len(msg) > 8:
+        if not es_mi_id(msg):
+            return None
+        mi_handle = h
+        mi_epoca = msg[3]
+    elif h != mi_handle or msg[3] != mi_epoca:
+        return None
+    return ORDENES_BIN.get(msg[1])
+
+def codificar_mensajes():
+    # Los mensajes de texto de este robot no cambian: se codifican una vez y
+    # las respuestas se comparan como bytes, sin decodificarlas.
+    global mi_id, mi_topico
+    mi_id = CLIENT_ID.encode()
+    mi_topico = TOPICO_RESPUESTA + b"/" + mi_id
+    mensajes_texto["solicitud"] = mi_id + b":" + "solicitud".encode()
+    for m in ("llego", "cruce_liberado", "pasar", "expulsado", "prepararse"):
+        mensajes_texto[m] = mi_id + b":" + m.encode()
+
+def nueva_solicitud():
+    # Cada cruce pide paso con un número nuevo; los reenvíos, reconexiones y
+    # resincronizaciones lo repiten para que el controlador los reconozca. Se
+    # empieza al azar para no repetir números tras un reinicio.
+    global secuencia
+    secuencia = (secuencia + 1) & 0xFFFF
+    mensajes_texto["numerada"] = mensajes_texto["solicitud"] + b"#" + str(secuencia).encode()
+
+def olvidar_handle():
+    global mi_handle
+    mi_handle = SIN_HANDLE
+
+def mensaje_solicitud():
+    if PROTOCOLO_BINARIO:
+        return trama(T_SOLICITUD)
+    return mensajes_texto["numerada"]
+
+def mensaje_reporte(evento):
+    if PROTOCOLO_BINARIO:
+        return trama(T_LLEGO if evento == "llego" else T_LIBERADO)
+    return mensajes_texto[evento]
+
+def figura(lista, robot_id):
+    # Busca robot_id entre los de una lista separada por comas, sin trocearla.
+    n = len(robot_id)
+    i = lista.find(robot_id)
+    while i >= 0:
+        if (i == 0 or lista[i - 1] == 44) and (i + n == len(lista) or lista[i + n] == 44):
+            return True
+        i = lista.find(robot_id, i + 1)
+    return False
+
+def programar_resolicitud(msg):
+    # Aviso de sync: "reanunciar[:<ventana ms>[:<robots recuperados>]]". Si el
+    # controlador no recuperó a este robot, repite la solicitud tras un
+    # retardo al azar dentro de la ventana; atender_red() la manda.
+    global resolicitud
+    partes = msg.split(b":", 2)
+    if len(partes) > 2 and figura(partes[2], mi_id):
+        print("Controlador solicita estado -> ya recuperado")
+        return
+    ventana = int(partes[1]) if len(partes) > 1 and partes[1].isdigit() else 0
+    resolicitud = (ticks_ms(), random.getrandbits(16) % (ventana + 1))
+    print("Controlador solicita estado -> reenviando solicitud en", resolicitud[1], "ms")
+
+def procesar_mensaje(topic, msg):
+    global autorizado, esperando_autorizacion, armado
+    if topic == mi_topico or topic == TOPICO_RESPUESTA or topic == TOPICO_RESPUESTA_BIN:
+        # Ningún mensaje de texto empieza por MAGICO.
+        if msg and msg[0] == MAGICO:
+            orden = leer_trama(msg)
+        elif msg == mensajes_texto["pasar"]:
+            orden = "pasar"
+        elif msg == mensajes_texto["expulsado"]:
+            orden = "expulsado"
+        elif msg == mensajes_texto["prepararse"]:
+            orden = "prepararse"
+        else:
+            return
+    elif topic == TOPICO_SYNC:
+        # El controlador ha vuelto a arrancar: los handles ya no valen.
+        olvidar_handle()
+        if esperando_autorizacion and preparado_para_preguntar:
+            programar_resolicitud(msg)
+        return
+    else:
+        return
+    if orden == "pasar":
+        print("Permiso recibido.")
+        autorizado = True
+        esperando_autorizacion = False
+        if armado:
+            # Arranca desde el propio callback, sin volver al bucle de espera.
+            avanzar()
+    elif orden == "expulsado":
+        print("Expulsado por timeout.")
+        autorizado = False
+        esperando_autorizacion = False
+        client.disconnect()
+        machine.deepsleep()
+    elif orden == "prepararse" and esperando_autorizacion:
+        print("Preparado: el cruce se libera en breve.")
+        armado = True
+
+def suscribir_temas():
+    if RESPUESTAS_COMPARTIDAS:
+        client.subscribe(TOPICO_RESPUESTA, qos=1)
+        if PROTOCOLO_BINARIO:
+            client.subscribe(TOPICO_RESPUESTA_BIN, qos=1)
+    else:
+        client.subscribe(mi_topico, qos=1)
+    client.subscribe(TOPICO_SYNC, qos=1)
+
+def conectar_mqtt():
+    global client
+    verificar_wifi()
+    codificar_mensajes()
+    client = MQTTClient(client_id=CLIENT_ID, server=BROKER_IP, keepalive=60)
+    client.set_last_will(topic=TOPICO_REPORTES, msg=(CLIENT_ID + ":offline").encode(), retain=True, qos=1)
+    client.set_callback(procesar_mensaje)
+    client.connect(clean_session=False)
+    suscribir_temas()
+    print("MQTT conectado y suscrito.")
+
+def reconectar_mqtt():
+    while True:
+        try:
+            print("Reconectando MQTT...")
+            client.set_callback(procesar_mensaje)
+            client.connect(clean_session=False)
+            suscribir_temas()
+            if esperando_autorizacion and not autorizado:
+                solicitar_cruce()
+            client.publish(TOPICO_REPORTES, (CLIENT_ID + ":online").encode(), qos=1, retain=True)
+            print("MQTT reconectado.")
+            return
+        except Exception as e:
+            print("Fallo reconexión:", e)
+            time.sleep(2)
+
+def solicitar_cruce():
+    global esperando_autorizacion, autorizado
+    verificar_wifi()
+    autorizado = False
+    esperando_autorizacion = True
+    try:
+        client.publish(TOPICO_SOLICITUD, mensaje_solicitud(), qos=1)
+        print("Solicitud enviada.")
+    except Exception:
+        reconectar_mqtt()
+        client.publish(TOPICO_SOLICITUD, mensaje_solicitud(), qos=1)
+
+def atender_red(espera_ms):
+    # Espera hasta espera_ms en el socket MQTT y atiende lo que llegue; manda
+    # el ping cuando toca para que el broker no dé la sesión por perdida.
+    global _sock, _sondeo, ultimo_ping, resolicitud
+    if resolicitud is not None:
+        falta = resolicitud[1] - ticks_diff(ticks_ms(), resolicitud[0])
+        if falta <= 0:
+            resolicitud = None
+            if esperando_autorizacion:
+                solicitar_cruce()
+        else:
+            espera_ms = min(espera_ms, falta)
+    try:
+        if ticks_diff(ticks_ms(), ultimo_ping) >= PERIODO_PING_MS:
+            client.ping()
+            ultimo_ping = ticks_ms()
+        if client.sock is not _sock:
+            _sock = client.sock
+            _sondeo = select.poll()
+            _sondeo.register(_sock, select.POLLIN)
+        if _sondeo.poll(min(espera_ms, PERIODO_PING_MS)):
+            client.check_msg()
+    except Exception:
+        reconectar_mqtt()
+
+def ejecutar(plan):
+    # Recorre los tramos del plan. Entre un cambio de tramo y el siguiente
+    # espera en el socket en lugar de dormir; los plazos se cuentan desde el
+    # inicio del plan para que los retrasos no se acumulen.
+    inicio = ticks_ms()
+    fin = 0
+    for d_izq, d_der, ms, aviso in plan:
+        mover(d_izq, d_der)
+        fin += ms
+        restante = fin - ticks_diff(ticks_ms(), inicio)
+        while restante > 0:
+            atender_red(restante)
+            restante = fin - ticks_diff(ticks_ms(), inicio)
+        if aviso is not None:
+            avisar(aviso)
+
+def esperar_autorizacion(resend_interval_s=60):
+    # Bloquea en el socket MQTT hasta el próximo reenvío: un pasar o un
+    # expulsado despiertan la espera en cuanto llegan.
+    global autorizado
+    print("Esperando autorización...")
+    ultimo_envio = ticks_ms()
+    while not autorizado:
+        restante = resend_interval_s * 1000 - ticks_diff(ticks_ms(), ultimo_envio)
+        if restante <= 0:
+            print("No hay autorización tras 1 minuto, reenviando solicitud...")
+            olvidar_handle()
+            solicitar_cruce()
+            ultimo_envio = ticks_ms()
+            continue
+        atender_red(restante)
+    return True
+
+def avisar(evento):
+    # Avisos durante el cruce (llego). Si se pierde, el cruce_liberado del
+    # final lo cubre.
+    try:
+        client.publish(TOPICO_REPORTES, mensaje_reporte(evento), qos=1)
+        print("Aviso enviado:", evento)
+    except Exception:
+        reconectar_mqtt()
+
+def reportar_liberado():
+    verificar_wifi()
+    try:
+        client.publish(TOPICO_REPORTES, mensaje_reporte("cruce_liberado"), qos=1)
+        print("Cruce liberado.")
+    except Exception:
+        reconectar_mqtt()
+        client.publish(TOPICO_REPORTES, mensaje_reporte("cruce_liberado"), qos=1)
+
+def main():
+    global en_cruce, armado, preparado_para_preguntar
+    configurar_topicos()
+    detener()
+    conectar_wifi()
+    conectar_mqtt()
+    ejecutar(PLAN_APROXIMACION)
+    preparado_para_preguntar = True
+    nueva_solicitud()
+    solicitar_cruce()
+    esperar_autorizacion(resend_interval_s=60)
+    en_cruce = True
+    # Un robot armado ya arrancó al recibir el pasar; el primer tramo lo
+    # mantiene en marcha.
+    armado = False
+    ejecutar(PLAN_CRUCE)
+    reportar_liberado()
+    en_cruce = False
+    print("Cruce completado.")
+    ejecutar(PLAN_SALIDA)
+    try:
+        client.disconnect()
+        print("Desconectado del broker MQTT.")
+    except Exception as e:
+        print("Error al desconectar:", e)
+
+if __name__ == "__main__":
+    main()
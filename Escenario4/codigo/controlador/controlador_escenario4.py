@@ -1,265 +1,1128 @@
-import network
-import time
-import machine
-from umqtt.robust import MQTTClient
-
-WIFI_SSID = "XXXXXX"
-WIFI_PASS = "XXXXXX"
-BROKER_IP = "XXXXXX"
-CLIENT_ID = b"controlador_escenario4"
-
-TOPICO_SOLICITUD = b"cruce/solicitud"
-TOPICO_RESPUESTA = b"cruce/respuesta"
-TOPICO_REPORTES  = b"cruce/reportes"
-TOPICO_ESTADO_ACT = b"cruce/estado/active_robot"
-TOPICO_ESTADO_COLA = b"cruce/estado/cola"
-TOPICO_SYNC = b"robots/solicitar_estado"
-
-recursos = {"I1": False, "I2": False}
-colas_verticales = {"vertical_A": [], "vertical_B": []}
-cola_horizontal = []
-tipo_por_robot = {}
-tiempo_inicio = {}
-prioridades = {"robot1": 1, "robot2": 2, "robot3": 3, "robot4": 4}
-TIEMPO_MAX_CRUCE = 10
-wdt = machine.WDT(timeout=150000)
-
-client = None
-
-def conectar_wifi():
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    if not wlan.isconnected():
-        wlan.connect(WIFI_SSID, WIFI_PASS)
-        while not wlan.isconnected():
-            time.sleep(0.5)
-    print("WiFi conectado:", wlan.ifconfig())
-
-def verificar_wifi():
-    wlan = network.WLAN(network.STA_IF)
-    if not wlan.isconnected():
-        print("WiFi desconectado. Reconectando...")
-        conectar_wifi()
-
-def publicar_estado():
-    if tipo_por_robot:
-        activos = ",".join(tipo_por_robot.keys())
-        client.publish(TOPICO_ESTADO_ACT, activos.encode(), qos=1, retain=True)
-    else:
-        client.publish(TOPICO_ESTADO_ACT, b"", qos=1, retain=True)
-    partes = [
-        f"vertical_A|{','.join(colas_verticales['vertical_A'])}",
-        f"vertical_B|{','.join(colas_verticales['vertical_B'])}",
-        f"horizontal|{','.join(cola_horizontal)}"
-    ]
-    payload = ";".join(partes).encode()
-    client.publish(TOPICO_ESTADO_COLA, payload, qos=1, retain=True)
-
-def restaurar_estado(topic, msg):
-    texto = msg.decode().strip()
-    if topic == TOPICO_ESTADO_ACT:
-        if texto:
-            robots = texto.split(",")
-            if not any(recursos.values()):
-                print("[CONTROL] Estado retenido pero sin recursos -> ignorado")
-                tipo_por_robot.clear()
-            else:
-                for r in robots:
-                    tipo_por_robot.setdefault(r, [])
-                    tiempo_inicio[r] = time.time()
-                print("Recuperado active_robot(s):", robots)
-        else:
-            tipo_por_robot.clear()
-            print("No hay active_robot retenido.")
-    elif topic == TOPICO_ESTADO_COLA:
-        if texto:
-            partes = texto.split(";")
-            for parte in partes:
-                if "|" not in parte:
-                    continue
-                zona, lst = parte.split("|", 1)
-                robots = lst.split(",") if lst else []
-                if zona in colas_verticales:
-                    colas_verticales[zona] = [r for r in robots if r]
-                elif zona == "horizontal":
-                    cola_horizontal[:] = [r for r in robots if r]
-            print("Recuperadas colas:", colas_verticales, cola_horizontal)
-        else:
-            print("Colas retenidas vacías.")
-
-def otorgar_permiso(robot_id, lista_recursos):
-    for r in lista_recursos:
-        recursos[r] = True
-    tipo_por_robot[robot_id] = lista_recursos
-    tiempo_inicio[robot_id] = time.time()
-    client.publish(TOPICO_RESPUESTA, f"{robot_id}:pasar".encode(), qos=1)
-    publicar_estado()
-    print(f"[CONTROL] Permiso a {robot_id} -> {lista_recursos}")
-
-def liberar_recursos(robot_id):
-    res_list = tipo_por_robot.pop(robot_id, [])
-    if not res_list:
-        print(f"[CONTROL] liberar_recursos: {robot_id} no tenía recursos asignados.")
-    else:
-        print(f"[CONTROL] Liberando recursos {res_list} de {robot_id}")
-        for r in res_list:
-            recursos[r] = False
-    tiempo_inicio.pop(robot_id, None)
-    publicar_estado()
-    reasignar_esperas()
-
-def reasignar_esperas():
-    while True:
-        servido = False
-        proximo_A = None
-        proximo_B = None
-        proximo_H = None
-        if colas_verticales["vertical_A"]:
-            colas_verticales["vertical_A"].sort(key=lambda rid: prioridades.get(rid, 99))
-            proximo_A = colas_verticales["vertical_A"][0]
-        if colas_verticales["vertical_B"]:
-            colas_verticales["vertical_B"].sort(key=lambda rid: prioridades.get(rid, 99))
-            proximo_B = colas_verticales["vertical_B"][0]
-        if cola_horizontal:
-            cola_horizontal.sort(key=lambda rid: prioridades.get(rid, 99))
-            proximo_H = cola_horizontal[0]
-        if (not recursos["I1"]) and (not recursos["I2"]) and proximo_H:
-            pr_H = prioridades.get(proximo_H, 99)
-            pr_A = prioridades.get(proximo_A, 99) if proximo_A else 999
-            pr_B = ninguna_prioridad(proximo_B)
-            if pr_H < pr_A and pr_H < pr_B:
-                cola_horizontal.pop(0)
-                otorgar_permiso(proximo_H, ["I1", "I2"])
-                servido = True
-                continue
-        if (not recursos["I1"]) and proximo_A:
-            colas_verticales["vertical_A"].pop(0)
-            otorgar_permiso(proximo_A, ["I1"])
-            servido = True
-            continue
-        if (not recursos["I2"]) and proximo_B:
-            colas_verticales["vertical_B"].pop(0)
-            otorgar_permiso(proximo_B, ["I2"])
-            servido = True
-            continue
-        if not servido:
-            break
-
-def ninguna_prioridad(candidate):
-    return obtener_prioridad(candidate, default=999)
-
-def obtener_prioridad(rid, default=999):
-    return prioridades.get(rid, default)
-
-def procesar_mensaje(topic, msg):
-    try:
-        if topic == TOPICO_SOLICITUD:
-            text = msg.decode()
-            if ":" not in text:
-                print("[CONTROL] solicitud formato inválido:", text)
-                return
-            robot_id, tipo = text.split(":", 1)
-            robot_id = robot_id.strip()
-            tipo = tipo.strip()
-            print(f"[CONTROL] Solicitud de {robot_id} tipo {tipo}")
-            if tipo == "vertical_A":
-                if not recursos["I1"]:
-                    otorgar_permiso(robot_id, ["I1"])
-                else:
-                    if robot_id not in colas_verticales["vertical_A"]:
-                        colas_verticales["vertical_A"].append(robot_id)
-            elif tipo == "vertical_B":
-                if not recursos["I2"]:
-                    otorgar_permiso(robot_id, ["I2"])
-                else:
-                    if robot_id not in colas_verticales["vertical_B"]:
-                        colas_verticales["vertical_B"].append(robot_id)
-            elif tipo == "horizontal":
-                if (not recursos["I1"]) and (not recursos["I2"]):
-                    otorgar_permiso(robot_id, ["I1", "I2"])
-                else:
-                    if robot_id not in cola_horizontal:
-                        cola_horizontal.append(robot_id)
-        elif topic == TOPICO_REPORTES:
-            origen, evento = msg.decode().split(":", 1)
-            origen = origen.strip()
-            evento = evento.strip()
-            if evento in ("cruce_liberado", "expulsado", "offline"):
-                if origen in tipo_por_robot or origen in sum(list(colas_verticales.values()), []) or origen in cola_horizontal:
-                    print(f"[CONTROL] Reporte {evento} de {origen}")
-                    if origen in tipo_por_robot:
-                        liberar_recursos(origen)
-                    else:
-                        quitar_de_colas(origen)
-                        publicar_estado()
-    except Exception as e:
-        print("[CONTROL] Error en procesar_mensaje:", e)
-
-def quitar_de_colas(robot_id):
-    for k in colas_verticales:
-        if robot_id in colas_verticales[k]:
-            colas_verticales[k] = [r for r in colas_verticales[k] if r != robot_id]
-    if robot_id in cola_horizontal:
-        cola_horizontal[:] = [r for r in cola_horizontal if r != robot_id]
-
-def revisar_timeout():
-    ahora = time.time()
-    for robot_id, inicio in list(tiempo_inicio.items()):
-        if ahora - inicio > TIEMPO_MAX_CRUCE:
-            print("[CONTROL] Timeout:", robot_id)
-            try:
-                client.publish(TOPICO_REPORTES, f"{robot_id}:expulsado".encode(), qos=1)
-            except Exception as e:
-                print("[CONTROL] No se pudo publicar timeout:", e)
-            if robot_id in tipo_por_robot:
-                liberar_recursos(robot_id)
-            else:
-                quitar_de_colas(robot_id)
-                publicar_estado()
-
-def conectar_broker():
-    global client
-    while True:
-        try:
-            client = MQTTClient(client_id=CLIENT_ID, server=BROKER_IP, keepalive=60)
-            client.set_last_will(topic=TOPICO_REPORTES, msg=CLIENT_ID + b":offline", retain=True, qos=1)
-            client.connect(clean_session=False)
-            print("[CONTROL] Conectado al broker MQTT")
-            return
-        except Exception as e:
-            print("[CONTROL] Broker no disponible. Reintentando en 5s...", e)
-            time.sleep(5)
-
-def inicializar_mqtt():
-    client.set_callback(restaurar_estado)
-    client.subscribe(TOPICO_ESTADO_ACT, qos=1)
-    client.subscribe(TOPICO_ESTADO_COLA, qos=1)
-    client.check_msg()
-    client.publish(TOPICO_SYNC, b"reanunciar", qos=1)
-    client.set_callback(procesar_mensaje)
-    client.subscribe(TOPICO_SOLICITUD, qos=1)
-    client.subscribe(TOPICO_REPORTES, qos=1)
-    client.publish(TOPICO_REPORTES, CLIENT_ID + b":online", qos=1, retain=True)
-    publicar_estado()
-    print("[CONTROL] Inicializado MQTT y publicado estado inicial.")
-def main():
-    conectar_wifi()
-    conectar_broker()
-    inicializar_mqtt()
-    while True:
-        try:
-            verificar_wifi()
-            client.check_msg()
-            revisar_timeout()
-        except OSError as e:
-            print("MQTT desconectado. Reintentando en 5s...", e)
-            time.sleep(5)
-            conectar_broker()
-            inicializar_mqtt()
-        except Exception as e:
-            print("Error loop principal:", e)
-        wdt.feed()
-        time.sleep(0.1)
-
-if __name__ == "__main__":
-    main()
\ No newline at end of file
+import network
+import os
+import sys
+import time
+import heapq
+import select
+import machine
+from umqtt.robust import MQTTClient
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+WIFI_SSID = "XXXXXX"
+WIFI_PASS = "XXXXXX"
+BROKER_IP = "XXXXXX"
+CLIENT_ID = b"controlador_escenario4"
+
+# Con CRUCE_ID los topics llevan el identificador del cruce (cruce/<id>/...
+# y robots/<id>/solicitar_estado), así varios cruces comparten broker. Vacío,
+# son los de un cruce solo.
+CRUCE_ID = ""
+
+def configurar_topicos():
+    global TOPICO_SOLICITUD, TOPICO_RESPUESTA, TOPICO_RESPUESTA_BIN, TOPICO_REPORTES
+    global TOPICO_ESTADO_ACT, TOPICO_ESTADO_COLA, TOPICO_SYNC
+    cruce = b"cruce/" + CRUCE_ID.encode() + b"/" if CRUCE_ID else b"cruce/"
+    robots = b"robots/" + CRUCE_ID.encode() + b"/" if CRUCE_ID else b"robots/"
+    TOPICO_SOLICITUD = cruce + b"solicitud"
+    TOPICO_RESPUESTA = cruce + b"respuesta"
+    TOPICO_RESPUESTA_BIN = cruce + b"respuesta/bin"
+    TOPICO_REPORTES  = cruce + b"reportes"
+    TOPICO_ESTADO_ACT = cruce + b"estado/active_robot"
+    TOPICO_ESTADO_COLA = cruce + b"estado/cola"
+    TOPICO_SYNC = robots + b"solicitar_estado"
+
+configurar_topicos()
+
+# Cada robot recibe sus respuestas, de texto o binarias, en TOPICO_RESPUESTA +
+# b"/" + su id. Con MODO_COMPATIBLE se publican también en los topics
+# compartidos, para los robots con el firmware anterior.
+MODO_COMPATIBLE = False
+
+# Orden de las colas de espera. "prioridad" (el original): siempre el mejor
+# según `prioridades`, aunque los demás esperen sin límite. "fifo": por orden de
+# llegada, como el Escenario 1. "envejecimiento": la prioridad mejora con la
+# espera, un nivel cada ENVEJECIMIENTO_MS, y a un robot solo pueden
+# adelantarle los que llegan menos de ADELANTO_MAXIMO_MS después que él.
+POLITICA = "prioridad"
+ENVEJECIMIENTO_MS  = 2000
+ADELANTO_MAXIMO_MS = 10000
+# Pelotones: al quedar libres sus zonas, el movimiento que acaba de cruzar
+# las conserva para el siguiente de su cola, hasta PELOTON_MAXIMO permisos
+# seguidos, antes de dejar paso a un movimiento incompatible (cada cambio de
+# sentido obliga a vaciar el cruce). El pelotón se corta si la cima de una
+# cola incompatible lleva más de ESPERA_MAXIMA_PELOTON_MS esperando. Con 1 no
+# hay pelotones.
+PELOTON_MAXIMO = 1
+ESPERA_MAXIMA_PELOTON_MS = 20000
+# Franjas: un robot que pide paso mientras se acerca, con lo que le falta para
+# llegar y lo que tarda en cruzar ("robot3:vertical_A@<eta_ms>+<duración_ms>"),
+# recibe "robot3:franja:<ms>", los ms que faltan para que entre. La franja se
+# da si sus zonas no las tiene nadie por la vía normal, nadie las espera en
+# las colas y hay hueco en ellas, con MARGEN_FRANJA_MS entre franjas, no más
+# de RETRASO_MAXIMO_FRANJA_MS después de su llegada. Si no, o con RESERVAS a
+# False, la petición se atiende como una solicitud normal.
+RESERVAS = True
+MARGEN_FRANJA_MS = 500
+RETRASO_MAXIMO_FRANJA_MS = 10000
+
+PRESUPUESTO_MENSAJES = 32
+ESPERA_SOCKET_S = 1
+PERIODO_WATCHDOG_S = 5
+PERIODO_CONEXION_S = 1
+PERIODO_PING_S = 30
+
+# Al arrancar o reconectar, el controlador pide a los robots que repitan su
+# solicitud con "reanunciar:<ventana ms>[:<robots recuperados>]" en
+# TOPICO_SYNC. Los que ya recuperó del estado retenido no la repiten; los
+# demás la mandan tras un retardo al azar dentro de la ventana, para que no
+# lleguen todas a la vez. La ventana crece MS_POR_ROBOT_SYNC por robot
+# conocido (al menos FLOTA_SYNC) hasta VENTANA_MAXIMA_SYNC_MS; con 0 repiten
+# en cuanto les llega el aviso y sin SYNC_CON_LISTA la repiten todos.
+FLOTA_SYNC = 100
+MS_POR_ROBOT_SYNC = 5
+VENTANA_MAXIMA_SYNC_MS = 10000
+SYNC_CON_LISTA = True
+ESPERA_RETENIDOS_MS = 500
+
+# Un cruce se describe con sus zonas de conflicto y, para cada movimiento, las
+# zonas que ocupa mientras cruza. El orden de los movimientos es el de las
+# colas en el estado publicado y el de su número en las tramas binarias.
+CRUCE_ESCENARIO3 = (
+    ("cruce",),
+    (("solicitud", ("cruce",)),),
+)
+CRUCE_ESCENARIO4 = (
+    ("I1", "I2"),
+    (("vertical_A", ("I1",)),
+     ("vertical_B", ("I2",)),
+     ("horizontal", ("I1", "I2"))),
+)
+# Cuatro accesos con giros, circulando por la derecha. Las zonas son los
+# cuadrantes del centro del cruce.
+CRUCE_4_ACCESOS = (
+    ("NE", "NO", "SO", "SE"),
+    (("sur_derecha", ("SE",)),
+     ("sur_recto", ("SE", "NE")),
+     ("sur_izquierda", ("SE", "NE", "NO")),
+     ("este_derecha", ("NE",)),
+     ("este_recto", ("NE", "NO")),
+     ("este_izquierda", ("NE", "NO", "SO")),
+     ("norte_derecha", ("NO",)),
+     ("norte_recto", ("NO", "SO")),
+     ("norte_izquierda", ("NO", "SO", "SE")),
+     ("oeste_derecha", ("SO",)),
+     ("oeste_recto", ("SO", "SE")),
+     ("oeste_izquierda", ("SO", "SE", "NE"))),
+)
+CRUCE = CRUCE_ESCENARIO4
+
+# Cada zona es un bit. zonas_ocupadas son las de los movimientos concedidos y
+# zonas_liberadas las que han quedado libres desde la última reasignación.
+# zonas_robot guarda las que aún tiene cada activo: puede devolverlas de una
+# en una al salir de ellas ("robot3:libera:I1") antes del cruce_liberado.
+zonas_ocupadas = 0
+zonas_liberadas = 0
+tipo_por_robot = {}
+zonas_robot = {}
+# Franja de cada robot con reserva: (inicio, fin, máscara). Varios robots con
+# franja pueden tener la misma zona, en momentos distintos.
+franjas = {}
+# Permisos seguidos de cada movimiento desde el último de uno incompatible.
+peloton = []
+prioridades = {"robot1": 1, "robot2": 2, "robot3": 3, "robot4": 4}
+# Prioridad de los robots que no están en `prioridades`, por movimiento; 99 en
+# los demás. Como en el original, la cima de vertical_B sin prioridad vale 999
+# y no impide pasar a un horizontal sin prioridad.
+PRIORIDAD_SIN_ASIGNAR = {"vertical_B": 999}
+TIEMPO_MAX_CRUCE_MS = 10000
+wdt = machine.WDT(timeout=150000)
+
+client = None
+_sock_sondeado = None
+_sondeo = None
+reconectando = False
+aviso_plazos = asyncio.Event()
+estado_pendiente = False
+salida = []
+version_estado = 0
+versiones_estado = {}
+estado_publicado = {}
+cambios_colas_publicados = -1
+solicitudes_leidas = {}
+reportes_leidos = {}
+
+def conectar_wifi():
+    wlan = network.WLAN(network.STA_IF)
+    wlan.active(True)
+    if not wlan.isconnected():
+        wlan.connect(WIFI_SSID, WIFI_PASS)
+        while not wlan.isconnected():
+            time.sleep(0.5)
+    print("WiFi conectado:", wlan.ifconfig())
+
+def verificar_wifi():
+    wlan = network.WLAN(network.STA_IF)
+    if not wlan.isconnected():
+        print("WiFi desconectado. Reconectando...")
+        conectar_wifi()
+
+ACTIVO = "activo"
+
+# Protocolo binario opcional. Una trama empieza por MAGICO (0xFF no aparece en
+# UTF-8, así que no se confunde con un mensaje de texto) y sigue con el tipo,
+# el movimiento, la época del controlador, el handle del robot y un número de
+# secuencia (2 bytes cada uno). Mientras el robot no conoce su handle añade su
+# id detrás de la cabecera, y el controlador hace lo mismo en sus respuestas.
+# En T_LIBERA_ZONA el byte del movimiento lleva la posición de la zona en ZONAS.
+MAGICO      = 0xFF
+T_SOLICITUD = 1
+T_PASAR     = 2
+T_LLEGO     = 4
+T_LIBERADO  = 5
+T_LIBERA_ZONA = 7
+T_PREPARARSE = 8
+SIN_HANDLE  = 0xFFFF
+TEXTO          = 0
+BINARIO        = 1
+BINARIO_CON_ID = 2
+ORDENES_BIN = {"pasar": T_PASAR, "prepararse": T_PREPARARSE}
+MOVIMIENTOS = (None,)  # Número de cada movimiento; lo completa configurar_cruce().
+EPOCA = os.urandom(1)[0] or 1
+_trama = bytearray(8)
+
+class RegistroRobots:
+    # Interna los identificadores ("robot3") en enteros pequeños y guarda dónde
+    # está cada robot: el nombre de la cola en la que espera, ACTIVO o None.
+    # También el protocolo con el que habla, su última secuencia binaria, el
+    # número de su última solicitud atendida y cuándo empezó a esperar.
+    def __init__(self):
+        self.ids = []
+        self.ubicacion = []
+        self.protocolo = []
+        self.secuencia = []
+        self.solicitud = []
+        self.llegada = []
+        self._handles = {}
+        self._respuestas = []
+        self._topicos = []
+
+    def handle(self, robot_id):
+        h = self._handles.get(robot_id)
+        if h is None:
+            h = len(self.ids)
+            self._handles[robot_id] = h
+            self.ids.append(robot_id)
+            self.ubicacion.append(None)
+            self._respuestas.append({})
+            self._topicos.append(None)
+            self.protocolo.append(TEXTO)
+            self.secuencia.append(0)
+            self.solicitud.append(None)
+            self.llegada.append(0)
+        return h
+
+    def respuesta(self, h, orden):
+        # Mensaje "robot3:pasar" ya codificado: se construye una vez por robot
+        # y orden, y después se reutiliza.
+        cache = self._respuestas[h]
+        msg = cache.get(orden)
+        if msg is None:
+            msg = cache[orden] = (self.ids[h] + ":" + orden).encode()
+        return msg
+
+    def topico(self, h):
+        t = self._topicos[h]
+        if t is None:
+            t = self._topicos[h] = TOPICO_RESPUESTA + b"/" + self.ids[h].encode()
+        return t
+
+    def buscar(self, robot_id):
+        return self._handles.get(robot_id)
+
+    def donde(self, robot_id):
+        h = self._handles.get(robot_id)
+        return None if h is None else self.ubicacion[h]
+
+class ColaPrioridad:
+    # Montículo de [prioridad, orden, handle] con índice por handle. Mantiene al
+    # día la ubicación del robot en el registro. Las bajas son perezosas: la
+    # entrada se marca y se descarta al llegar a la cima. `cambios` crece con
+    # cada alta o baja, para saber si hay que volver a publicar la cola. Las
+    # entradas que salen del montículo se reutilizan, así que un alta no
+    # reserva memoria.
+    def __init__(self, nombre, registro, prioridad):
+        self.nombre = nombre
+        self._registro = registro
+        self._prioridad = prioridad
+        self._heap = []
+        self._entradas = {}
+        self._libres = []
+        self._orden = 0
+        self.cambios = 0
+
+    def __len__(self):
+        return len(self._entradas)
+
+    def __contains__(self, h):
+        return h in self._entradas
+
+    def push(self, h):
+        if h in self._entradas:
+            return False
+        entrada = self._libres.pop() if self._libres else [0, 0, None]
+        entrada[0] = self._prioridad(self._registro.ids[h], self.nombre)
+        entrada[1] = self._orden
+        entrada[2] = h
+        self._orden += 1
+        self._entradas[h] = entrada
+        heapq.heappush(self._heap, entrada)
+        self._registro.ubicacion[h] = self.nombre
+        self.cambios += 1
+        return True
+
+    def remove(self, h):
+        entrada = self._entradas.pop(h, None)
+        if entrada is None:
+            return False
+        entrada[2] = None
+        self._registro.ubicacion[h] = None
+        self.cambios += 1
+        if len(self._heap) > 2 * len(self._entradas) + 8:
+            self._heap = [e for e in self._heap if e[2] is not None]
+            heapq.heapify(self._heap)
+        return True
+
+    def peek(self):
+        heap = self._heap
+        while heap and heap[0][2] is None:
+            self._libres.append(heapq.heappop(heap))
+        return heap[0][2] if heap else None
+
+    def pop(self):
+        h = self.peek()
+        if h is not None:
+            self._libres.append(heapq.heappop(self._heap))
+            del self._entradas[h]
+            self._registro.ubicacion[h] = None
+            self.cambios += 1
+        return h
+
+    def clear(self):
+        for h in self._entradas:
+            self._registro.ubicacion[h] = None
+        self._heap = []
+        self._entradas.clear()
+        self.cambios += 1
+
+    def clave(self, h):
+        return self._entradas[h][0]
+
+    def ordenados(self):
+        ids = self._registro.ids
+        return [ids[e[2]] for e in sorted(self._heap) if e[2] is not None]
+
+class Plazos:
+    # Min-montículo de [vencimiento_ms, orden, handle] sobre un reloj propio en
+    # milisegundos que acumula ticks_diff, de modo que la vuelta de ticks_ms no
+    # desordena el montículo. Cancelar es O(1): la entrada se marca y se
+    # descarta al llegar a la cima, y después se reutiliza.
+    def __init__(self):
+        self._heap = []
+        self._entradas = {}
+        self._libres = []
+        self._orden = 0
+        self._tick = ticks_ms()
+        self._ahora = 0
+
+    def __len__(self):
+        return len(self._entradas)
+
+    def __contains__(self, h):
+        return h in self._entradas
+
+    def ahora(self):
+        t = ticks_ms()
+        self._ahora += ticks_diff(t, self._tick)
+        self._tick = t
+        return self._ahora
+
+    def programar(self, h, espera_ms):
+        self.cancelar(h)
+        entrada = self._libres.pop() if self._libres else [0, 0, None]
+        entrada[0] = self.ahora() + espera_ms
+        entrada[1] = self._orden
+        entrada[2] = h
+        self._orden += 1
+        self._entradas[h] = entrada
+        heapq.heappush(self._heap, entrada)
+
+    def cancelar(self, h):
+        entrada = self._entradas.pop(h, None)
+        if entrada is None:
+            return False
+        entrada[2] = None
+        if len(self._heap) > 2 * len(self._entradas) + 8:
+            self._heap = [e for e in self._heap if e[2] is not None]
+            heapq.heapify(self._heap)
+        return True
+
+    def restante_ms(self):
+        heap = self._heap
+        while heap and heap[0][2] is None:
+            self._libres.append(heapq.heappop(heap))
+        if not heap:
+            return None
+        return max(0, heap[0][0] - self.ahora())
+
+    def vencido(self):
+        # Handle de un plazo ya vencido, o None. Solo se mira la cima.
+        if self.restante_ms() != 0:
+            return None
+        entrada = heapq.heappop(self._heap)
+        self._libres.append(entrada)
+        h = entrada[2]
+        del self._entradas[h]
+        return h
+
+def prioridad_en_cola(rid, movimiento):
+    return prioridades.get(rid, PRIORIDAD_SIN_ASIGNAR.get(movimiento, 99))
+
+def clave_espera(robot_id, movimiento):
+    # Clave de la cola según POLITICA; a igual clave, el que llegó antes. Con
+    # envejecimiento es la hora de llegada más un retraso por cada nivel de
+    # prioridad (limitado a ADELANTO_MAXIMO_MS): ordenar por ella equivale a
+    # ordenar por la prioridad mejorada con la espera, y no cambia mientras
+    # el robot espera.
+    if POLITICA == "prioridad":
+        return prioridad_en_cola(robot_id, movimiento)
+    if POLITICA == "fifo":
+        return plazos.ahora()
+    retraso = (prioridad_en_cola(robot_id, movimiento) - 1) * ENVEJECIMIENTO_MS
+    return plazos.ahora() + min(retraso, ADELANTO_MAXIMO_MS)
+
+registro = RegistroRobots()
+plazos = Plazos()
+
+def configurar_cruce(cruce):
+    # Tablas del cruce indexadas por movimiento: máscara de zonas, nombres de
+    # las zonas (para los mensajes), número de zonas, cola de espera y
+    # movimientos incompatibles (los que comparten alguna zona).
+    global ZONAS, TODAS_LAS_ZONAS, MOVIMIENTOS, movimientos, mascaras, zonas_movimiento
+    global n_zonas, colas_movimiento, colas, indice_movimiento, conflictos, peloton, indice_zona
+    ZONAS, definicion = cruce
+    TODAS_LAS_ZONAS = (1 << len(ZONAS)) - 1
+    movimientos = [m for m, _ in definicion]
+    mascaras = [mascara(z) for _, z in definicion]
+    zonas_movimiento = [list(z) for _, z in definicion]
+    n_zonas = [len(z) for _, z in definicion]
+    colas_movimiento = [ColaPrioridad(m, registro, clave_espera) for m in movimientos]
+    colas = dict(zip(movimientos, colas_movimiento))
+    indice_movimiento = {m: i for i, m in enumerate(movimientos)}
+    indice_zona = {z: k for k, z in enumerate(ZONAS)}
+    MOVIMIENTOS = (None,) + tuple(movimientos)
+    conflictos = [[j for j in range(len(mascaras)) if j != i and mascaras[i] & mascaras[j]]
+                  for i in range(len(mascaras))]
+    peloton = [0] * len(movimientos)
+
+def mascara(zonas):
+    m = 0
+    for z in zonas:
+        m |= 1 << ZONAS.index(z)
+    return m
+
+configurar_cruce(CRUCE)
+
+def encolar(topic, msg, retain=False):
+    salida.append((topic, msg, retain))
+
+def enviar_salida():
+    # Un publish con QoS 1 atiende los mensajes entrantes mientras espera su
+    # PUBACK. Si el manejador de uno de ellos publicara a su vez, ese publish
+    # se quedaría con el PUBACK del primero y el primero no volvería nunca;
+    # por eso los manejadores solo encolan y lo que encolen mientras tanto
+    # sale en esta misma vuelta.
+    i = 0
+    try:
+        while i < len(salida):
+            topic, msg, retain = salida[i]
+            client.publish(topic, msg, qos=1, retain=retain)
+            i += 1
+    finally:
+        del salida[:i]
+
+def publicar_estado():
+    # Solo marca el estado como pendiente: volcar_estado() lo publica una vez
+    # por pasada del bucle, aunque reasignar_esperas() conceda varios permisos.
+    global estado_pendiente
+    estado_pendiente = True
+
+def volcar_estado():
+    # Publica en cada topic solo si su contenido ha cambiado, con una versión
+    # creciente delante ("<versión>:<estado>") para descartar retenidos viejos.
+    global estado_pendiente, version_estado, cambios_colas_publicados
+    enviar_salida()
+    if not estado_pendiente:
+        return
+    nuevos = []
+    activos = ",".join(registro.ids[h] for h in tipo_por_robot).encode()
+    if activos != estado_publicado.get(TOPICO_ESTADO_ACT):
+        nuevos.append((TOPICO_ESTADO_ACT, activos))
+    cambios = sum(c.cambios for c in colas_movimiento)
+    if cambios != cambios_colas_publicados:
+        partes = [m + "|" + ",".join(colas[m].ordenados()) for m in movimientos]
+        payload = ";".join(partes).encode()
+        if payload != estado_publicado.get(TOPICO_ESTADO_COLA):
+            nuevos.append((TOPICO_ESTADO_COLA, payload))
+    cambios_colas_publicados = cambios
+    estado_pendiente = False
+    if nuevos:
+        version_estado += 1
+        prefijo = str(version_estado).encode() + b":"
+        for topic, estado in nuevos:
+            # Se anota antes de publicar: mientras publish() espera el PUBACK
+            # pueden llegar el propio retenido y otros mensajes, que no deben
+            # tomarlo por un estado ajeno ni perder lo que cambien.
+            estado_publicado[topic] = estado
+            versiones_estado[topic] = version_estado
+            client.publish(topic, prefijo + estado, qos=1, retain=True)
+    enviar_salida()
+
+def leer_estado(topic, msg):
+    # Estado de una instantánea retenida, o None si no es más nueva que la
+    # última aplicada o publicada en ese topic. Sin versión (formato
+    # anterior) cuenta como la versión 0.
+    global version_estado
+    texto = msg.decode().strip()
+    version, sep, estado = texto.partition(":")
+    if sep and version.isdigit():
+        version = int(version)
+    else:
+        version, estado = 0, texto
+    if version <= versiones_estado.get(topic, -1):
+        return None
+    versiones_estado[topic] = version
+    version_estado = max(version_estado, version)
+    estado_publicado[topic] = estado.encode()
+    return estado
+
+def restaurar_estado(topic, msg):
+    global zonas_liberadas
+    texto = leer_estado(topic, msg)
+    if texto is None:
+        return
+    if topic == TOPICO_ESTADO_ACT:
+        if texto:
+            robots = texto.split(",")
+            if not zonas_ocupadas:
+                print("[CONTROL] Estado retenido pero sin recursos -> ignorado")
+                olvidar_activos()
+            else:
+                for r in robots:
+                    h = registro.handle(r)
+                    quitar_de_colas(h)
+                    tipo_por_robot.setdefault(h, None)
+                    registro.ubicacion[h] = ACTIVO
+                    plazos.programar(h, TIEMPO_MAX_CRUCE_MS)
+                print("Recuperado active_robot(s):", robots)
+        else:
+            olvidar_activos()
+            print("No hay active_robot retenido.")
+    elif topic == TOPICO_ESTADO_COLA:
+        if texto:
+            partes = texto.split(";")
+            for parte in partes:
+                if "|" not in parte:
+                    continue
+                zona, lst = parte.split("|", 1)
+                robots = lst.split(",") if lst else []
+                if zona not in colas:
+                    continue
+                cola = colas[zona]
+                cola.clear()
+                for r in robots:
+                    if r and registro.donde(r) is None:
+                        h = registro.handle(r)
+                        registro.llegada[h] = plazos.ahora()
+                        cola.push(h)
+            # Las zonas siguen libres tras restaurar: la próxima liberación
+            # debe evaluar las colas recuperadas.
+            zonas_liberadas |= TODAS_LAS_ZONAS & ~zonas_ocupadas
+            print("Recuperadas colas:", {m: colas[m].ordenados() for m in movimientos})
+        else:
+            print("Colas retenidas vacías.")
+
+def olvidar_activos():
+    for h in tipo_por_robot:
+        registro.ubicacion[h] = None
+    tipo_por_robot.clear()
+    zonas_robot.clear()
+    franjas.clear()
+
+def responder(h, orden):
+    # La orden va al topic del robot, en el formato con el que pidió paso.
+    if registro.protocolo[h] != TEXTO:
+        msg = bytes(trama(ORDENES_BIN[orden], h))
+        compartido = TOPICO_RESPUESTA_BIN
+    else:
+        msg = registro.respuesta(h, orden)
+        compartido = TOPICO_RESPUESTA
+    encolar(registro.topico(h), msg)
+    if MODO_COMPATIBLE:
+        encolar(compartido, msg)
+
+def responder_franja(h, espera_ms):
+    msg = (registro.ids[h] + ":franja:" + str(espera_ms)).encode()
+    encolar(registro.topico(h), msg)
+    if MODO_COMPATIBLE:
+        encolar(TOPICO_RESPUESTA, msg)
+
+def otorgar_permiso(h, i, espera_ms=None):
+    # Con espera_ms el permiso es una franja que empieza dentro de espera_ms.
+    global zonas_ocupadas
+    robot_id = registro.ids[h]
+    zonas_ocupadas |= mascaras[i]
+    tipo_por_robot[h] = i
+    zonas_robot[h] = mascaras[i]
+    peloton[i] += 1
+    for j in conflictos[i]:
+        peloton[j] = 0
+    registro.ubicacion[h] = ACTIVO
+    if espera_ms is None:
+        plazos.programar(h, TIEMPO_MAX_CRUCE_MS)
+        responder(h, "pasar")
+    else:
+        plazos.programar(h, espera_ms + TIEMPO_MAX_CRUCE_MS)
+        responder_franja(h, espera_ms)
+    publicar_estado()
+    print("[CONTROL] Permiso a", robot_id, "->", zonas_movimiento[i])
+
+def buscar_franja(i, eta_ms, duracion_ms):
+    # Primer inicio desde la llegada en que ninguna franja de las mismas
+    # zonas se solapa, o None si no se puede reservar.
+    mascara = mascaras[i]
+    directas = 0
+    for h, m in zonas_robot.items():
+        if h not in franjas:
+            directas |= m
+    if mascara & directas or colas_movimiento[i]:
+        return None
+    for j in conflictos[i]:
+        if colas_movimiento[j]:
+            return None
+    llegada = plazos.ahora() + eta_ms
+    inicio = llegada
+    movido = True
+    while movido:
+        movido = False
+        for desde, hasta, m in franjas.values():
+            if m & mascara and desde < inicio + duracion_ms + MARGEN_FRANJA_MS and inicio < hasta + MARGEN_FRANJA_MS:
+                inicio = hasta + MARGEN_FRANJA_MS
+                movido = True
+    if inicio - llegada > RETRASO_MAXIMO_FRANJA_MS:
+        return None
+    return inicio
+
+def soltar(mascara):
+    # Quita zonas de zonas_ocupadas. Con franjas, una zona solo queda libre si
+    # no la tiene ningún otro robot.
+    global zonas_ocupadas, zonas_liberadas
+    if franjas:
+        for m in zonas_robot.values():
+            mascara &= ~m
+    zonas_ocupadas &= ~mascara
+    zonas_liberadas |= mascara
+
+def liberar_recursos(h):
+    global zonas_ocupadas, zonas_liberadas
+    robot_id = registro.ids[h]
+    i = tipo_por_robot.pop(h, None)
+    retenidas = zonas_robot.pop(h, 0)
+    franjas.pop(h, None)
+    registro.ubicacion[h] = None
+    if i is None:
+        print("[CONTROL] liberar_recursos:", robot_id, "no tenía recursos asignados.")
+    else:
+        print("[CONTROL] Liberando recursos", zonas_movimiento[i], "de", robot_id)
+        soltar(retenidas)
+    plazos.cancelar(h)
+    publicar_estado()
+    reasignar_esperas()
+
+def liberar_zona(h, k):
+    # Liberación parcial: el activo ya ha salido de la zona k y pasa al
+    # siguiente que la espera. Sigue activo, con su plazo, hasta que libere
+    # el cruce.
+    bit = 1 << k
+    if not zonas_robot.get(h, 0) & bit:
+        return
+    zonas_robot[h] &= ~bit
+    soltar(bit)
+    print("[CONTROL]", registro.ids[h], "libera", ZONAS[k])
+    reasignar_esperas()
+
+def avisar_siguientes(h):
+    # El activo avisa con llego de que está a punto de dejar sus zonas: las
+    # cimas de las colas que las esperan se preparan para arrancar en cuanto
+    # les llegue el pasar.
+    i = tipo_por_robot.get(h)
+    if i is None:
+        return
+    for j in [i] + conflictos[i]:
+        siguiente = colas_movimiento[j].peek()
+        if siguiente is not None:
+            responder(siguiente, "prepararse")
+
+def reasignar_esperas():
+    # Solo hay algo que decidir si alguna zona acaba de quedar libre. Entre las
+    # cimas de las colas cuyas zonas están libres (un AND con zonas_ocupadas)
+    # se elige la de menor clave_espera, a igualdad la que ocupa menos zonas, y
+    # se le reservan sus zonas; se repite hasta que no cabe nadie más, así que
+    # todos los movimientos compatibles salen a la vez. Los permisos se dan
+    # después en el orden de los movimientos. Salvo con prioridad estricta,
+    # compiten también las cimas que no caben: si la mejor no cabe, sus zonas
+    # quedan reservadas y nadie que llegó después las toma, de modo que un
+    # movimiento de varias zonas no espera sin límite a que se liberen todas
+    # a la vez. Antes que nadie van los pelotones que pueden seguir.
+    global zonas_liberadas
+    if not zonas_liberadas:
+        return
+    zonas_liberadas = 0
+    reservar = POLITICA != "prioridad"
+    ocupadas = zonas_ocupadas
+    vistos = 0
+    elegidos = 0
+    if PELOTON_MAXIMO > 1:
+        # Dos movimientos incompatibles no tienen pelotón a la vez: conceder
+        # a uno pone a cero el del otro.
+        for i in range(len(movimientos)):
+            if not mascaras[i] & ocupadas and sigue_peloton(i):
+                vistos |= 1 << i
+                elegidos |= 1 << i
+                ocupadas |= mascaras[i]
+    while True:
+        mejor = -1
+        mejor_clave = 0
+        for i in range(len(movimientos)):
+            if vistos >> i & 1 or (mascaras[i] & ocupadas and not reservar):
+                continue
+            h = colas_movimiento[i].peek()
+            if h is None:
+                continue
+            clave = colas_movimiento[i].clave(h)
+            if mejor < 0 or clave < mejor_clave or (clave == mejor_clave and n_zonas[i] < n_zonas[mejor]):
+                mejor = i
+                mejor_clave = clave
+        if mejor < 0:
+            break
+        vistos |= 1 << mejor
+        if not mascaras[mejor] & ocupadas:
+            elegidos |= 1 << mejor
+        ocupadas |= mascaras[mejor]
+    for i in range(len(movimientos)):
+        if elegidos >> i & 1:
+            otorgar_permiso(colas_movimiento[i].pop(), i)
+
+def sigue_peloton(i):
+    # El pelotón del movimiento i crece si tiene a alguien esperando, no ha
+    # llegado a PELOTON_MAXIMO y ninguna cola incompatible espera demasiado.
+    if not 0 < peloton[i] < PELOTON_MAXIMO or colas_movimiento[i].peek() is None:
+        return False
+    ahora = plazos.ahora()
+    for j in conflictos[i]:
+        h = colas_movimiento[j].peek()
+        if h is not None and ahora - registro.llegada[h] > ESPERA_MAXIMA_PELOTON_MS:
+            return False
+    return True
+
+def leer_trama(msg):
+    # Lee la cabecera indexando el mensaje recibido, sin copiarlo (vale igual
+    # para bytes, bytearray o memoryview). Devuelve el tipo, el movimiento y el
+    # handle, o SIN_HANDLE si la trama no identifica a ningún robot.
+    if len(msg) < 8:
+        return None, 0, SIN_HANDLE
+    if len(msg) > 8:
+        h = registro.handle(bytes(msg[8:]).decode())
+        registro.protocolo[h] = BINARIO_CON_ID
+    else:
+        h = msg[4] << 8 | msg[5]
+        if msg[3] != EPOCA or h >= len(registro.ids):
+            return msg[1], msg[2], SIN_HANDLE
+        registro.protocolo[h] = BINARIO
+    registro.secuencia[h] = msg[6] << 8 | msg[7]
+    return msg[1], msg[2], h
+
+def trama(tipo, h, movimiento=0):
+    t = _trama
+    s = registro.secuencia[h]
+    t[0] = MAGICO
+    t[1] = tipo
+    t[2] = movimiento
+    t[3] = EPOCA
+    t[4] = h >> 8
+    t[5] = h & 0xFF
+    t[6] = s >> 8
+    t[7] = s & 0xFF
+    if registro.protocolo[h] == BINARIO_CON_ID:
+        return t + registro.ids[h].encode()
+    return t
+
+def solicitud_repetida(h, numero):
+    # El robot numera cada solicitud y repite el número al reenviarla (por
+    # tiempo, al reconectar o tras el sync); QoS 1 también puede entregarla
+    # dos veces. Una repetida no pasa por las colas ni cambia el estado: al
+    # activo se le vuelve a mandar su pasar o su franja, por si lo perdió, y
+    # al que espera nada. Sin número (robots anteriores) todas cuentan como
+    # nuevas.
+    if numero is None or numero != registro.solicitud[h]:
+        registro.solicitud[h] = numero
+        return False
+    print("[CONTROL] Solicitud repetida de", registro.ids[h] + ", ya atendida.")
+    if registro.ubicacion[h] == ACTIVO:
+        if h in franjas:
+            responder_franja(h, max(0, franjas[h][0] - plazos.ahora()))
+        else:
+            responder(h, "pasar")
+    return True
+
+def atender_solicitud(h, tipo):
+    global zonas_liberadas
+    robot_id = registro.ids[h]
+    print("[CONTROL] Solicitud de", robot_id, "tipo", tipo)
+    lugar = registro.ubicacion[h]
+    if lugar is not None:
+        print("[CONTROL]", robot_id, "ya está en", lugar + ", ignorando.")
+        return
+    i = indice_movimiento.get(tipo)
+    if i is None:
+        print("[CONTROL] Movimiento desconocido:", tipo)
+    elif mascaras[i] & zonas_ocupadas:
+        registro.llegada[h] = plazos.ahora()
+        colas_movimiento[i].push(h)
+        publicar_estado()
+    elif POLITICA == "prioridad" or not any(colas_movimiento):
+        otorgar_permiso(h, i)
+    else:
+        # Sus zonas están libres, pero pueden estar reservadas para alguien
+        # que espera desde antes: lo decide reasignar_esperas().
+        registro.llegada[h] = plazos.ahora()
+        colas_movimiento[i].push(h)
+        zonas_liberadas |= mascaras[i]
+        publicar_estado()
+        reasignar_esperas()
+
+def atender_reserva(h, pedido):
+    tipo, _, plan = pedido.partition("@")
+    eta, _, duracion = plan.partition("+")
+    i = indice_movimiento.get(tipo)
+    if not RESERVAS or i is None or not eta.isdigit() or not duracion.isdigit():
+        atender_solicitud(h, tipo)
+        return
+    robot_id = registro.ids[h]
+    print("[CONTROL] Reserva de", robot_id, "tipo", tipo, "llega en", eta, "ms")
+    if registro.ubicacion[h] is not None:
+        print("[CONTROL]", robot_id, "ya está en", registro.ubicacion[h] + ", ignorando.")
+        return
+    inicio = buscar_franja(i, int(eta), int(duracion))
+    if inicio is None:
+        atender_solicitud(h, tipo)
+        return
+    ahora = plazos.ahora()
+    franjas[h] = (inicio, inicio + int(duracion), mascaras[i])
+    otorgar_permiso(h, i, inicio - ahora)
+
+def atender_reporte(h, evento):
+    lugar = registro.ubicacion[h]
+    if lugar is not None:
+        print("[CONTROL] Reporte", evento, "de", registro.ids[h])
+        if evento != "cruce_liberado":
+            # Sale sin cruzar: si vuelve con la misma solicitud, es nueva.
+            registro.solicitud[h] = None
+        if lugar == ACTIVO:
+            liberar_recursos(h)
+        else:
+            quitar_de_colas(h)
+            publicar_estado()
+
+def procesar_trama(msg):
+    tipo, movimiento, h = leer_trama(msg)
+    if h == SIN_HANDLE:
+        print("[CONTROL] Trama de un robot desconocido, ignorando.")
+        return
+    if tipo == T_SOLICITUD and 0 < movimiento < len(MOVIMIENTOS):
+        if not solicitud_repetida(h, registro.secuencia[h]):
+            atender_solicitud(h, MOVIMIENTOS[movimiento])
+    elif tipo == T_LIBERADO:
+        atender_reporte(h, "cruce_liberado")
+    elif tipo == T_LIBERA_ZONA and movimiento < len(ZONAS):
+        liberar_zona(h, movimiento)
+    elif tipo == T_LLEGO and registro.ubicacion[h] == ACTIVO:
+        avisar_siguientes(h)
+
+def recordar(cache, msg, valor):
+    # Un robot manda siempre los mismos mensajes de texto ("robot3:horizontal",
+    # y la solicitud repetida con el mismo número), así que basta con
+    # trocearlos la primera vez. Si la caché se llena de
+    # mensajes que no se repiten, se vacía.
+    if len(cache) > 8 * len(registro.ids) + 64:
+        cache.clear()
+    cache[msg] = valor
+    return valor
+
+def procesar_mensaje(topic, msg):
+    try:
+        if msg and msg[0] == MAGICO and topic in (TOPICO_SOLICITUD, TOPICO_REPORTES):
+            procesar_trama(msg)
+        elif topic == TOPICO_SOLICITUD:
+            # "robot3:<tipo>[@<eta>+<duración>]#<número>"; sin "#" es una
+            # solicitud sin numerar.
+            leido = solicitudes_leidas.get(msg)
+            if leido is None:
+                text = msg.decode()
+                if ":" not in text:
+                    print("[CONTROL] solicitud formato inválido:", text)
+                    return
+                text, _, numero = text.partition("#")
+                robot_id, tipo = text.split(":", 1)
+                numero = numero.strip()
+                leido = recordar(solicitudes_leidas, msg, (registro.handle(robot_id.strip()), tipo.strip(),
+                                                           int(numero) if numero.isdigit() else None))
+            h, tipo, numero = leido
+            registro.protocolo[h] = TEXTO
+            if solicitud_repetida(h, numero):
+                return
+            if "@" in tipo:
+                atender_reserva(h, tipo)
+            else:
+                atender_solicitud(h, tipo)
+        elif topic == TOPICO_REPORTES:
+            leido = reportes_leidos.get(msg)
+            if leido is None:
+                origen, evento = msg.decode().split(":", 1)
+                leido = recordar(reportes_leidos, msg, (origen.strip(), evento.strip()))
+            origen, evento = leido
+            if evento in ("cruce_liberado", "expulsado", "offline"):
+                h = registro.buscar(origen)
+                if h is not None:
+                    atender_reporte(h, evento)
+            elif evento == "llego":
+                h = registro.buscar(origen)
+                if h is not None and registro.ubicacion[h] == ACTIVO:
+                    avisar_siguientes(h)
+            elif evento.startswith("libera:"):
+                h = registro.buscar(origen)
+                k = indice_zona.get(evento[7:])
+                if h is not None and k is not None:
+                    liberar_zona(h, k)
+        elif topic in (TOPICO_ESTADO_ACT, TOPICO_ESTADO_COLA):
+            # Retenidos que llegan tarde y el eco de las propias publicaciones.
+            restaurar_estado(topic, msg)
+    except Exception as e:
+        print("[CONTROL] Error en procesar_mensaje:", e)
+
+def quitar_de_colas(h):
+    # Si sale la cima de una cola, sus zonas dejan de estar reservadas y
+    # pueden entrar los que esperaban detrás de esa reserva.
+    global zonas_liberadas
+    lugar = registro.ubicacion[h]
+    if lugar in colas:
+        cima = colas[lugar].peek() == h
+        colas[lugar].remove(h)
+        if cima:
+            zonas_liberadas |= mascaras[indice_movimiento[lugar]]
+            reasignar_esperas()
+
+def revisar_timeout():
+    h = plazos.vencido()
+    while h is not None:
+        robot_id = registro.ids[h]
+        print("[CONTROL] Timeout:", robot_id)
+        encolar(TOPICO_REPORTES, registro.respuesta(h, "expulsado"))
+        # Sale sin cruzar: si vuelve con la misma solicitud, es nueva.
+        registro.solicitud[h] = None
+        if h in tipo_por_robot:
+            liberar_recursos(h)
+        else:
+            quitar_de_colas(h)
+            publicar_estado()
+        h = plazos.vencido()
+
+def conectar_broker():
+    global client
+    while True:
+        try:
+            client = MQTTClient(client_id=CLIENT_ID, server=BROKER_IP, keepalive=60)
+            client.set_last_will(topic=TOPICO_REPORTES, msg=CLIENT_ID + b":offline", retain=True, qos=1)
+            client.connect(clean_session=False)
+            print("[CONTROL] Conectado al broker MQTT")
+            return
+        except Exception as e:
+            print("[CONTROL] Broker no disponible. Reintentando en 5s...", e)
+            time.sleep(5)
+
+def esperar_retenidos():
+    # Los retenidos de estado llegan tras la suscripción: se esperan hasta
+    # ESPERA_RETENIDOS_MS para que el aviso de sync ya lleve a los robots
+    # recuperados. En el primer arranque no hay retenidos y se agota el plazo.
+    inicio = ticks_ms()
+    sondeo = select.poll()
+    sondeo.register(client.sock, select.POLLIN)
+    while TOPICO_ESTADO_ACT not in versiones_estado or TOPICO_ESTADO_COLA not in versiones_estado:
+        restante = ESPERA_RETENIDOS_MS - ticks_diff(ticks_ms(), inicio)
+        if restante <= 0 or not sondeo.poll(restante):
+            return
+        client.check_msg()
+
+def aviso_sync():
+    recuperados = [registro.ids[h] for h in range(len(registro.ids)) if registro.ubicacion[h] is not None]
+    flota = max(FLOTA_SYNC, len(registro.ids))
+    ventana = min(VENTANA_MAXIMA_SYNC_MS, MS_POR_ROBOT_SYNC * flota)
+    msg = b"reanunciar:" + str(ventana).encode()
+    if SYNC_CON_LISTA and recuperados:
+        msg += b":" + ",".join(recuperados).encode()
+    return msg
+
+def inicializar_mqtt():
+    client.set_callback(restaurar_estado)
+    client.subscribe(TOPICO_ESTADO_ACT, qos=1)
+    client.subscribe(TOPICO_ESTADO_COLA, qos=1)
+    esperar_retenidos()
+    client.set_callback(procesar_mensaje)
+    client.subscribe(TOPICO_SOLICITUD, qos=1)
+    client.subscribe(TOPICO_REPORTES, qos=1)
+    client.publish(TOPICO_REPORTES, CLIENT_ID + b":online", qos=1, retain=True)
+    client.publish(TOPICO_SYNC, aviso_sync(), qos=1)
+    # Lo atendido mientras se suscribía se publica ya, sin esperar al bucle.
+    publicar_estado()
+    volcar_estado()
+    print("[CONTROL] Inicializado MQTT y publicado estado inicial.")
+def drenar_mensajes():
+    # Atiende todo lo pendiente en el socket MQTT, hasta PRESUPUESTO_MENSAJES
+    # por pasada. Devuelve True si se agotó el presupuesto y puede quedar más.
+    global _sock_sondeado, _sondeo
+    if client.sock is not _sock_sondeado:
+        _sock_sondeado = client.sock
+        _sondeo = select.poll()
+        _sondeo.register(_sock_sondeado, select.POLLIN)
+    for _ in range(PRESUPUESTO_MENSAJES):
+        if not _sondeo.poll(0):
+            return False
+        client.check_msg()
+        enviar_salida()
+    return True
+
+if sys.implementation.name == "micropython":
+    async def esperar_lectura(sock):
+        yield asyncio.core._io_queue.queue_read(sock)
+else:
+    async def esperar_lectura(sock):
+        loop = asyncio.get_running_loop()
+        listo = loop.create_future()
+        loop.add_reader(sock, lambda: listo.done() or listo.set_result(None))
+        try:
+            await listo
+        finally:
+            loop.remove_reader(sock)
+
+async def reconectar(e):
+    global reconectando
+    if reconectando:
+        return
+    reconectando = True
+    try:
+        print("[CONTROL] MQTT desconectado. Reintentando en 5s...", e)
+        await asyncio.sleep(5)
+        conectar_broker()
+        inicializar_mqtt()
+        aviso_plazos.set()
+    finally:
+        reconectando = False
+
+async def tarea_mensajes():
+    # Despierta en cuanto el socket tiene datos: un cruce_liberado se convierte
+    # en el siguiente pasar sin esperar a ninguna pausa. El plazo de espera
+    # solo sirve para volver a mirar client.sock tras una reconexión.
+    while True:
+        try:
+            try:
+                await asyncio.wait_for(esperar_lectura(client.sock), ESPERA_SOCKET_S)
+            except asyncio.TimeoutError:
+                volcar_estado()
+                continue
+            while drenar_mensajes():
+                volcar_estado()
+                await asyncio.sleep(0)
+            volcar_estado()
+            aviso_plazos.set()
+        except OSError as e:
+            await reconectar(e)
+        except Exception as e:
+            print("[CONTROL] Error en tarea de mensajes:", e)
+
+async def tarea_plazos():
+    # Duerme hasta el próximo vencimiento, o hasta que los mensajes cambien los plazos.
+    while True:
+        aviso_plazos.clear()
+        restante = plazos.restante_ms()
+        if restante is None:
+            await aviso_plazos.wait()
+        elif restante > 0:
+            try:
+                await asyncio.wait_for(aviso_plazos.wait(), restante / 1000)
+            except asyncio.TimeoutError:
+                pass
+        try:
+            revisar_timeout()
+            volcar_estado()
+        except OSError as e:
+            await reconectar(e)
+        except Exception as e:
+            print("[CONTROL] Error en tarea de plazos:", e)
+
+async def tarea_watchdog():
+    while True:
+        wdt.feed()
+        await asyncio.sleep(PERIODO_WATCHDOG_S)
+
+async def tarea_conexion():
+    # Comprueba la WiFi y mantiene viva la sesión MQTT con un PINGREQ periódico.
+    desde_ping = 0
+    while True:
+        await asyncio.sleep(PERIODO_CONEXION_S)
+        desde_ping += PERIODO_CONEXION_S
+        try:
+            verificar_wifi()
+            if desde_ping >= PERIODO_PING_S:
+                client.ping()
+                desde_ping = 0
+        except OSError as e:
+            await reconectar(e)
+
+async def principal():
+    configurar_topicos()
+    configurar_cruce(CRUCE)
+    conectar_wifi()
+    conectar_broker()
+    inicializar_mqtt()
+    asyncio.create_task(tarea_plazos())
+    asyncio.create_task(tarea_watchdog())
+    asyncio.create_task(tarea_conexion())
+    await tarea_mensajes()
+
+def main():
+    asyncio.run(principal())
+
+if __name__ == "__main__":
+    main()
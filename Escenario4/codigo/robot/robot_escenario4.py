@@ -1,183 +1,514 @@
-from machine import Pin, PWM
-import time
-from umqtt.robust import MQTTClient
-import network
-
-WIFI_SSID   = "XXXXX"
-WIFI_PASS   = "XXXXX"
-BROKER_IP   = "XXXXX"
-CLIENT_ID   = "robotX"
-ROBOT_TIPO  = "XXXXX"        # "vertical_A", "vertical_B" o "horizontal"
-
-TOPICO_SOLICITUD  = b"cruce/solicitud"
-TOPICO_RESPUESTA  = b"cruce/respuesta"
-TOPICO_REPORTES   = b"cruce/reportes"
-TOPICO_SYNC       = b"robots/solicitar_estado"
-
-PIN_SERVO_IZQ = 13
-PIN_SERVO_DER = 14
-led = Pin(2, Pin.OUT)
-servo_izq = PWM(Pin(PIN_SERVO_IZQ), freq=50)
-servo_der = PWM(Pin(PIN_SERVO_DER), freq=50)
-en_cruce = False
-autorizado = False
-esperando_autorizacion = False
-client = None
-
-def mover(d_izq, d_der):
-    servo_izq.duty_u16(d_izq)
-    servo_der.duty_u16(d_der)
-
-def avanzar():
-    print("[ROBOT] Avanzando...")
-    mover(5060, 4390)
-
-def detener():
-    print("[ROBOT] Detenido.")
-    mover(4800, 4700)
-
-def led_parpadeo(intervalo, veces=1):
-    for _ in range(veces):
-        led.on(); time.sleep(intervalo)
-        led.off(); time.sleep(intervalo)
-
-def conectar_wifi():
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    if not wlan.isconnected():
-        wlan.connect(WIFI_SSID, WIFI_PASS)
-        while not wlan.isconnected():
-            time.sleep(0.5)
-            led_parpadeo(0.1, 1)
-    print("[ROBOT] WiFi conectado:", wlan.ifconfig())
-    led.on()
-
-def verificar_wifi():
-    wlan = network.WLAN(network.STA_IF)
-    if not wlan.isconnected():
-        print("[ROBOT] Reconectando WiFi...")
-        conectar_wifi()
-
-def procesar_mensaje(topic, msg):
-    global autorizado, esperando_autorizacion
-    t = topic.decode() if isinstance(topic, bytes) else topic
-    m = msg.decode() if isinstance(msg, bytes) else msg
-    if t == TOPICO_RESPUESTA.decode():
-        try:
-            who, orden = m.split(":", 1)
-        except ValueError:
-            return
-        if who != CLIENT_ID:
-            return
-        orden = orden.strip()
-        if orden == "pasar":
-            print("[ROBOT] Permiso recibido -> pasar")
-            autorizado = True
-            esperando_autorizacion = False
-        elif orden == "expulsado":
-            print("[ROBOT] Expulsado por timeout")
-            autorizado = False
-            esperando_autorizacion = False
-    elif t == TOPICO_SYNC.decode():
-        if esperando_autorizacion or not en_cruce:
-            print("[ROBOT] Sync recibido -> reenviando solicitud")
-            solicitar_cruce()
-
-def _suscribir_temas():
-    client.subscribe(TOPICO_RESPUESTA, qos=1)
-    client.subscribe(TOPICO_SYNC, qos=1)
-
-def conectar_mqtt():
-    global client
-    verificar_wifi()
-    client = MQTTClient(client_id=CLIENT_ID.encode(), server=BROKER_IP, keepalive=60)
-    client.set_last_will(topic=TOPICO_REPORTES, msg=(CLIENT_ID + ":offline").encode(), retain=True, qos=1)
-    client.set_callback(lambda t, m: procesar_mensaje(t, m))
-    client.connect(clean_session=False)
-    _suscribir_temas()
-    client.publish(TOPICO_REPORTES, (CLIENT_ID + ":online").encode(), qos=1, retain=True)
-    print("[ROBOT] MQTT conectado y suscrito")
-
-def reconectar_mqtt():
-    while True:
-        try:
-            print("[ROBOT] Reconectando MQTT...")
-            client.connect(clean_session=False)
-            _suscribir_temas()
-            client.publish(TOPICO_REPORTES, (CLIENT_ID + ":online").encode(), qos=1, retain=True)
-            print("[ROBOT] MQTT reconectado")
-            return
-        except Exception as e:
-            print("[ROBOT] Fallo reconexión:", e)
-            time.sleep(2)
-
-def solicitar_cruce():
-    global esperando_autorizacion, autorizado
-    verificar_wifi()
-    autorizado = False
-    esperando_autorizacion = True
-    try:
-        client.publish(TOPICO_SOLICITUD, f"{CLIENT_ID}:{ROBOT_TIPO}".encode(), qos=1)
-        print("[ROBOT] Solicitud enviada:", f"{CLIENT_ID}:{ROBOT_TIPO}".encode())
-    except Exception as e:
-        print("[ROBOT] Fallo al publicar solicitud, reconectando...", e)
-        reconectar_mqtt()
-        client.publish(TOPICO_SOLICITUD, f"{CLIENT_ID}:{ROBOT_TIPO}".encode(), qos=1)
-
-def esperar_autorizacion(resend_interval_s=60):
-    global autorizado
-    print("[ROBOT] Esperando autorización...")
-    ultimo_envio = time.time()
-    while not autorizado:
-        try:
-            client.check_msg()
-        except Exception:
-            reconectar_mqtt()
-        if time.time() - ultimo_envio >= resend_interval_s:
-            print("[ROBOT] Timeout espera -> reenviando solicitud")
-            solicitar_cruce()
-            ultimo_envio = time.time()
-        time.sleep(0.1)
-    return True
-
-def reportar_llegada():
-    verificar_wifi()
-    try:
-        client.publish(TOPICO_REPORTES, (CLIENT_ID + ":llego").encode(), qos=1)
-        print("[ROBOT] Reporte llego enviado")
-        client.publish(TOPICO_REPORTES, (CLIENT_ID + ":cruce_liberado").encode(), qos=1)
-        print("[ROBOT] Reporte cruce_liberado enviado")
-    except Exception as e:
-        print("[ROBOT] Error publicando reportes:", e)
-        reconectar_mqtt()
-        client.publish(TOPICO_REPORTES, (CLIENT_ID + ":llego").encode(), qos=1)
-        client.publish(TOPICO_REPORTES, (CLIENT_ID + ":cruce_liberado").encode(), qos=1)
-
-def main():
-    global en_cruce
-    detener()
-    conectar_wifi()
-    conectar_mqtt()
-    avanzar()
-    time.sleep(2)
-    detener()
-    solicitar_cruce()
-    esperar_autorizacion(resend_interval_s=60)
-    en_cruce = True
-    avanzar()
-    time.sleep(6)
-    detener()
-    reportar_llegada()
-    en_cruce = False
-    print("[ROBOT] Cruce completado.")
-    avanzar()
-    time.sleep(2)
-    detener()
-    try:
-        client.disconnect()
-        print("[ROBOT] Desconectado del broker MQTT.")
-    except Exception as e:
-        print("[ROBOT] Error al desconectar:", e)
-
-if __name__ == "__main__":
-    main()
\ No newline at end of file
+from machine import Pin, PWM
+import time
+import select
+import random
+from umqtt.robust import MQTTClient
+import network
+
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+WIFI_SSID   = "XXXXX"
+WIFI_PASS   = "XXXXX"
+BROKER_IP   = "XXXXX"
+CLIENT_ID   = "robotX"
+ROBOT_TIPO  = "XXXXX"        # "vertical_A", "vertical_B" o "horizontal"
+# Recorrido por el cruce: tarda TIEMPO_CRUCE_MS y, según SALIDAS_ZONA, avisa
+# de cada zona de la que sale antes de terminar (ms desde que entra) para que
+# el controlador se la dé al siguiente. Las demás se liberan al final con
+# cruce_liberado. AVISO_LLEGO_MS antes del final manda llego, para que el
+# controlador prepare al siguiente.
+TIEMPO_CRUCE_MS = 6000
+# Vacío: todas las zonas se liberan al final. Los tiempos dependen del cruce
+# y del robot, así que hay que medirlos antes de ponerlos: marcar en el suelo
+# el borde de cada zona, cruzar varias veces por cada movimiento y cronometrar
+# desde que el robot entra hasta que su parte trasera sale de la zona; se
+# pone la peor medida más un margen. P. ej. {"horizontal": (("I1", 3000),)}.
+SALIDAS_ZONA = {}
+AVISO_LLEGO_MS = 1000
+# Con RESERVA el robot pide paso al empezar a acercarse, con lo que le falta
+# para llegar a la línea (TIEMPO_APROXIMACION_MS) y lo que tarda en cruzar. Si
+# el controlador le da franja, entra sin pararse, o esperando en la línea lo
+# que falte para su franja; si no, se para en la línea y espera el pasar como
+# siempre. Solo con el protocolo de texto.
+RESERVA = False
+TIEMPO_APROXIMACION_MS = 2000
+TOLERANCIA_FRANJA_MS = 300
+PROTOCOLO_BINARIO = False
+# Con keepalive=60 el broker cierra la sesión tras 90 s sin oír al robot.
+PERIODO_PING_MS = 30000
+# Con un controlador anterior a los topics por robot, las respuestas llegan
+# a todos por los topics compartidos.
+RESPUESTAS_COMPARTIDAS = False
+
+# Con CRUCE_ID los topics llevan el identificador del cruce (cruce/<id>/...
+# y robots/<id>/solicitar_estado), así varios cruces comparten broker. Vacío,
+# son los de un cruce solo.
+CRUCE_ID = ""
+
+def configurar_topicos():
+    global TOPICO_SOLICITUD, TOPICO_RESPUESTA, TOPICO_RESPUESTA_BIN
+    global TOPICO_REPORTES, TOPICO_SYNC
+    cruce = b"cruce/" + CRUCE_ID.encode() + b"/" if CRUCE_ID else b"cruce/"
+    robots = b"robots/" + CRUCE_ID.encode() + b"/" if CRUCE_ID else b"robots/"
+    TOPICO_SOLICITUD  = cruce + b"solicitud"
+    TOPICO_RESPUESTA  = cruce + b"respuesta"
+    TOPICO_RESPUESTA_BIN = cruce + b"respuesta/bin"
+    TOPICO_REPORTES   = cruce + b"reportes"
+    TOPICO_SYNC       = robots + b"solicitar_estado"
+
+configurar_topicos()
+
+# Trama binaria: MAGICO, tipo, movimiento, época del controlador, handle y
+# secuencia. Mientras no conoce su handle, el robot añade su id detrás. La
+# secuencia es el número de la solicitud en curso, el mismo en sus reenvíos.
+MAGICO      = 0xFF
+T_SOLICITUD = 1
+T_LLEGO     = 4
+T_LIBERADO  = 5
+T_LIBERA_ZONA = 7
+SIN_HANDLE  = 0xFFFF
+# Los movimientos y las zonas en el orden de CRUCE en el controlador.
+MOVIMIENTOS = (None, "vertical_A", "vertical_B", "horizontal")
+ZONAS = ("I1", "I2")
+ORDENES_BIN = {2: "pasar", 6: "expulsado", 8: "prepararse"}
+
+# Movimiento como datos: cada tramo es (duty izquierdo, duty derecho, ms,
+# aviso al terminarlo o None). ejecutar() los recorre sin dejar de atender
+# MQTT, así que el robot oye al controlador mientras se mueve.
+AVANCE = (5060, 4390)
+PARADA = (4800, 4700)
+PLAN_SALIDA = (AVANCE + (2000, None), PARADA + (0, None))
+
+PIN_SERVO_IZQ = 13
+PIN_SERVO_DER = 14
+led = Pin(2, Pin.OUT)
+servo_izq = PWM(Pin(PIN_SERVO_IZQ), freq=50)
+servo_der = PWM(Pin(PIN_SERVO_DER), freq=50)
+en_cruce = False
+autorizado = False
+esperando_autorizacion = False
+armado = False
+franja = None
+client = None
+mi_id = b""
+mi_topico = b""
+mensajes_texto = {}
+mi_handle = SIN_HANDLE
+mi_epoca = 0
+secuencia = random.getrandbits(16)
+_trama = bytearray(8)
+_sock = None
+_sondeo = None
+ultimo_ping = 0
+resolicitud = None
+
+def mover(d_izq, d_der):
+    servo_izq.duty_u16(d_izq)
+    servo_der.duty_u16(d_der)
+
+def avanzar():
+    print("[ROBOT] Avanzando...")
+    mover(*AVANCE)
+
+def detener():
+    print("[ROBOT] Detenido.")
+    mover(*PARADA)
+
+def led_parpadeo(intervalo, veces=1):
+    for _ in range(veces):
+        led.on(); time.sleep(intervalo)
+        led.off(); time.sleep(intervalo)
+
+def conectar_wifi():
+    wlan = network.WLAN(network.STA_IF)
+    wlan.active(True)
+    if not wlan.isconnected():
+        wlan.connect(WIFI_SSID, WIFI_PASS)
+        while not wlan.isconnected():
+            time.sleep(0.5)
+            led_parpadeo(0.1, 1)
+    print("[ROBOT] WiFi conectado:", wlan.ifconfig())
+    led.on()
+
+def verificar_wifi():
+    wlan = network.WLAN(network.STA_IF)
+    if not wlan.isconnected():
+        print("[ROBOT] Reconectando WiFi...")
+        conectar_wifi()
+
+def trama(tipo, movimiento=0):
+    t = _trama
+    t[0] = MAGICO
+    t[1] = tipo
+    t[2] = movimiento
+    t[3] = mi_epoca
+    t[4] = mi_handle >> 8
+    t[5] = mi_handle & 0xFF
+    t[6] = secuencia >> 8
+    t[7] = secuencia & 0xFF
+    if mi_handle == SIN_HANDLE:
+        return t + mi_id
+    return t
+
+def es_mi_id(msg):
+    # Compara el id que sigue a la cabecera byte a byte, sin copiarlo.
+    n = len(mi_id)
+    if len(msg) != 8 + n:
+        return False
+    for i in range(n):
+        if msg[8 + i] != mi_id[i]:
+            return False
+    return True
+
+def leer_trama(msg):
+    # Devuelve la orden si la trama va dirigida a este robot; una trama con id
+    # le da a conocer su handle y la época del controlador. Indexa el mensaje
+    # sin copiarlo, así que vale igual para bytes o memoryview.
+    global mi_handle, mi_epoca
+    if len(msg) < 8 or msg[0] != MAGICO:
+        return None
+    h = msg[4] << 8 | msg[5]
+    if len(msg) > 8:
+        if not es_mi_id(msg):
+            return None
+        mi_handle = h
+        mi_epoca = msg[3]
+    elif h != mi_handle or msg[3] != mi_epoca:
+        return None
+    return ORDENES_BIN.get(msg[1])
+
+def codificar_mensajes():
+    # Los mensajes de texto de este robot no cambian: se codifican una vez y
+    # las respuestas se comparan como bytes, sin decodificarlas.
+    global mi_id, mi_topico
+    mi_id = CLIENT_ID.encode()
+    mi_topico = TOPICO_RESPUESTA + b"/" + mi_id
+    mensajes_texto["solicitud"] = mi_id + b":" + ROBOT_TIPO.encode()
+    mensajes_texto["franja"] = mi_id + b":franja:"
+    for m in ("llego", "cruce_liberado", "pasar", "expulsado", "prepararse"):
+        mensajes_texto[m] = mi_id + b":" + m.encode()
+    for zona in ZONAS:
+        mensajes_texto["libera:" + zona] = mi_id + b":libera:" + zona.encode()
+
+def nueva_solicitud():
+    # Cada cruce pide paso con un número nuevo; los reenvíos, reconexiones y
+    # resincronizaciones lo repiten para que el controlador los reconozca. Se
+    # empieza al azar para no repetir números tras un reinicio.
+    global secuencia
+    secuencia = (secuencia + 1) & 0xFFFF
+    mensajes_texto["numerada"] = mensajes_texto["solicitud"] + b"#" + str(secuencia).encode()
+
+def olvidar_handle():
+    global mi_handle
+    mi_handle = SIN_HANDLE
+
+def mensaje_solicitud(eta_ms=None):
+    if PROTOCOLO_BINARIO:
+        return trama(T_SOLICITUD, MOVIMIENTOS.index(ROBOT_TIPO))
+    if eta_ms is not None:
+        return mensajes_texto["solicitud"] + ("@%d+%d#%d" % (eta_ms, TIEMPO_CRUCE_MS, secuencia)).encode()
+    return mensajes_texto["numerada"]
+
+def mensaje_reporte(evento):
+    if PROTOCOLO_BINARIO:
+        if evento.startswith("libera:"):
+            return trama(T_LIBERA_ZONA, ZONAS.index(evento[7:]))
+        return trama(T_LLEGO if evento == "llego" else T_LIBERADO)
+    return mensajes_texto[evento]
+
+def figura(lista, robot_id):
+    # Busca robot_id entre los de una lista separada por comas, sin trocearla.
+    n = len(robot_id)
+    i = lista.find(robot_id)
+    while i >= 0:
+        if (i == 0 or lista[i - 1] == 44) and (i + n == len(lista) or lista[i + n] == 44):
+            return True
+        i = lista.find(robot_id, i + 1)
+    return False
+
+def programar_resolicitud(msg):
+    # Aviso de sync: "reanunciar[:<ventana ms>[:<robots recuperados>]]". Si el
+    # controlador no recuperó a este robot, repite la solicitud tras un
+    # retardo al azar dentro de la ventana; atender_red() la manda.
+    global resolicitud
+    partes = msg.split(b":", 2)
+    if len(partes) > 2 and figura(partes[2], mi_id):
+        print("[ROBOT] Sync recibido -> ya recuperado por el controlador")
+        return
+    ventana = int(partes[1]) if len(partes) > 1 and partes[1].isdigit() else 0
+    resolicitud = (ticks_ms(), random.getrandbits(16) % (ventana + 1))
+    print("[ROBOT] Sync recibido -> reenviando solicitud en", resolicitud[1], "ms")
+
+def procesar_mensaje(topic, msg):
+    global autorizado, esperando_autorizacion, armado, franja
+    if topic == mi_topico or topic == TOPICO_RESPUESTA or topic == TOPICO_RESPUESTA_BIN:
+        # Ningún mensaje de texto empieza por MAGICO.
+        if msg and msg[0] == MAGICO:
+            orden = leer_trama(msg)
+        elif msg == mensajes_texto["pasar"]:
+            orden = "pasar"
+        elif msg == mensajes_texto["expulsado"]:
+            orden = "expulsado"
+        elif msg == mensajes_texto["prepararse"]:
+            orden = "prepararse"
+        elif msg.startswith(mensajes_texto["franja"]):
+            orden = "franja"
+        else:
+            return
+    elif topic == TOPICO_SYNC:
+        # El controlador ha vuelto a arrancar: los handles ya no valen.
+        olvidar_handle()
+        if esperando_autorizacion:
+            programar_resolicitud(msg)
+        return
+    else:
+        return
+    if orden == "pasar":
+        print("[ROBOT] Permiso recibido -> pasar")
+        autorizado = True
+        esperando_autorizacion = False
+        if armado:
+            # Arranca desde el propio callback, sin volver al bucle de espera.
+            avanzar()
+    elif orden == "expulsado":
+        print("[ROBOT] Expulsado por timeout")
+        autorizado = False
+        esperando_autorizacion = False
+        armado = False
+    elif orden == "prepararse" and esperando_autorizacion:
+        print("[ROBOT] Preparado: el cruce se libera en breve")
+        armado = True
+    elif orden == "franja":
+        franja = (ticks_ms(), int(msg[len(mensajes_texto["franja"]):]))
+        print("[ROBOT] Franja recibida: entrar dentro de", franja[1], "ms")
+        autorizado = True
+        esperando_autorizacion = False
+
+def _suscribir_temas():
+    if RESPUESTAS_COMPARTIDAS:
+        client.subscribe(TOPICO_RESPUESTA, qos=1)
+        if PROTOCOLO_BINARIO:
+            client.subscribe(TOPICO_RESPUESTA_BIN, qos=1)
+    else:
+        client.subscribe(mi_topico, qos=1)
+    client.subscribe(TOPICO_SYNC, qos=1)
+
+def conectar_mqtt():
+    global client
+    verificar_wifi()
+    codificar_mensajes()
+    client = MQTTClient(client_id=CLIENT_ID.encode(), server=BROKER_IP, keepalive=60)
+    client.set_last_will(topic=TOPICO_REPORTES, msg=(CLIENT_ID + ":offline").encode(), retain=True, qos=1)
+    client.set_callback(lambda t, m: procesar_mensaje(t, m))
+    client.connect(clean_session=False)
+    _suscribir_temas()
+    client.publish(TOPICO_REPORTES, (CLIENT_ID + ":online").encode(), qos=1, retain=True)
+    print("[ROBOT] MQTT conectado y suscrito")
+
+def reconectar_mqtt():
+    while True:
+        try:
+            print("[ROBOT] Reconectando MQTT...")
+            client.connect(clean_session=False)
+            _suscribir_temas()
+            client.publish(TOPICO_REPORTES, (CLIENT_ID + ":online").encode(), qos=1, retain=True)
+            print("[ROBOT] MQTT reconectado")
+            return
+        except Exception as e:
+            print("[ROBOT] Fallo reconexión:", e)
+            time.sleep(2)
+
+def solicitar_cruce(eta_ms=None):
+    global esperando_autorizacion, autorizado
+    verificar_wifi()
+    autorizado = False
+    esperando_autorizacion = True
+    inicio = ticks_ms()
+    try:
+        mensaje = mensaje_solicitud(eta_ms)
+        client.publish(TOPICO_SOLICITUD, mensaje, qos=1)
+        print("[ROBOT] Solicitud enviada:", bytes(mensaje))
+    except Exception as e:
+        print("[ROBOT] Fallo al publicar solicitud, reconectando...", e)
+        reconectar_mqtt()
+        # La reserva sigue en pie, con lo que le quede para llegar a la línea.
+        if eta_ms is not None:
+            eta_ms = max(0, eta_ms - ticks_diff(ticks_ms(), inicio))
+        client.publish(TOPICO_SOLICITUD, mensaje_solicitud(eta_ms), qos=1)
+
+def atender_red(espera_ms):
+    # Espera hasta espera_ms en el socket MQTT y atiende lo que llegue; manda
+    # el ping cuando toca para que el broker no dé la sesión por perdida.
+    global _sock, _sondeo, ultimo_ping, resolicitud
+    if resolicitud is not None:
+        falta = resolicitud[1] - ticks_diff(ticks_ms(), resolicitud[0])
+        if falta <= 0:
+            resolicitud = None
+            if esperando_autorizacion:
+                solicitar_cruce()
+        else:
+            espera_ms = min(espera_ms, falta)
+    try:
+        if ticks_diff(ticks_ms(), ultimo_ping) >= PERIODO_PING_MS:
+            client.ping()
+            ultimo_ping = ticks_ms()
+        if client.sock is not _sock:
+            _sock = client.sock
+            _sondeo = select.poll()
+            _sondeo.register(_sock, select.POLLIN)
+        if _sondeo.poll(min(espera_ms, PERIODO_PING_MS)):
+            client.check_msg()
+    except Exception:
+        reconectar_mqtt()
+
+def ejecutar(plan):
+    # Recorre los tramos del plan. Entre un cambio de tramo y el siguiente
+    # espera en el socket en lugar de dormir; los plazos se cuentan desde el
+    # inicio del plan para que los retrasos no se acumulen.
+    inicio = ticks_ms()
+    fin = 0
+    for d_izq, d_der, ms, aviso in plan:
+        mover(d_izq, d_der)
+        fin += ms
+        restante = fin - ticks_diff(ticks_ms(), inicio)
+        while restante > 0:
+            atender_red(restante)
+            restante = fin - ticks_diff(ticks_ms(), inicio)
+        if aviso is not None:
+            avisar(aviso)
+
+def plan_aproximacion():
+    # Sin parar al final: con franja el robot entra en marcha.
+    return (AVANCE + (TIEMPO_APROXIMACION_MS, None),)
+
+def plan_cruce():
+    # El cruce se corta en cada aviso (libera:<zona>, llego) para mandarlo en
+    # su momento, y acaba parado.
+    avisos = [(ms, "libera:" + zona) for zona, ms in SALIDAS_ZONA.get(ROBOT_TIPO, ())]
+    avisos.append((TIEMPO_CRUCE_MS - AVISO_LLEGO_MS, "llego"))
+    avisos.sort()
+    plan = []
+    t = 0
+    for ms, evento in avisos:
+        plan.append(AVANCE + (max(0, ms - t), evento))
+        t = max(t, ms)
+    plan.append(AVANCE + (max(0, TIEMPO_CRUCE_MS - t), None))
+    plan.append(PARADA + (0, None))
+    return plan
+
+def esperar_autorizacion(resend_interval_s=60):
+    # Bloquea en el socket MQTT hasta el próximo reenvío: un pasar o un
+    # expulsado despiertan la espera en cuanto llegan.
+    global autorizado
+    print("[ROBOT] Esperando autorización...")
+    ultimo_envio = ticks_ms()
+    while not autorizado:
+        restante = resend_interval_s * 1000 - ticks_diff(ticks_ms(), ultimo_envio)
+        if restante <= 0:
+            print("[ROBOT] Timeout espera -> reenviando solicitud")
+            olvidar_handle()
+            solicitar_cruce()
+            ultimo_envio = ticks_ms()
+            continue
+        atender_red(restante)
+    return True
+
+def respetar_franja():
+    # Espera en la línea hasta que empiece la franja recibida y devuelve True.
+    # Si ya ha pasado, la devuelve con cruce_liberado, pide paso como siempre
+    # y devuelve False.
+    global franja
+    recibida, espera = franja
+    franja = None
+    falta = espera - ticks_diff(ticks_ms(), recibida)
+    if falta >= -TOLERANCIA_FRANJA_MS:
+        if falta > 0:
+            ejecutar((PARADA + (falta, None),))
+        return True
+    print("[ROBOT] Franja perdida -> solicitud normal")
+    detener()
+    reportar_liberado()
+    nueva_solicitud()
+    solicitar_cruce()
+    return False
+
+def aproximarse():
+    # Avanza TIEMPO_APROXIMACION_MS hasta la línea. Con RESERVA pide franja al
+    # empezar y la respuesta llega por el camino.
+    global franja
+    franja = None
+    nueva_solicitud()
+    if RESERVA and not PROTOCOLO_BINARIO:
+        solicitar_cruce(TIEMPO_APROXIMACION_MS)
+    ejecutar(plan_aproximacion())
+    if franja is not None:
+        if respetar_franja():
+            return
+    elif autorizado:
+        return
+    else:
+        detener()
+        if not esperando_autorizacion:
+            solicitar_cruce()
+    # La franja también puede llegar con el robot ya parado en la línea: se
+    # respeta su inicio igual que si hubiera llegado por el camino.
+    while True:
+        esperar_autorizacion(resend_interval_s=60)
+        if franja is None or respetar_franja():
+            return
+
+def avisar(evento):
+    # Avisos durante el cruce (libera:<zona>, llego). Si se pierde uno, el
+    # cruce_liberado del final lo cubre.
+    try:
+        client.publish(TOPICO_REPORTES, mensaje_reporte(evento), qos=1)
+        print("[ROBOT] Reporte", evento, "enviado")
+    except Exception as e:
+        print("[ROBOT] Error publicando", evento + ":", e)
+        reconectar_mqtt()
+
+def cruzar():
+    # Un robot armado ya arrancó al recibir el pasar; el primer tramo lo
+    # mantiene en marcha.
+    global armado
+    armado = False
+    ejecutar(plan_cruce())
+
+def reportar_liberado():
+    verificar_wifi()
+    try:
+        client.publish(TOPICO_REPORTES, mensaje_reporte("cruce_liberado"), qos=1)
+        print("[ROBOT] Reporte cruce_liberado enviado")
+    except Exception as e:
+        print("[ROBOT] Error publicando reportes:", e)
+        reconectar_mqtt()
+        client.publish(TOPICO_REPORTES, mensaje_reporte("cruce_liberado"), qos=1)
+
+def main():
+    global en_cruce
+    configurar_topicos()
+    detener()
+    conectar_wifi()
+    conectar_mqtt()
+    aproximarse()
+    en_cruce = True
+    cruzar()
+    reportar_liberado()
+    en_cruce = False
+    print("[ROBOT] Cruce completado.")
+    ejecutar(PLAN_SALIDA)
+    try:
+        client.disconnect()
+        print("[ROBOT] Desconectado del broker MQTT.")
+    except Exception as e:
+        print("[ROBOT] Error al desconectar:", e)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Anfitrión de controladores: muchos cruces en un PC, repartidos en procesos.
+
+Cada cruce es una instancia del controlador del Escenario 3 o 4, cargada sin
+tocar el script, con su CRUCE_ID y un CLIENT_ID propio: sus topics
+(cruce/<id>/..., robots/<id>/solicitar_estado), sus colas y su estado
+retenido son solo suyos. Los cruces se reparten por turnos entre --procesos
+procesos de trabajo; dentro de cada proceso, cada cruce corre en su hilo con
+su propio bucle asyncio y su conexión al broker. Los controladores todavía
+bloquean en algunos sitios (time.sleep al reconectar, la espera de los
+retenidos al arrancar, el PUBACK de cada publish con QoS 1): en su hilo, eso
+solo para a su cruce y no a los demás del proceso. Como el estado de cada cruce
+está en sus topics retenidos, un cruce puede pasar a otro proceso al
+cambiar el reparto.
+
+    python herramientas/anfitrion.py --escenario 4 --cruces 32 --procesos 4 --broker 127.0.0.1:1883
+    python herramientas/anfitrion.py --escenario 3 --cruces norte,sur --broker 192.168.1.10:1883
+
+--cruces es un número (c1 ... cN) o una lista de identificadores. Los
+Escenarios 1 y 2 tienen un bucle bloqueante por controlador, así que cada
+cruce de esos es un proceso: ejecutar.py con --fijar CRUCE_ID=c1.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+
+from ejecutar import etiquetar, fijar, leer_constantes
+from entorno import CONTROLADORES, cargar
+
+
+def nombres_cruces(texto):
+    if texto.isdigit():
+        return [f"c{i}" for i in range(1, int(texto) + 1)]
+    return [c for c in texto.split(",") if c]
+
+
+def repartir(cruces, procesos):
+    return [cruces[i::procesos] for i in range(procesos) if cruces[i::procesos]]
+
+
+def instanciar(escenario, cruce, constantes, verboso):
+    modulo = cargar(CONTROLADORES[escenario], f"controlador_{cruce}")
+    fijar(modulo, constantes)
+    modulo.CRUCE_ID = cruce
+    modulo.CLIENT_ID = modulo.CLIENT_ID + b"_" + cruce.encode()
+    if verboso:
+        etiquetar(modulo, cruce)
+    else:
+        modulo.print = lambda *args, **kwargs: None
+    return modulo
+
+
+def correr(modulo):
+    asyncio.run(modulo.principal())
+
+
+def servir(escenario, cruces, constantes, verboso):
+    hilos = [threading.Thread(target=correr, args=(instanciar(escenario, c, constantes, verboso),),
+                              name=f"cruce_{c}", daemon=True) for c in cruces]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--escenario", type=int, choices=(3, 4), required=True)
+    parser.add_argument("--cruces", default="4", help="número de cruces o lista de identificadores")
+    parser.add_argument("--procesos", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--broker", default="127.0.0.1:1883", help="host:puerto del broker")
+    parser.add_argument("--fijar", action="append", default=[], metavar="NOMBRE=valor",
+                        help="cambia una constante de todos los controladores")
+    parser.add_argument("--verboso", action="store_true", help="muestra la salida de los controladores")
+    args = parser.parse_args()
+
+    os.environ["SHIM_BROKER"] = args.broker
+    constantes = leer_constantes(args.fijar)
+    procesos = []
+    for i, cruces in enumerate(repartir(nombres_cruces(args.cruces), args.procesos)):
+        print(f"Proceso {i}: {len(cruces)} cruces ({', '.join(cruces)})")
+        proceso = multiprocessing.Process(target=servir, name=f"anfitrion{i}",
+                                          args=(args.escenario, cruces, constantes, args.verboso))
+        proceso.start()
+        procesos.append(proceso)
+
+    # Al terminar el anfitrión (Ctrl+C o SIGTERM) terminan también sus procesos.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        for proceso in procesos:
+            proceso.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proceso in procesos:
+            proceso.terminate()
+            proceso.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+"""Benchmark de los manejadores de los cuatro controladores.
+
+Alimenta con un cliente falso sub_cb (Escenarios 1 y 2), procesar_mensaje y
+revisar_timeout (Escenario 3) y procesar_mensaje, liberar_recursos y
+reasignar_esperas (Escenario 4). Para cada profundidad de cola mide la
+latencia de cada manejador, la memoria que reserva cada mensaje (tracemalloc),
+la que reserva cada manejador por separado del volcado del estado y el
+rendimiento sostenido. Los resultados se guardan en JSON para comparar una
+ejecución con otra:
+
+    python herramientas/bench_controladores.py --json base.json
+    python herramientas/bench_controladores.py --json nuevo.json --comparar base.json
+
+Con --procesos mide además anfitrion.py de verdad, con broker_mqtt.py y un
+enjambre (enjambre.py) de robots que cruzan sin demora repartidos entre
+--cruces cruces, para cada número de procesos de la lista. Con
+--profundidades vacío solo se hace esta medida:
+
+    python herramientas/bench_controladores.py --escenarios 4 --profundidades "" --procesos 1,2,4
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+
+from bench_resincronizacion import puerto_libre
+from enjambre import Enjambre, lanzar_procesos
+from entorno import RAIZ, cargar_controlador, silencio
+
+TIPOS = ("vertical_A", "vertical_B", "horizontal")
+# En el Escenario 3, uno de cada PERIODO_TIMEOUT ciclos el activo agota su
+# plazo en lugar de liberar el cruce.
+PERIODO_TIMEOUT = 10
+
+
+class Conductor:
+    """Mantiene un controlador con `profundidad` robots esperando y genera el
+    siguiente mensaje según a quién haya concedido el paso."""
+
+    def __init__(self, escenario, profundidad, semilla):
+        self.escenario = escenario
+        self.c = cargar_controlador(escenario, f"c{escenario}_bench_{profundidad}")
+        self.c.client.publish = self._publicar
+        self.atender = self.c.sub_cb if escenario <= 2 else self.c.procesar_mensaje
+        # Los controladores que agrupan el estado lo publican al final de cada
+        # pasada del bucle; aquí cada mensaje cuenta como una pasada.
+        self.volcar = getattr(self.c, "volcar_estado", None)
+        self.rnd = random.Random(semilla)
+        self.activos = []
+        self._ids_pasar = {}
+        self.ciclos = 0
+        with silencio():
+            if escenario == 4:
+                self.solicitud("activo_A", "vertical_A")
+                self.solicitud("activo_B", "vertical_B")
+                for i in range(profundidad):
+                    for tipo in TIPOS:
+                        self.solicitud(f"{tipo}_{i}", tipo)
+            else:
+                for i in range(profundidad + 1):
+                    self.solicitud(f"r{i}")
+
+    def manejador(self, topic, msg):
+        self.atender(topic, msg)
+        if self.volcar is not None:
+            self.volcar()
+
+    def revisar_timeout(self):
+        self.c.revisar_timeout()
+        if self.volcar is not None:
+            self.volcar()
+
+    def _publicar(self, topic, msg, retain=False, qos=0):
+        if topic.startswith(self.c.TOPICO_RESPUESTA) and msg.endswith(b":pasar"):
+            # Sin reservar memoria una vez visto cada permiso, para no
+            # contarla en el manejador que publica.
+            robot_id = self._ids_pasar.get(msg)
+            if robot_id is None:
+                robot_id = self._ids_pasar[bytes(msg)] = msg[:-6].decode()
+            self.activos.append(robot_id)
+
+    def solicitud(self, robot_id, tipo=None):
+        self.manejador(*self.mensaje_solicitud(robot_id, tipo))
+
+    def mensaje_solicitud(self, robot_id, tipo=None):
+        # Cada mensaje es un objeto nuevo, como los que entrega el cliente MQTT.
+        if self.escenario == 4:
+            return self.c.TOPICO_SOLICITUD, f"{robot_id}:{tipo}".encode()
+        return self.c.TOPICO_SOLICITUD, f"{robot_id}:solicitud".encode()
+
+    def mensaje_reporte(self, robot_id):
+        return self.c.TOPICO_REPORTES, f"{robot_id}:cruce_liberado".encode()
+
+    def operaciones(self):
+        # Un ciclo: el activo libera el cruce (o agota su plazo) y vuelve a
+        # pedir paso, de modo que la profundidad de las colas se mantiene.
+        self.ciclos += 1
+        if self.escenario == 4:
+            robot_id = self.activos.pop(self.rnd.randrange(len(self.activos)))
+            yield "reporte", self.manejador, self.mensaje_reporte(robot_id)
+            yield "solicitud", self.manejador, self.mensaje_solicitud(robot_id, self.rnd.choice(TIPOS))
+            return
+        robot_id = self.activos.pop(0)
+        if self.escenario == 3 and self.ciclos % PERIODO_TIMEOUT == 0:
+            self.c.plazos.programar(self.c.registro.buscar(robot_id), 0)
+            yield "timeout", self.revisar_timeout, ()
+        else:
+            yield "reporte", self.manejador, self.mensaje_reporte(robot_id)
+        if self.escenario == 3:
+            yield "revisar_timeout", self.revisar_timeout, ()
+        yield "solicitud", self.manejador, self.mensaje_solicitud(robot_id)
+
+    def secuencia(self, mensajes):
+        # Cuenta solo los mensajes MQTT; los revisar_timeout del Escenario 3
+        # acompañan a cada mensaje como en el bucle del controlador.
+        enviados = 0
+        while enviados < mensajes:
+            for nombre, funcion, args in self.operaciones():
+                if nombre in ("reporte", "solicitud"):
+                    enviados += 1
+                yield nombre, funcion, args
+
+
+def cronometrar(modulo, nombre, muestras):
+    # Sustituye una función global del módulo por una versión que anota su
+    # duración; las llamadas internas del controlador pasan por ella.
+    original = getattr(modulo, nombre)
+
+    def medida(*args):
+        t0 = time.perf_counter_ns()
+        try:
+            return original(*args)
+        finally:
+            muestras[nombre].append(time.perf_counter_ns() - t0)
+
+    setattr(modulo, nombre, medida)
+
+
+def resumir(valores_ns):
+    valores = sorted(valores_ns)
+    n = len(valores)
+    return {
+        "n": n,
+        "media_us": round(sum(valores) / n / 1000, 2),
+        "p50_us": round(valores[n // 2] / 1000, 2),
+        "p99_us": round(valores[min(n - 1, int(n * 0.99))] / 1000, 2),
+        "max_us": round(valores[-1] / 1000, 2),
+    }
+
+
+def medir_latencia(escenario, profundidad, mensajes, semilla):
+    conductor = Conductor(escenario, profundidad, semilla)
+    muestras = collections.defaultdict(list)
+    if escenario == 4:
+        cronometrar(conductor.c, "liberar_recursos", muestras)
+        cronometrar(conductor.c, "reasignar_esperas", muestras)
+    reloj = time.perf_counter_ns
+    with silencio():
+        for nombre, funcion, args in conductor.secuencia(mensajes):
+            t0 = reloj()
+            funcion(*args)
+            muestras[nombre].append(reloj() - t0)
+    return {nombre: resumir(v) for nombre, v in sorted(muestras.items())}
+
+
+def medir_memoria(escenario, profundidad, mensajes, semilla):
+    conductor = Conductor(escenario, profundidad, semilla)
+    pico = retenido = n = 0
+    tracemalloc.start()
+    try:
+        with silencio():
+            for nombre, funcion, args in conductor.secuencia(mensajes):
+                tracemalloc.reset_peak()
+                antes = tracemalloc.get_traced_memory()[0]
+                funcion(*args)
+                actual, maximo = tracemalloc.get_traced_memory()
+                pico += maximo - antes
+                retenido += actual - antes
+                n += 1
+    finally:
+        tracemalloc.stop()
+    return {"pico_B_por_llamada": round(pico / n, 1), "retenido_B_por_llamada": round(retenido / n, 1)}
+
+
+def reservado(funcion, args, base=0):
+    tracemalloc.reset_peak()
+    antes = tracemalloc.get_traced_memory()[0]
+    funcion(*args)
+    return max(0, tracemalloc.get_traced_memory()[1] - antes - base)
+
+
+def medir_asignaciones(escenario, profundidad, mensajes, semilla):
+    # Memoria que reserva cada manejador, con volcar_estado medido aparte y
+    # descontando lo que reserva la propia medida (una llamada vacía). Los
+    # print del controlador no cuentan: en la placa escriben en la UART sin
+    # reservar memoria.
+    conductor = Conductor(escenario, profundidad, semilla)
+    conductor.c.print = lambda *args, **kwargs: None
+    volcar, conductor.volcar = conductor.volcar, None
+    muestras = collections.defaultdict(list)
+    tracemalloc.start()
+    try:
+        base = min(reservado(len, ((),)) for _ in range(10))
+        for nombre, funcion, args in conductor.secuencia(mensajes):
+            muestras[nombre].append(reservado(funcion, args, base))
+            if volcar is not None:
+                muestras["volcar_estado"].append(reservado(volcar, (), base))
+    finally:
+        tracemalloc.stop()
+    return {nombre: {"B_por_llamada": round(sum(v) / len(v), 1),
+                     "llamadas_sin_reserva": round(v.count(0) / len(v), 3)}
+            for nombre, v in sorted(muestras.items())}
+
+
+def medir_rendimiento(escenario, profundidad, mensajes, semilla):
+    conductor = Conductor(escenario, profundidad, semilla)
+    with silencio():
+        t0 = time.perf_counter()
+        for nombre, funcion, args in conductor.secuencia(mensajes):
+            funcion(*args)
+        segundos = time.perf_counter() - t0
+    return round(mensajes / segundos, 1)
+
+
+def medir_anfitrion(escenario, procesos, cruces, robots, ciclos, semilla):
+    # Cruces por minuto de anfitrion.py con `procesos` procesos. Cada medida
+    # arranca su propio broker y su anfitrión; los robots cruzan sin demora,
+    # así que el límite lo ponen los controladores.
+    puerto = puerto_libre()
+    nombres = [f"c{i}" for i in range(1, cruces + 1)]
+    lanzados = lanzar_procesos(escenario, puerto, cruces=nombres, procesos=procesos)
+    try:
+        enjambre = Enjambre(escenario, "127.0.0.1", puerto, robots, ciclos=ciclos, tiempo_cruce=0,
+                            semilla=semilla, cruces=nombres)
+        informe = asyncio.run(enjambre.ejecutar(120))
+    finally:
+        for proceso in lanzados:
+            proceso.terminate()
+            proceso.wait()
+    return {
+        "escenario": escenario,
+        "procesos": procesos,
+        "cruces": cruces,
+        "robots": robots,
+        "cruces_por_minuto": informe["cruces_por_minuto"],
+        "sin_terminar": informe["sin_terminar"],
+        "latencia_ms": informe["latencia_ms"],
+    }
+
+
+def revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=RAIZ,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def comparar(resultados, anterior):
+    previos = {(r["escenario"], r["profundidad"]): r for r in anterior["resultados"]}
+    print()
+    print(f"Comparación con {anterior.get('commit') or 'la ejecución anterior'}:")
+    print(f"{'esc':>3} {'prof':>6} {'msg/s antes':>12} {'msg/s ahora':>12} {'cambio':>7}")
+    for r in resultados:
+        previo = previos.get((r["escenario"], r["profundidad"]))
+        if previo is None:
+            continue
+        antes, ahora = previo["mensajes_por_s"], r["mensajes_por_s"]
+        print(f"{r['escenario']:>3} {r['profundidad']:>6} {antes:>12.0f} {ahora:>12.0f} {ahora / antes:>6.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--escenarios", default="1,2,3,4")
+    parser.add_argument("--profundidades", default="1,10,100,1000,10000")
+    parser.add_argument("--mensajes", type=int, default=1000, help="mensajes por medida")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--json", help="fichero donde guardar los resultados")
+    parser.add_argument("--comparar", help="resultados JSON de una ejecución anterior")
+    parser.add_argument("--procesos", default="",
+                        help="procesos de anfitrion.py a comparar en los Escenarios 3 y 4, p. ej. 1,2,4")
+    parser.add_argument("--cruces", type=int, default=8, help="cruces alojados en anfitrion.py")
+    parser.add_argument("--robots", type=int, default=400, help="robots del enjambre para anfitrion.py")
+    parser.add_argument("--ciclos", type=int, default=5, help="cruces por robot para anfitrion.py")
+    args = parser.parse_args()
+    escenarios = [int(e) for e in args.escenarios.split(",") if e]
+    profundidades = [int(p) for p in args.profundidades.split(",") if p]
+
+    resultados = []
+    if profundidades:
+        print(f"{'esc':>3} {'prof':>6} {'msg/s':>9} {'B/llamada':>10}  latencia p50/p99 (us)")
+    for escenario in escenarios:
+        for profundidad in profundidades:
+            medida = (escenario, profundidad, args.mensajes, args.semilla)
+            r = {
+                "escenario": escenario,
+                "profundidad": profundidad,
+                "mensajes_por_s": medir_rendimiento(*medida),
+                "latencia": medir_latencia(*medida),
+                "memoria": medir_memoria(*medida),
+                "asignaciones": medir_asignaciones(*medida),
+            }
+            resultados.append(r)
+            lat = "  ".join(f"{k} {v['p50_us']}/{v['p99_us']}" for k, v in r["latencia"].items())
+            print(f"{escenario:>3} {profundidad:>6} {r['mensajes_por_s']:>9.0f} "
+                  f"{r['memoria']['pico_B_por_llamada']:>10.0f}  {lat}")
+            reservas = "  ".join(f"{k} {v['B_por_llamada']:.0f}" for k, v in r["asignaciones"].items())
+            print(f"{'':>31}B reservados: {reservas}")
+
+    anfitrion = []
+    if args.procesos:
+        print()
+        print(f"anfitrion.py: {args.cruces} cruces, {args.robots} robots x {args.ciclos} cruces, "
+              f"{os.cpu_count()} núcleos")
+        print(f"{'esc':>3} {'procesos':>8} {'cruces/min':>10} {'aceleración':>11}  latencia p50/p99 (ms)")
+    for escenario in (e for e in escenarios if e >= 3 and args.procesos):
+        base = None
+        for procesos in (int(p) for p in args.procesos.split(",")):
+            r = medir_anfitrion(escenario, procesos, args.cruces, args.robots, args.ciclos, args.semilla)
+            anfitrion.append(r)
+            base = base or r["cruces_por_minuto"]
+            lat = r["latencia_ms"]
+            print(f"{escenario:>3} {procesos:>8} {r['cruces_por_minuto']:>10.0f} "
+                  f"{r['cruces_por_minuto'] / base:>10.2f}x  {lat['p50']}/{lat['p99']}"
+                  + (f"  sin terminar: {r['sin_terminar']}" if r["sin_terminar"] else ""))
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            comparar(resultados, json.load(f))
+    if args.json:
+        salida = {
+            "fecha": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": revision(),
+            "python": platform.python_version(),
+            "parametros": {"mensajes": args.mensajes, "semilla": args.semilla},
+            "resultados": resultados,
+            "anfitrion": anfitrion,
+        }
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(salida, f, indent=2, ensure_ascii=False)
+        print(f"Resultados guardados en {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Mensajes por segundo que atiende el bucle principal de cada controlador.
+
+Se deja una ráfaga de solicitudes y liberaciones pendiente en el cliente y se
+mide el ritmo al que el bucle la vacía, con el bucle original (un check_msg()
+y una pausa por vuelta) y con drenar_mensajes() (pausa solo si no hay nada).
+
+    python herramientas/bench_drenado.py [--mensajes 2000] [--ventana 3]
+"""
+import argparse
+import time
+
+from entorno import cargar_controlador, silencio
+
+PAUSAS = {1: 0.1, 2: 0.1, 3: 0.5, 4: 0.1}
+
+
+def rafaga(escenario, n):
+    tipo = b"vertical_A" if escenario == 4 else b"solicitud"
+    mensajes = []
+    for i in range(n // 2):
+        mensajes.append((b"cruce/solicitud", b"robot%d:%s" % (i, tipo)))
+        mensajes.append((b"cruce/reportes", b"robot%d:cruce_liberado" % i))
+    return mensajes
+
+
+def preparar(escenario, n, nombre):
+    c = cargar_controlador(escenario, nombre)
+    c.client.set_callback(getattr(c, "sub_cb", None) or getattr(c, "procesar_mensaje"))
+    for topic, msg in rafaga(escenario, n):
+        c.client.entregar(topic, msg)
+    return c
+
+
+def medir_original(escenario, n, ventana):
+    c = preparar(escenario, n, f"c{escenario}_original")
+    pausa = PAUSAS[escenario]
+    t0 = time.perf_counter()
+    with silencio():
+        while c.client.entrantes and time.perf_counter() - t0 < ventana:
+            c.client.check_msg()
+            time.sleep(pausa)
+    atendidos = n - len(c.client.entrantes)
+    return atendidos / (time.perf_counter() - t0)
+
+
+def medir_drenado(escenario, n):
+    c = preparar(escenario, n, f"c{escenario}_drenado")
+    t0 = time.perf_counter()
+    with silencio():
+        while True:
+            pendiente = c.drenar_mensajes()
+            if not c.client.entrantes:
+                break
+            if not pendiente:
+                time.sleep(PAUSAS[escenario])
+    return n / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mensajes", type=int, default=2000)
+    parser.add_argument("--ventana", type=float, default=3.0,
+                        help="segundos que se deja correr el bucle original")
+    args = parser.parse_args()
+
+    print(f"{'escenario':>9} {'original (msg/s)':>17} {'drenado (msg/s)':>16}")
+    for escenario in (1, 2, 3, 4):
+        original = medir_original(escenario, args.mensajes, args.ventana)
+        drenado = medir_drenado(escenario, args.mensajes)
+        print(f"{escenario:>9} {original:>17.1f} {drenado:>16.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Publicaciones que se ahorra un controlador de los Escenarios 3 y 4 con las solicitudes numeradas.
+
+Lanza broker_mqtt.py y el controlador en procesos aparte y le echa encima un
+enjambre (enjambre.py) que repite mucho la solicitud: reenvía cada --reenvio
+segundos sin permiso y la mitad de los robots se cae y vuelve mientras
+espera, con lo que repite la solicitud al reconectar y el broker le reenvía
+las que tenía a medias. Se hace dos veces, con las solicitudes sin numerar
+(--sin-numero de enjambre.py) y numeradas. Un observador cuenta lo que
+publica el controlador: respuestas a los robots, estado retenido y avisos
+de timeout. Como los dos enjambres no cruzan exactamente lo mismo, la
+comparación se hace por cruce completado. Antes, con el controlador cargado
+en el propio proceso, se comprueba que un robot expulsado por timeout que
+vuelve con el mismo número recibe el pasar.
+
+    python herramientas/bench_duplicados.py
+    python herramientas/bench_duplicados.py --escenario 4 --robots 500 --reenvio 0.1
+"""
+import argparse
+import asyncio
+
+from bench_resincronizacion import puerto_libre
+from enjambre import ClienteMQTT, Enjambre, lanzar_procesos, topicos
+from entorno import cargar_controlador, silencio
+
+
+class Contador:
+    # Cuenta por tipo lo que publica el controlador. Se suscribe antes de
+    # empezar y descarta lo que le llega al suscribirse (retenidos).
+    def __init__(self, puerto):
+        self.cuentas = {"respuestas": 0, "estado": 0, "timeout": 0}
+        self.activo = False
+        self.cliente = ClienteMQTT("127.0.0.1", puerto, b"bench_duplicados", self.al_mensaje)
+
+    def al_mensaje(self, topic, msg):
+        if not self.activo:
+            return
+        if topic.startswith(b"cruce/respuesta/"):
+            self.cuentas["respuestas"] += 1
+        elif topic.startswith(b"cruce/estado/"):
+            self.cuentas["estado"] += 1
+        elif topic == topicos("")[2] and (msg.endswith(b":timeout") or msg.endswith(b":expulsado")):
+            self.cuentas["timeout"] += 1
+
+    async def suscribir(self):
+        await self.cliente.conectar()
+        for topic in (b"cruce/respuesta/#", b"cruce/estado/#", topicos("")[2]):
+            await self.cliente.suscribir(topic, 1)
+        await asyncio.sleep(0.5)
+        self.activo = True
+
+
+def verificar(escenario):
+    # Pide paso, repite, agota el plazo y vuelve con el mismo número: la
+    # repetida solo reenvía el pasar y la expulsión olvida el número, así que
+    # la última cuenta como nueva.
+    c = cargar_controlador(escenario, f"c{escenario}_duplicados")
+    tipo = "vertical_A" if escenario == 4 else "solicitud"
+    msg = f"robot1:{tipo}#7".encode()
+    with silencio():
+        c.procesar_mensaje(c.TOPICO_SOLICITUD, msg)
+        c.procesar_mensaje(c.TOPICO_SOLICITUD, msg)
+        h = c.registro.buscar("robot1")
+        c.plazos.programar(h, 0)
+        c.revisar_timeout()
+        c.volcar_estado()
+        antes = len(c.client.publicados)
+        c.procesar_mensaje(c.TOPICO_SOLICITUD, msg)
+        c.volcar_estado()
+    pasar = [m for t, m in c.client.publicados if t == c.registro.topico(h) and m == b"robot1:pasar"]
+    if len(pasar) != 3 or c.registro.ubicacion[h] != c.ACTIVO or len(c.client.publicados) == antes:
+        raise SystemExit("Un robot expulsado que repite su número no recibe el pasar")
+
+
+async def contar(args, puerto, numerar):
+    contador = Contador(puerto)
+    await contador.suscribir()
+    enjambre = Enjambre(args.escenario, "127.0.0.1", puerto, args.robots, ciclos=args.ciclos,
+                        tiempo_cruce=args.cruce, reenvio=args.reenvio, desconexiones=args.desconexiones,
+                        ventana_corte=args.ventana_corte, reconexion=args.reconexion,
+                        semilla=args.semilla, numerar=numerar)
+    informe = await enjambre.ejecutar(args.duracion)
+    await asyncio.sleep(0.5)
+    contador.cliente.cortar()
+    return informe, contador.cuentas
+
+
+def medir(args, numerar):
+    puerto = puerto_libre()
+    procesos = lanzar_procesos(args.escenario, puerto)
+    try:
+        return asyncio.run(contar(args, puerto, numerar))
+    finally:
+        for proceso in procesos:
+            proceso.terminate()
+            proceso.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--escenario", type=int, choices=(3, 4), default=3)
+    parser.add_argument("--robots", type=int, default=200)
+    parser.add_argument("--ciclos", type=int, default=3, help="cruces por robot")
+    parser.add_argument("--cruce", type=float, default=0.02, help="segundos ocupando el cruce")
+    parser.add_argument("--reenvio", type=float, default=0.5, help="segundos sin permiso antes de repetir")
+    parser.add_argument("--desconexiones", type=float, default=0.5,
+                        help="probabilidad de que un robot se caiga mientras espera")
+    parser.add_argument("--ventana-corte", type=float, default=1.0)
+    parser.add_argument("--reconexion", type=float, default=0.1)
+    parser.add_argument("--duracion", type=float, default=120)
+    parser.add_argument("--semilla", type=int, default=1)
+    args = parser.parse_args()
+
+    verificar(args.escenario)
+    print("Verificación: el expulsado que repite su número recibe el pasar")
+    print(f"Escenario {args.escenario}: {args.robots} robots x {args.ciclos} cruces, reenvío cada "
+          f"{args.reenvio} s, {args.desconexiones:.0%} se caen esperando")
+    print(f"{'solicitudes':<11} {'cruces':>6} {'reenvíos':>8} {'cortes':>6} {'respuestas':>10} {'estado':>6} "
+          f"{'timeout':>7} {'por cruce':>9} {'p99 (ms)':>9}")
+    por_cruce = {}
+    for numerar in (False, True):
+        informe, cuentas = medir(args, numerar)
+        total = sum(cuentas.values())
+        por_cruce[numerar] = total / informe["cruces"] if informe["cruces"] else float("nan")
+        print(f"{'numeradas' if numerar else 'sin número':<11} {informe['cruces']:>6} {informe['reenvios']:>8} "
+              f"{informe['cortes']:>6} {cuentas['respuestas']:>10} {cuentas['estado']:>6} {cuentas['timeout']:>7} "
+              f"{por_cruce[numerar]:>9.2f} {informe['latencia_ms']['p99']:>9}")
+    ahorro = por_cruce[False] - por_cruce[True]
+    print(f"Ahorro: {ahorro:.2f} publicaciones por cruce ({ahorro / por_cruce[False]:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Latencia entre la llegada de un pasar y el fin de la espera del robot.
+
+Un hilo entrega el permiso al cliente del robot tras un retardo aleatorio y se
+mide cuánto tarda en volver la espera: con el bucle original (check_msg() y
+time.sleep(0.1)) y con la espera bloqueante sobre el socket del script actual.
+
+    python herramientas/bench_espera_robot.py [--muestras 30]
+"""
+import argparse
+import random
+import statistics
+import threading
+import time
+
+from entorno import cargar_robot, silencio
+
+
+def esperar_sondeando(r):
+    # Bucle de espera anterior de robot_escenario3.py, sin el reenvío.
+    while not r.autorizado:
+        r.client.check_msg()
+        time.sleep(0.1)
+
+
+def muestra(r, esperar, rnd):
+    r.autorizado = False
+    r.esperando_autorizacion = True
+    entrega = [0.0]
+
+    def conceder():
+        time.sleep(rnd.uniform(0.01, 0.2))
+        entrega[0] = time.perf_counter()
+        r.client.entregar(r.mi_topico, r.mensajes_texto["pasar"])
+
+    hilo = threading.Thread(target=conceder)
+    hilo.start()
+    esperar(r)
+    fin = time.perf_counter()
+    hilo.join()
+    return (fin - entrega[0]) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--muestras", type=int, default=30)
+    parser.add_argument("--semilla", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'espera':>11} {'media (ms)':>11} {'p95 (ms)':>9} {'max (ms)':>9}")
+    for escenario in (3, 4):
+        r = cargar_robot(escenario, f"robot{escenario}_bench")
+        r.codificar_mensajes()
+        for nombre, esperar in (("sondeo", esperar_sondeando),
+                                ("bloqueante", lambda r: r.esperar_autorizacion())):
+            rnd = random.Random(args.semilla)
+            with silencio():
+                lat = sorted(muestra(r, esperar, rnd) for _ in range(args.muestras))
+            p95 = lat[int(0.95 * (len(lat) - 1))]
+            print(f"E{escenario} {nombre:>8} {statistics.mean(lat):>11.2f} {p95:>9.2f} {lat[-1]:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""Compara el protocolo de texto con el binario de los Escenarios 3 y 4.
+
+Mide los bytes que ocupa cada mensaje en la red (paquete PUBLISH con QoS 1,
+topic incluido) y lo que cuesta leerlo en el controlador y en el robot: tiempo
+por mensaje y bytes reservados. Solo usa lo que también tiene MicroPython, así
+que se ejecuta igual en el PC y en la placa:
+
+    python herramientas/bench_protocolo.py [iteraciones]
+    mpremote run herramientas/bench_protocolo.py
+
+Las funciones de lectura son copia de las de los scripts de los escenarios,
+que no se pueden importar en la placa sin arrancarlos. Los controladores
+recuerdan los mensajes de texto ya troceados, así que la medida del texto es
+la de un mensaje repetido; la primera vez cuesta como antes.
+"""
+import gc
+import sys
+import time
+
+try:
+    from time import ticks_us, ticks_diff
+except ImportError:
+    def ticks_us():
+        return time.perf_counter_ns() // 1000
+
+    def ticks_diff(a, b):
+        return a - b
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+TOPICO_SOLICITUD     = b"cruce/solicitud"
+TOPICO_RESPUESTA     = b"cruce/respuesta/robot3"
+TOPICO_REPORTES      = b"cruce/reportes"
+
+MAGICO      = 0xFF
+T_SOLICITUD = 1
+T_PASAR     = 2
+T_ESPERAR   = 3
+T_LLEGO     = 4
+T_LIBERADO  = 5
+SIN_HANDLE  = 0xFFFF
+TEXTO          = 0
+BINARIO        = 1
+BINARIO_CON_ID = 2
+MOVIMIENTOS = (None, "vertical_A", "vertical_B", "horizontal")
+ORDENES_BIN = {2: "pasar", 3: "esperar", 6: "expulsado"}
+EPOCA = 0x5A
+
+CLIENT_ID = "robot3"
+mi_id = CLIENT_ID.encode()
+mi_handle = 2
+mi_epoca = EPOCA
+
+# Estado del controlador: cuatro robots registrados, todos binarios.
+ids = ["robot1", "robot2", "robot3", "robot4"]
+handles = {r: h for h, r in enumerate(ids)}
+protocolo = [BINARIO] * len(ids)
+secuencia = [0] * len(ids)
+solicitudes_leidas = {}
+reportes_leidos = {}
+mensajes_texto = {"pasar": b"robot3:pasar", "expulsado": b"robot3:expulsado"}
+
+
+def trama(tipo, h, movimiento=0, secuencia=1, epoca=EPOCA, robot_id=None):
+    t = bytes((MAGICO, tipo, movimiento, epoca, h >> 8, h & 0xFF, secuencia >> 8, secuencia & 0xFF))
+    if robot_id is not None:
+        t += robot_id.encode()
+    return t
+
+
+# --- Controlador -------------------------------------------------------------
+
+def c_solicitud_texto(msg):
+    h = solicitudes_leidas.get(msg)
+    if h is None:
+        h = solicitudes_leidas[msg] = handles.get(msg.decode().split(":", 1)[0].strip())
+    return h
+
+
+def c_solicitud_texto_e4(msg):
+    leido = solicitudes_leidas.get(msg)
+    if leido is None:
+        robot_id, tipo = msg.decode().split(":", 1)
+        leido = solicitudes_leidas[msg] = (handles.get(robot_id.strip()), tipo.strip())
+    return leido
+
+
+def c_reporte_texto(msg):
+    leido = reportes_leidos.get(msg)
+    if leido is None:
+        leido = reportes_leidos[msg] = msg.decode().split(":", 1)
+    origen, evento = leido
+    return evento == "cruce_liberado" and origen == "robot3"
+
+
+def c_leer_trama(msg):
+    if len(msg) < 8:
+        return None, 0, SIN_HANDLE
+    if len(msg) > 8:
+        h = handles[bytes(msg[8:]).decode()]
+        protocolo[h] = BINARIO_CON_ID
+    else:
+        h = msg[4] << 8 | msg[5]
+        if msg[3] != EPOCA or h >= len(ids):
+            return msg[1], msg[2], SIN_HANDLE
+        protocolo[h] = BINARIO
+    secuencia[h] = msg[6] << 8 | msg[7]
+    return msg[1], msg[2], h
+
+
+def c_solicitud_binaria_e4(msg):
+    tipo, movimiento, h = c_leer_trama(msg)
+    return h, MOVIMIENTOS[movimiento]
+
+
+# --- Robot -------------------------------------------------------------------
+
+def r_respuesta_texto(msg):
+    if msg == mensajes_texto["pasar"]:
+        return "pasar"
+    if msg == mensajes_texto["expulsado"]:
+        return "expulsado"
+    return None
+
+
+def es_mi_id(msg):
+    n = len(mi_id)
+    if len(msg) != 8 + n:
+        return False
+    for i in range(n):
+        if msg[8 + i] != mi_id[i]:
+            return False
+    return True
+
+
+def r_leer_trama(msg):
+    if len(msg) < 8 or msg[0] != MAGICO:
+        return None
+    h = msg[4] << 8 | msg[5]
+    if len(msg) > 8:
+        if not es_mi_id(msg):
+            return None
+    elif h != mi_handle or msg[3] != mi_epoca:
+        return None
+    return ORDENES_BIN.get(msg[1])
+
+
+# --- Medidas -----------------------------------------------------------------
+
+def bytes_publish(topic, msg):
+    # Cabecera fija + longitud restante + topic + identificador de paquete.
+    resto = 2 + len(topic) + 2 + len(msg)
+    n = 1
+    while resto > 127:
+        resto >>= 7
+        n += 1
+    return 1 + n + 2 + len(topic) + 2 + len(msg)
+
+
+def tiempo_ns(funcion, msg, iteraciones):
+    t0 = ticks_us()
+    for _ in range(iteraciones):
+        funcion(msg)
+    return ticks_diff(ticks_us(), t0) * 1000 // iteraciones
+
+
+def reservado(funcion, msg):
+    # MicroPython: lo que crece el montón con el recolector parado. CPython:
+    # pico de tracemalloc durante una llamada.
+    gc.collect()
+    if hasattr(gc, "mem_alloc"):
+        gc.disable()
+        try:
+            antes = gc.mem_alloc()
+            for _ in range(100):
+                funcion(msg)
+            return (gc.mem_alloc() - antes) // 100
+        finally:
+            gc.enable()
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        funcion(msg)
+        tracemalloc.reset_peak()
+        antes = tracemalloc.get_traced_memory()[0]
+        funcion(msg)
+        return tracemalloc.get_traced_memory()[1] - antes
+    finally:
+        tracemalloc.stop()
+
+
+MENSAJES = (
+    # nombre, topic texto, mensaje texto, topic binario, trama
+    ("solicitud E3", TOPICO_SOLICITUD, b"robot3:solicitud",
+     TOPICO_SOLICITUD, trama(T_SOLICITUD, 2)),
+    ("solicitud E3 (id)", TOPICO_SOLICITUD, b"robot3:solicitud",
+     TOPICO_SOLICITUD, trama(T_SOLICITUD, SIN_HANDLE, epoca=0, robot_id="robot3")),
+    ("solicitud E4", TOPICO_SOLICITUD, b"robot3:vertical_A",
+     TOPICO_SOLICITUD, trama(T_SOLICITUD, 2, 1)),
+    ("esperar", TOPICO_RESPUESTA, b"robot3:esperar",
+     TOPICO_RESPUESTA, trama(T_ESPERAR, 2)),
+    ("pasar", TOPICO_RESPUESTA, b"robot3:pasar",
+     TOPICO_RESPUESTA, trama(T_PASAR, 2)),
+    ("pasar (id)", TOPICO_RESPUESTA, b"robot3:pasar",
+     TOPICO_RESPUESTA, trama(T_PASAR, 2, robot_id="robot3")),
+    ("llego", TOPICO_REPORTES, b"robot3:llego",
+     TOPICO_REPORTES, trama(T_LLEGO, 2)),
+    ("cruce_liberado", TOPICO_REPORTES, b"robot3:cruce_liberado",
+     TOPICO_REPORTES, trama(T_LIBERADO, 2)),
+)
+
+LECTURAS = (
+    # nombre, lector texto, mensaje texto, lector binario, trama
+    ("controlador: solicitud E3", c_solicitud_texto, b"robot3:solicitud",
+     c_leer_trama, trama(T_SOLICITUD, 2)),
+    ("controlador: solicitud E4", c_solicitud_texto_e4, b"robot3:vertical_A",
+     c_solicitud_binaria_e4, trama(T_SOLICITUD, 2, 1)),
+    ("controlador: reporte", c_reporte_texto, b"robot3:cruce_liberado",
+     c_leer_trama, trama(T_LIBERADO, 2)),
+    ("robot: respuesta propia", r_respuesta_texto, b"robot3:pasar",
+     r_leer_trama, trama(T_PASAR, 2)),
+    ("robot: respuesta ajena", r_respuesta_texto, b"robot1:pasar",
+     r_leer_trama, trama(T_PASAR, 0)),
+    ("robot: respuesta con id", r_respuesta_texto, b"robot3:pasar",
+     r_leer_trama, trama(T_PASAR, 2, robot_id="robot3")),
+    ("robot: sobre memoryview", r_respuesta_texto, b"robot3:pasar",
+     r_leer_trama, memoryview(trama(T_PASAR, 2))),
+)
+
+
+def main():
+    iteraciones = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print("Python:", sys.implementation.name, sys.version.split()[0])
+    print()
+    print("Bytes en la red por mensaje (PUBLISH QoS 1; el PUBACK son 4 más)")
+    print("%-20s %8s %8s" % ("mensaje", "texto", "binario"))
+    for nombre, topic_t, texto, topic_b, binario in MENSAJES:
+        print("%-20s %8d %8d" % (nombre, bytes_publish(topic_t, texto), bytes_publish(topic_b, binario)))
+    print()
+    print("Lectura de un mensaje: ns por mensaje y bytes reservados (%d iteraciones)" % iteraciones)
+    print("%-26s %8s %8s %8s %8s" % ("lectura", "texto", "binario", "B texto", "B bin"))
+    for nombre, lector_t, texto, lector_b, binario in LECTURAS:
+        print("%-26s %8d %8d %8s %8s" % (
+            nombre,
+            tiempo_ns(lector_t, texto, iteraciones),
+            tiempo_ns(lector_b, binario, iteraciones),
+            reservado(lector_t, texto),
+            reservado(lector_b, binario)))
+
+
+main()
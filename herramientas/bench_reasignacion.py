@@ -0,0 +1,195 @@
+"""Micro-benchmark de reasignar_esperas() en el controlador del Escenario 4.
+
+Compara el motor incremental actual con la versión original (que reordenaba
+las tres colas en cada pasada) y comprueba antes que ambos conceden el paso
+a los mismos robots en el mismo orden.
+
+    python herramientas/bench_reasignacion.py [--profundidades 1,10,100,1000]
+"""
+import argparse
+import random
+import time
+
+from entorno import cargar_controlador, silencio
+
+
+class Legado:
+    # Copia fiel de la lógica de colas anterior, sobre listas.
+    def __init__(self, prioridades):
+        self.prioridades = prioridades
+        self.recursos = {"I1": False, "I2": False}
+        self.colas = {"vertical_A": [], "vertical_B": []}
+        self.cola_horizontal = []
+        self.tipo_por_robot = {}
+        self.concesiones = []
+
+    def libre(self, robot_id):
+        return (robot_id not in self.tipo_por_robot and robot_id not in self.cola_horizontal
+                and all(robot_id not in c for c in self.colas.values()))
+
+    def otorgar(self, robot_id, lista):
+        for r in lista:
+            self.recursos[r] = True
+        self.tipo_por_robot[robot_id] = lista
+        self.concesiones.append(robot_id)
+
+    def solicitud(self, robot_id, tipo):
+        if tipo == "vertical_A":
+            if not self.recursos["I1"]:
+                self.otorgar(robot_id, ["I1"])
+            elif robot_id not in self.colas["vertical_A"]:
+                self.colas["vertical_A"].append(robot_id)
+        elif tipo == "vertical_B":
+            if not self.recursos["I2"]:
+                self.otorgar(robot_id, ["I2"])
+            elif robot_id not in self.colas["vertical_B"]:
+                self.colas["vertical_B"].append(robot_id)
+        elif tipo == "horizontal":
+            if not self.recursos["I1"] and not self.recursos["I2"]:
+                self.otorgar(robot_id, ["I1", "I2"])
+            elif robot_id not in self.cola_horizontal:
+                self.cola_horizontal.append(robot_id)
+
+    def reporte(self, origen):
+        if origen in self.tipo_por_robot:
+            for r in self.tipo_por_robot.pop(origen):
+                self.recursos[r] = False
+            self.reasignar()
+        elif origen in sum(list(self.colas.values()), []) or origen in self.cola_horizontal:
+            for k in self.colas:
+                self.colas[k] = [r for r in self.colas[k] if r != origen]
+            self.cola_horizontal[:] = [r for r in self.cola_horizontal if r != origen]
+
+    def reasignar(self):
+        prio = self.prioridades
+        while True:
+            proximo_A = proximo_B = proximo_H = None
+            if self.colas["vertical_A"]:
+                self.colas["vertical_A"].sort(key=lambda rid: prio.get(rid, 99))
+                proximo_A = self.colas["vertical_A"][0]
+            if self.colas["vertical_B"]:
+                self.colas["vertical_B"].sort(key=lambda rid: prio.get(rid, 99))
+                proximo_B = self.colas["vertical_B"][0]
+            if self.cola_horizontal:
+                self.cola_horizontal.sort(key=lambda rid: prio.get(rid, 99))
+                proximo_H = self.cola_horizontal[0]
+            if not self.recursos["I1"] and not self.recursos["I2"] and proximo_H:
+                pr_H = prio.get(proximo_H, 99)
+                pr_A = prio.get(proximo_A, 99) if proximo_A else 999
+                pr_B = prio.get(proximo_B, 999)
+                if pr_H < pr_A and pr_H < pr_B:
+                    self.cola_horizontal.pop(0)
+                    self.otorgar(proximo_H, ["I1", "I2"])
+                    continue
+            if not self.recursos["I1"] and proximo_A:
+                self.colas["vertical_A"].pop(0)
+                self.otorgar(proximo_A, ["I1"])
+                continue
+            if not self.recursos["I2"] and proximo_B:
+                self.colas["vertical_B"].pop(0)
+                self.otorgar(proximo_B, ["I2"])
+                continue
+            break
+
+
+class Motor:
+    # Adaptador sobre el módulo real del controlador. La instantánea retenida
+    # no forma parte de la decisión de reparto y se deja fuera de la medida.
+    def __init__(self, nombre):
+        self.c = cargar_controlador(4, nombre)
+        # La versión original atendía siempre por prioridad estricta.
+        self.c.POLITICA = "prioridad"
+        self.concesiones = []
+        self.c.client.publish = self._publicar
+        self.c.publicar_estado = lambda: None
+
+    def _publicar(self, topic, msg, retain=False, qos=0):
+        if topic.startswith(self.c.TOPICO_RESPUESTA) and msg.endswith(b":pasar"):
+            self.concesiones.append(msg[:-6].decode())
+
+    def solicitud(self, robot_id, tipo):
+        self.c.procesar_mensaje(self.c.TOPICO_SOLICITUD, f"{robot_id}:{tipo}".encode())
+        self.c.enviar_salida()
+
+    def reporte(self, origen):
+        self.c.procesar_mensaje(self.c.TOPICO_REPORTES, f"{origen}:cruce_liberado".encode())
+        self.c.enviar_salida()
+
+
+TIPOS = ("vertical_A", "vertical_B", "horizontal")
+
+
+def verificar(pasos, semilla):
+    rnd = random.Random(semilla)
+    robots = [f"robot{i}" for i in range(1, 25)]
+    # Un tercio de los robots sin prioridad: la versión original les daba 99,
+    # salvo en la cima de vertical_B, donde valían 999.
+    prioridades = {r: rnd.randint(1, 6) for r in robots if rnd.random() < 0.67}
+    legado = Legado(prioridades)
+    motor = Motor("c4_verificacion")
+    motor.c.prioridades.clear()
+    motor.c.prioridades.update(prioridades)
+    with silencio():
+        for _ in range(pasos):
+            if legado.tipo_por_robot and rnd.random() < 0.45:
+                origen = rnd.choice(sorted(legado.tipo_por_robot))
+            elif rnd.random() < 0.1:
+                origen = rnd.choice(robots)
+            else:
+                # Solo piden paso los robots que no esperan ni cruzan ya.
+                robot_id = rnd.choice(robots)
+                if not legado.libre(robot_id):
+                    continue
+                tipo = rnd.choice(TIPOS)
+                legado.solicitud(robot_id, tipo)
+                motor.solicitud(robot_id, tipo)
+                continue
+            legado.reporte(origen)
+            motor.reporte(origen)
+    if legado.concesiones != motor.concesiones:
+        raise SystemExit("Las concesiones difieren entre el motor y la versión original")
+    return len(motor.concesiones)
+
+
+def preparar(modelo, profundidad):
+    # I1 e I2 ocupados y `profundidad` robots esperando en cada cola.
+    modelo.solicitud("activo_A", "vertical_A")
+    modelo.solicitud("activo_B", "vertical_B")
+    for i in range(profundidad):
+        for tipo in TIPOS:
+            modelo.solicitud(f"{tipo}_{i}", tipo)
+
+
+def medir(modelo, profundidad, ciclos):
+    preparar(modelo, profundidad)
+    activo = "activo_A"
+    t0 = time.perf_counter()
+    for _ in range(ciclos):
+        modelo.reporte(activo)
+        siguiente = modelo.concesiones[-1]
+        modelo.solicitud(activo, "vertical_A")
+        activo = siguiente
+    return (time.perf_counter() - t0) / ciclos * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--profundidades", default="1,10,100,1000,5000")
+    parser.add_argument("--ciclos", type=int, default=200)
+    parser.add_argument("--semilla", type=int, default=1)
+    args = parser.parse_args()
+
+    n = verificar(5000, args.semilla)
+    print(f"Verificación: {n} concesiones idénticas")
+    print(f"{'profundidad':>11} {'original (us)':>14} {'motor (us)':>11} {'mejora':>7}")
+    for profundidad in (int(p) for p in args.profundidades.split(",")):
+        legado = Legado({"robot1": 1, "robot2": 2, "robot3": 3, "robot4": 4})
+        motor = Motor(f"c4_bench_{profundidad}")
+        with silencio():
+            t_legado = medir(legado, profundidad, args.ciclos)
+            t_motor = medir(motor, profundidad, args.ciclos)
+        print(f"{profundidad:>11} {t_legado:>14.1f} {t_motor:>11.1f} {t_legado / t_motor:>6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
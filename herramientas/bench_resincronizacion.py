@@ -0,0 +1,183 @@
+"""Tiempo que tarda un controlador de los Escenarios 3 y 4 en recuperarse al reiniciarse.
+
+Arranca broker_mqtt.py y el controlador en procesos aparte y conecta robots
+virtuales de enjambre.py, todos del mismo movimiento: el primero recibe el
+pasar y se queda en el cruce, y los demás esperan en la cola. Entonces se
+mata el controlador y se arranca otro. Al recibir su aviso de sync, los
+robots repiten la solicitud según el modo: todos al momento ("inmediato"),
+repartidos en la ventana ("ventana") o, además, solo los que no figuran
+entre los recuperados del estado retenido ("lista"). Dos sondas miden el
+efecto: una pide paso en cuanto llega el aviso y muestra lo que espera una
+solicitud normal detrás de la ráfaga. La otra pide paso cuando los robots
+ya han repetido todos. La recuperación dura desde el aviso hasta que el
+controlador le contesta a esta segunda sonda, es decir, hasta que ha
+atendido todo lo anterior. Con --sin-instantanea se borra el estado
+retenido antes de rearrancar, como si se hubiera perdido. Entonces no hay
+recuperados y los robots repiten todos.
+
+    python herramientas/bench_resincronizacion.py
+    python herramientas/bench_resincronizacion.py --escenario 3 --robots 10,100 --sin-instantanea
+"""
+import argparse
+import asyncio
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+
+from enjambre import ClienteMQTT, Enjambre, RobotVirtual, esperar_controladores, esperar_puerto, topicos
+from entorno import CONTROLADORES, RAIZ
+
+HERRAMIENTAS = RAIZ / "herramientas"
+TOPICO_ESTADO_ACT = b"cruce/estado/active_robot"
+TOPICO_ESTADO_COLA = b"cruce/estado/cola"
+TOPICO_RESPUESTA = topicos("")[1] + b"/"
+
+MODOS = {
+    "inmediato": ["VENTANA_MAXIMA_SYNC_MS=0", "SYNC_CON_LISTA=False"],
+    "ventana": ["SYNC_CON_LISTA=False"],
+    "lista": [],
+}
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def lanzar_controlador(escenario, puerto, fijar):
+    orden = [sys.executable, str(HERRAMIENTAS / "ejecutar.py"), str(RAIZ / CONTROLADORES[escenario]),
+             "--fijar", "TIEMPO_MAX_CRUCE_MS=600000"]
+    for f in fijar:
+        orden += ["--fijar", f]
+    entorno = dict(os.environ, SHIM_BROKER=f"127.0.0.1:{puerto}")
+    return subprocess.Popen(orden, env=entorno, stdout=subprocess.DEVNULL)
+
+
+class Observador:
+    # Sigue la cola publicada, el aviso de sync del controlador y las
+    # respuestas a la sonda.
+    def __init__(self, puerto):
+        self.cola = set()
+        self.cambio = asyncio.Event()
+        self.sync = None
+        self.t_sync = None
+        self.respuestas = {}
+        self.cliente = ClienteMQTT("127.0.0.1", puerto, b"bench_resincronizacion", self.al_mensaje)
+
+    def al_mensaje(self, topic, msg):
+        if topic == TOPICO_ESTADO_COLA:
+            self.cola = set(re.split(rb"[:;|,]", msg))
+        elif topic == topicos("")[3]:
+            self.sync = msg
+            self.t_sync = time.perf_counter()
+        elif topic.startswith(TOPICO_RESPUESTA):
+            self.respuestas.setdefault(topic[len(TOPICO_RESPUESTA):], time.perf_counter())
+        self.cambio.set()
+
+    async def esperar(self, condicion, limite=120):
+        fin = time.perf_counter() + limite
+        while not condicion():
+            self.cambio.clear()
+            restante = fin - time.perf_counter()
+            if restante <= 0:
+                raise RuntimeError("el controlador no se ha recuperado a tiempo")
+            # Las condiciones también cambian sin mensajes (los reenvíos que
+            # cuenta el enjambre): se vuelven a mirar cada 5 ms.
+            try:
+                await asyncio.wait_for(self.cambio.wait(), min(restante, 0.005))
+            except asyncio.TimeoutError:
+                pass
+
+
+async def medir(escenario, n, modo, sin_instantanea):
+    puerto = puerto_libre()
+    broker = subprocess.Popen([sys.executable, str(HERRAMIENTAS / "broker_mqtt.py"),
+                               "--host", "127.0.0.1", "--puerto", str(puerto)],
+                              stdout=subprocess.DEVNULL)
+    procesos = [broker]
+    try:
+        esperar_puerto("127.0.0.1", puerto)
+        procesos.append(lanzar_controlador(escenario, puerto, MODOS[modo]))
+        await esperar_controladores("127.0.0.1", puerto, [""])
+        tipo = "vertical_A" if escenario == 4 else "solicitud"
+        # Las sondas piden un movimiento que no choca con el de los robots:
+        # en el Escenario 4 reciben el pasar y en el 3, el esperar.
+        libre = b"vertical_B" if escenario == 4 else b"solicitud"
+        enjambre = Enjambre(escenario, "127.0.0.1", puerto, n, mezcla={tipo: 1})
+        robots = [RobotVirtual(enjambre, f"robot{i}", tipo) for i in range(1, n + 1)]
+        await asyncio.gather(*(r.conectar() for r in robots))
+        obs = Observador(puerto)
+        await obs.cliente.conectar()
+        await obs.cliente.suscribir(TOPICO_ESTADO_COLA, 1)
+        await obs.cliente.suscribir(topicos("")[3], 1)
+        await obs.cliente.suscribir(TOPICO_RESPUESTA + b"aviso", 1)
+        await obs.cliente.suscribir(TOPICO_RESPUESTA + b"sonda", 1)
+        for r in robots:
+            r.esperando = True
+            await r.solicitar()
+        esperan = {r.id for r in robots[1:]}
+        await obs.esperar(lambda: esperan <= obs.cola)
+        robots[0].esperando = False
+
+        procesos[1].terminate()
+        procesos[1].wait()
+        if sin_instantanea:
+            for topic in (TOPICO_ESTADO_ACT, TOPICO_ESTADO_COLA):
+                await obs.cliente.publicar(topic, b"", 1, retain=True)
+        obs.sync = None
+        procesos[1] = lanzar_controlador(escenario, puerto, MODOS[modo])
+        await obs.esperar(lambda: obs.sync is not None)
+        await obs.cliente.publicar(topicos("")[0], b"aviso:" + libre, 1)
+        partes = obs.sync.split(b":", 2)
+        ventana = int(partes[1]) if len(partes) > 1 else 0
+        recuperados = set(partes[2].split(b",")) if len(partes) > 2 else set()
+        repiten = len(esperan - recuperados)
+        await obs.esperar(lambda: enjambre.metricas.reenvios >= repiten)
+        t_ultima = time.perf_counter()
+        await obs.esperar(lambda: b"aviso" in obs.respuestas)
+        if escenario == 4:
+            await obs.cliente.publicar(topicos("")[2], b"aviso:cruce_liberado", 1)
+        await obs.cliente.publicar(topicos("")[0], b"sonda:" + libre, 1)
+        await obs.esperar(lambda: b"sonda" in obs.respuestas)
+        t_fin = obs.respuestas[b"sonda"]
+        for r in robots:
+            r.cliente.cortar()
+        obs.cliente.cortar()
+        return {
+            "ventana_ms": ventana,
+            "reenvios": enjambre.metricas.reenvios,
+            "aviso_ms": (obs.respuestas[b"aviso"] - obs.t_sync) * 1000,
+            "ultima_s": t_ultima - obs.t_sync,
+            "recuperacion_s": t_fin - obs.t_sync,
+        }
+    finally:
+        for proceso in reversed(procesos):
+            proceso.terminate()
+            proceso.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--escenario", type=int, choices=(3, 4), default=4)
+    parser.add_argument("--robots", default="10,100,1000")
+    parser.add_argument("--modos", default=",".join(MODOS))
+    parser.add_argument("--sin-instantanea", action="store_true",
+                        help="borra el estado retenido antes de rearrancar el controlador")
+    args = parser.parse_args()
+
+    print(f"Escenario {args.escenario}, estado retenido {'borrado' if args.sin_instantanea else 'intacto'}")
+    print(f"{'robots':>6} {'modo':<9} {'ventana (ms)':>12} {'reenvíos':>8} {'sonda al aviso (ms)':>19} "
+          f"{'último (s)':>10} {'recuperación (s)':>16}")
+    for n in (int(x) for x in args.robots.split(",")):
+        for modo in args.modos.split(","):
+            r = asyncio.run(medir(args.escenario, n, modo, args.sin_instantanea))
+            print(f"{n:>6} {modo:<9} {r['ventana_ms']:>12} {r['reenvios']:>8} {r['aviso_ms']:>19.1f} "
+                  f"{r['ultima_s']:>10.2f} {r['recuperacion_s']:>16.2f}")
+
+
+if __name__ == "__main__":
+    main()
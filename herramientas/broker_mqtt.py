@@ -0,0 +1,447 @@
+"""Broker MQTT 3.1.1 mínimo sobre asyncio.
+
+Cubre lo que usa el protocolo del cruce: mensajes retenidos, QoS 0 y 1,
+último deseo (LWT) y sesiones persistentes (clean_session=False) que
+conservan suscripciones y mensajes QoS 1 mientras el cliente está
+desconectado. QoS 2 se acepta con su intercambio completo, pero se entrega
+como QoS 1.
+
+Sirve como broker local de pruebas y benchmarks, y para ejecutarlo en el
+mismo equipo que el controlador:
+
+    python herramientas/broker_mqtt.py --puerto 1883
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import socket
+import struct
+import threading
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+MAX_PAQUETE = 256 * 1024
+MAX_EN_VUELO = 64
+LIMITE_PENDIENTES = 1000
+LIMITE_BUFFER_SALIDA = 1 << 20
+ESPERA_CONNECT_S = 10
+PERIODO_VIGILANCIA_S = 1
+
+
+class ErrorProtocolo(Exception):
+    pass
+
+
+def coincide(filtro, topic):
+    f = filtro.split(b"/")
+    t = topic.split(b"/")
+    for i, nivel in enumerate(f):
+        if nivel == b"#":
+            return True
+        if i >= len(t):
+            return False
+        if nivel != b"+" and nivel != t[i]:
+            return False
+    return len(f) == len(t)
+
+
+def es_comodin(filtro):
+    return b"+" in filtro or b"#" in filtro
+
+
+def longitud(n):
+    salida = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        salida.append(byte | 0x80 if n else byte)
+        if not n:
+            return bytes(salida)
+
+
+def paquete(tipo, flags, cuerpo=b""):
+    return bytes((tipo << 4 | flags,)) + longitud(len(cuerpo)) + cuerpo
+
+
+def cadena(valor):
+    return struct.pack("!H", len(valor)) + valor
+
+
+def leer_cadena(cuerpo, i):
+    n = struct.unpack_from("!H", cuerpo, i)[0]
+    if i + 2 + n > len(cuerpo):
+        raise ErrorProtocolo("cadena truncada")
+    return bytes(cuerpo[i + 2:i + 2 + n]), i + 2 + n
+
+
+def paquete_publish(topic, msg, qos, retain, pid=0, dup=False):
+    cuerpo = cadena(topic)
+    if qos:
+        cuerpo += struct.pack("!H", pid)
+    return paquete(PUBLISH, dup << 3 | qos << 1 | retain, cuerpo + msg)
+
+
+async def leer_paquete(reader):
+    """Lee un paquete MQTT completo y devuelve (tipo, flags, cuerpo)."""
+    leer = reader.readexactly
+    cabecera = (await leer(1))[0]
+    n = 0
+    for desplazamiento in (0, 7, 14, 21):
+        byte = (await leer(1))[0]
+        n |= (byte & 0x7F) << desplazamiento
+        if not byte & 0x80:
+            break
+    else:
+        raise ErrorProtocolo("longitud inválida")
+    if n > MAX_PAQUETE:
+        raise ErrorProtocolo("paquete demasiado grande")
+    cuerpo = await leer(n) if n else b""
+    return cabecera >> 4, cabecera & 0x0F, cuerpo
+
+
+class Sesion:
+    def __init__(self, client_id, limpia):
+        self.client_id = client_id
+        self.limpia = limpia
+        self.suscripciones = {}
+        self.conexion = None
+        # QoS 1 enviados sin PUBACK (se reenvían con DUP al reconectar) y
+        # QoS 1 a la espera de hueco o de que el cliente vuelva.
+        self.en_vuelo = {}
+        self.pendientes = collections.deque()
+        self._pid = 0
+
+    def _siguiente_pid(self):
+        while True:
+            self._pid = self._pid % 65535 + 1
+            if self._pid not in self.en_vuelo:
+                return self._pid
+
+    def entregar(self, topic, msg, qos, retain=False):
+        conexion = self.conexion
+        if not qos:
+            if conexion is not None:
+                conexion.enviar(paquete_publish(topic, msg, 0, retain))
+            return
+        if conexion is None or len(self.en_vuelo) >= MAX_EN_VUELO:
+            if len(self.pendientes) >= LIMITE_PENDIENTES:
+                self.pendientes.popleft()
+            self.pendientes.append((topic, msg, retain))
+            return
+        pid = self._siguiente_pid()
+        self.en_vuelo[pid] = (topic, msg, retain)
+        conexion.enviar(paquete_publish(topic, msg, 1, retain, pid))
+
+    def confirmar(self, pid):
+        self.en_vuelo.pop(pid, None)
+        while self.pendientes and len(self.en_vuelo) < MAX_EN_VUELO and self.conexion is not None:
+            topic, msg, retain = self.pendientes.popleft()
+            self.entregar(topic, msg, 1, retain)
+
+    def reanudar(self):
+        for pid, (topic, msg, retain) in self.en_vuelo.items():
+            self.conexion.enviar(paquete_publish(topic, msg, 1, retain, pid, dup=True))
+        pendientes = self.pendientes
+        self.pendientes = collections.deque()
+        for topic, msg, retain in pendientes:
+            self.entregar(topic, msg, 1, retain)
+
+
+class Conexion:
+    def __init__(self, broker, reader, writer):
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+        self.sesion = None
+        self.will = None
+        self.keepalive = 0
+        self.ultimo = 0
+        self.cerrada = False
+        self._qos2 = set()
+
+    def enviar(self, datos):
+        if self.cerrada:
+            return
+        if self.writer.is_closing():
+            self.cerrar()
+            return
+        self.writer.write(datos)
+        if self.writer.transport.get_write_buffer_size() > LIMITE_BUFFER_SALIDA:
+            # Un cliente que no lee no debe frenar al resto: se trata como caída.
+            self.cerrar()
+
+    def cerrar(self):
+        if self.cerrada:
+            return
+        self.cerrada = True
+        self.broker.conexiones.discard(self)
+        self.writer.close()
+        sesion = self.sesion
+        if sesion is not None and sesion.conexion is self:
+            sesion.conexion = None
+            if sesion.limpia:
+                self.broker.olvidar(sesion)
+        if self.will is not None:
+            will, self.will = self.will, None
+            self.broker.publicar(*will)
+
+    async def _leer(self):
+        paquete_leido = await leer_paquete(self.reader)
+        self.ultimo = asyncio.get_running_loop().time()
+        return paquete_leido
+
+    async def atender(self):
+        try:
+            tipo, _, cuerpo = await asyncio.wait_for(self._leer(), ESPERA_CONNECT_S)
+            if tipo != CONNECT or not self._conectar(cuerpo):
+                return
+            while not self.cerrada:
+                tipo, flags, cuerpo = await self._leer()
+                if tipo == DISCONNECT:
+                    self.will = None
+                    return
+                self._despachar(tipo, flags, cuerpo)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError,
+                ErrorProtocolo, struct.error, IndexError, OSError):
+            pass
+        finally:
+            self.cerrar()
+
+    def _conectar(self, cuerpo):
+        nombre, i = leer_cadena(cuerpo, 0)
+        if nombre not in (b"MQTT", b"MQIsdp"):
+            raise ErrorProtocolo("protocolo desconocido")
+        nivel, flags, self.keepalive = struct.unpack_from("!BBH", cuerpo, i)
+        i += 4
+        if nivel not in (3, 4):
+            self.enviar(paquete(CONNACK, 0, b"\0\1"))
+            return False
+        client_id, i = leer_cadena(cuerpo, i)
+        limpia = bool(flags & 0x02)
+        if flags & 0x04:
+            topic, i = leer_cadena(cuerpo, i)
+            msg, i = leer_cadena(cuerpo, i)
+            self.will = (topic, msg, min((flags >> 3) & 3, 1), bool(flags & 0x20))
+        if not client_id:
+            if not limpia:
+                self.enviar(paquete(CONNACK, 0, b"\0\2"))
+                return False
+            client_id = b"auto-%d" % next(self.broker.ids)
+        self.sesion, presente = self.broker.abrir_sesion(self, client_id, limpia)
+        self.enviar(paquete(CONNACK, 0, bytes((presente, 0))))
+        self.sesion.reanudar()
+        return True
+
+    def _despachar(self, tipo, flags, cuerpo):
+        if tipo == PUBLISH:
+            qos = (flags >> 1) & 3
+            topic, i = leer_cadena(cuerpo, 0)
+            if es_comodin(topic):
+                raise ErrorProtocolo("comodín en el topic de publicación")
+            if qos:
+                pid = cuerpo[i:i + 2]
+                i += 2
+            msg = bytes(cuerpo[i:])
+            if qos == 2:
+                if pid not in self._qos2:
+                    self._qos2.add(pid)
+                    self.broker.publicar(topic, msg, 1, bool(flags & 1))
+                self.enviar(paquete(PUBREC, 0, pid))
+                return
+            self.broker.publicar(topic, msg, qos, bool(flags & 1))
+            if qos:
+                self.enviar(paquete(PUBACK, 0, pid))
+        elif tipo == PUBACK:
+            self.sesion.confirmar(struct.unpack("!H", cuerpo)[0])
+        elif tipo == PUBREL:
+            self._qos2.discard(cuerpo)
+            self.enviar(paquete(PUBCOMP, 0, cuerpo))
+        elif tipo == PUBREC:
+            self.sesion.confirmar(struct.unpack("!H", cuerpo)[0])
+            self.enviar(paquete(PUBREL, 2, cuerpo))
+        elif tipo == PUBCOMP:
+            pass
+        elif tipo == SUBSCRIBE:
+            pid = cuerpo[:2]
+            i = 2
+            concedidas = []
+            while i < len(cuerpo):
+                filtro, i = leer_cadena(cuerpo, i)
+                qos = min(cuerpo[i] & 3, 1)
+                i += 1
+                concedidas.append((filtro, qos))
+                self.broker.suscribir(self.sesion, filtro, qos)
+            self.enviar(paquete(SUBACK, 0, pid + bytes(q for _, q in concedidas)))
+            for filtro, qos in concedidas:
+                self.broker.enviar_retenidos(self.sesion, filtro, qos)
+        elif tipo == UNSUBSCRIBE:
+            i = 2
+            while i < len(cuerpo):
+                filtro, i = leer_cadena(cuerpo, i)
+                self.broker.desuscribir(self.sesion, filtro)
+            self.enviar(paquete(UNSUBACK, 0, cuerpo[:2]))
+        elif tipo == PINGREQ:
+            self.enviar(paquete(PINGRESP, 0))
+        else:
+            raise ErrorProtocolo("paquete inesperado %d" % tipo)
+
+
+class Broker:
+    def __init__(self):
+        self.sesiones = {}
+        self.conexiones = set()
+        self.retenidos = {}
+        # Los topics exactos se resuelven con un diccionario; solo los
+        # filtros con comodines se recorren en cada publicación.
+        self.exactas = collections.defaultdict(dict)
+        self.comodines = collections.defaultdict(dict)
+        self.ids = itertools.count(1)
+        self.publicaciones = 0
+        self.entregas = 0
+        self.trazas = []
+
+    def abrir_sesion(self, conexion, client_id, limpia):
+        anterior = self.sesiones.get(client_id)
+        if anterior is not None and anterior.conexion is not None:
+            # Un cliente con el mismo id expulsa al anterior.
+            anterior.conexion.cerrar()
+            anterior = self.sesiones.get(client_id)
+        presente = anterior is not None and not limpia
+        if anterior is not None and limpia:
+            self.olvidar(anterior)
+            anterior = None
+        sesion = anterior or Sesion(client_id, limpia)
+        sesion.limpia = limpia
+        sesion.conexion = conexion
+        self.sesiones[client_id] = sesion
+        self.conexiones.add(conexion)
+        return sesion, presente
+
+    def olvidar(self, sesion):
+        for filtro in list(sesion.suscripciones):
+            self.desuscribir(sesion, filtro)
+        if self.sesiones.get(sesion.client_id) is sesion:
+            del self.sesiones[sesion.client_id]
+
+    def _indice(self, filtro):
+        return self.comodines if es_comodin(filtro) else self.exactas
+
+    def suscribir(self, sesion, filtro, qos):
+        sesion.suscripciones[filtro] = qos
+        self._indice(filtro)[filtro][sesion] = qos
+
+    def desuscribir(self, sesion, filtro):
+        if sesion.suscripciones.pop(filtro, None) is None:
+            return
+        indice = self._indice(filtro)
+        suscriptores = indice[filtro]
+        suscriptores.pop(sesion, None)
+        if not suscriptores:
+            del indice[filtro]
+
+    def enviar_retenidos(self, sesion, filtro, qos):
+        if es_comodin(filtro):
+            retenidos = [(t, v) for t, v in self.retenidos.items() if coincide(filtro, t)]
+        elif filtro in self.retenidos:
+            retenidos = [(filtro, self.retenidos[filtro])]
+        else:
+            return
+        for topic, (msg, qos_msg) in retenidos:
+            sesion.entregar(topic, msg, min(qos, qos_msg), True)
+
+    def publicar(self, topic, msg, qos=0, retain=False):
+        self.publicaciones += 1
+        for funcion in self.trazas:
+            funcion(topic, msg, retain, qos)
+        if retain:
+            if msg:
+                self.retenidos[topic] = (msg, qos)
+            else:
+                self.retenidos.pop(topic, None)
+        destinos = dict(self.exactas.get(topic, ()))
+        for filtro, suscriptores in self.comodines.items():
+            if coincide(filtro, topic):
+                for sesion, q in suscriptores.items():
+                    if q > destinos.get(sesion, -1):
+                        destinos[sesion] = q
+        for sesion, q in destinos.items():
+            sesion.entregar(topic, msg, min(qos, q))
+        self.entregas += len(destinos)
+
+    async def _atender(self, reader, writer):
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        await Conexion(self, reader, writer).atender()
+
+    async def _vigilar(self):
+        # Keepalive de todas las conexiones en una sola tarea: se cierra la
+        # que lleva más de 1,5 veces su keepalive sin enviar nada.
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(PERIODO_VIGILANCIA_S)
+            ahora = loop.time()
+            for conexion in list(self.conexiones):
+                if conexion.keepalive and ahora - conexion.ultimo > 1.5 * conexion.keepalive:
+                    conexion.cerrar()
+
+    async def servir(self, host="0.0.0.0", puerto=1883):
+        servidor = await asyncio.start_server(self._atender, host, puerto, backlog=4096)
+        self._vigilancia = asyncio.create_task(self._vigilar())
+        return servidor
+
+
+def en_hilo(host="127.0.0.1", puerto=0):
+    """Arranca un broker en un hilo propio y devuelve (broker, puerto)."""
+    broker = Broker()
+    listo = threading.Event()
+    estado = {}
+
+    def correr():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        servidor = loop.run_until_complete(broker.servir(host, puerto))
+        estado["puerto"] = servidor.sockets[0].getsockname()[1]
+        listo.set()
+        loop.run_forever()
+
+    threading.Thread(target=correr, name="broker", daemon=True).start()
+    listo.wait()
+    return broker, estado["puerto"]
+
+
+async def principal(host, puerto):
+    broker = Broker()
+    servidor = await broker.servir(host, puerto)
+    print(f"Broker MQTT escuchando en {host}:{puerto}")
+    async with servidor:
+        await servidor.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--puerto", type=int, default=1883)
+    args = parser.parse_args()
+    try:
+        asyncio.run(principal(args.host, args.puerto))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
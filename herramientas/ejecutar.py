@@ -0,0 +1,177 @@
+"""Ejecuta los scripts de los escenarios en el PC, sin tocarlos, sobre el shim.
+
+Un solo script, como si fuera main.py de la placa:
+
+    python herramientas/ejecutar.py Escenario3/codigo/controlador/controlador_cruce_escenario3.py
+
+Un escenario completo en un proceso, con el controlador y N robots en hilos
+conectados al broker en memoria:
+
+    python herramientas/ejecutar.py --escenario 4 --robots 3 --tipos vertical_A,horizontal
+
+Con --broker tcp se arranca broker_mqtt.py en el mismo proceso y los clientes
+se conectan a él por TCP; con --broker host:puerto se usa un broker externo.
+Con --binarios N los N primeros robots usan el protocolo binario (Escenarios 3
+y 4) y el resto el de texto. --fijar NOMBRE=valor cambia una constante del
+script, o de los scripts del escenario que la definen, antes de arrancarlos. El
+valor es un literal de Python, el nombre de otra constante del script o, si
+no es ninguna de las dos, un texto:
+
+    python herramientas/ejecutar.py --escenario 3 --fijar MODO_COMPATIBLE=True
+    python herramientas/ejecutar.py --escenario 4 --fijar CRUCE=CRUCE_4_ACCESOS
+    python herramientas/ejecutar.py --escenario 3 --fijar CRUCE_ID=norte
+"""
+import argparse
+import ast
+import functools
+import os
+import runpy
+import threading
+import time
+
+from entorno import CONTROLADORES, ROBOTS, cargar, instalar_sustitutos
+
+TIPOS_ESCENARIO4 = ("vertical_A", "vertical_B", "horizontal")
+
+
+def etiquetar(modulo, etiqueta):
+    modulo.print = functools.partial(print, f"[{etiqueta}]")
+
+
+def fijar(modulo, constantes):
+    for nombre, valor in constantes.items():
+        if hasattr(modulo, nombre):
+            if isinstance(valor, Constante):
+                valor = getattr(modulo, valor, str(valor))
+            setattr(modulo, nombre, valor)
+
+
+class Constante(str):
+    """Nombre de otra constante del script, que se resuelve en cada módulo; si
+    el módulo no la tiene, es un texto."""
+
+
+def leer_constantes(textos):
+    constantes = {}
+    for texto in textos:
+        nombre, _, valor = texto.partition("=")
+        try:
+            constantes[nombre] = ast.literal_eval(valor)
+        except (ValueError, SyntaxError):
+            if not valor.isidentifier():
+                raise
+            constantes[nombre] = Constante(valor)
+    return constantes
+
+
+def lanzar(funcion, nombre):
+    hilo = threading.Thread(target=funcion, name=nombre, daemon=True)
+    hilo.start()
+    return hilo
+
+
+def preparar_broker(opcion):
+    if opcion == "memoria":
+        from broker_local import broker
+        return broker
+    if opcion == "tcp":
+        import broker_mqtt
+        broker, puerto = broker_mqtt.en_hilo()
+        os.environ["SHIM_BROKER"] = f"127.0.0.1:{puerto}"
+        return broker
+    os.environ["SHIM_BROKER"] = opcion
+    return None
+
+
+def ejecutar_escenario(escenario, n_robots, tipos, duracion, traza, escalonado, opcion_broker,
+                       binarios=0, constantes=None):
+    instalar_sustitutos()
+    broker = preparar_broker(opcion_broker)
+
+    if traza and broker is not None:
+        broker.trazas.append(
+            lambda t, m, r, q: print(f"[broker] {t.decode()} <- {m!r} retain={r} qos={q}"))
+
+    controlador = cargar(CONTROLADORES[escenario], f"controlador{escenario}")
+    fijar(controlador, constantes or {})
+    etiquetar(controlador, "controlador")
+    lanzar(controlador.main, "controlador")
+    time.sleep(0.5)
+
+    robots = []
+    hilos = []
+    for i in range(1, n_robots + 1):
+        r = cargar(ROBOTS[escenario], f"robot{i}")
+        r.CLIENT_ID = f"robot{i}"
+        if hasattr(r, "ROBOT_TIPO"):
+            r.ROBOT_TIPO = tipos[(i - 1) % len(tipos)]
+        if hasattr(r, "PROTOCOLO_BINARIO"):
+            r.PROTOCOLO_BINARIO = i <= binarios
+        fijar(r, constantes or {})
+        etiquetar(r, r.CLIENT_ID)
+        robots.append(r)
+        hilos.append(lanzar(r.main, r.CLIENT_ID))
+        time.sleep(escalonado)
+
+    limite = time.monotonic() + duracion
+    for hilo in hilos:
+        hilo.join(max(0, limite - time.monotonic()))
+
+    print()
+    print("Resumen de robots:")
+    for r in robots:
+        tipo = f" ({r.ROBOT_TIPO})" if hasattr(r, "ROBOT_TIPO") else ""
+        if getattr(r, "PROTOCOLO_BINARIO", False):
+            tipo += " [binario]"
+        izq = [d for _, d in r.servo_izq.historial]
+        der = [d for _, d in r.servo_der.historial]
+        print(f"  {r.CLIENT_ID}{tipo}: {len(izq)} cambios de duty, "
+              f"último ({izq[-1] if izq else '-'}, {der[-1] if der else '-'}), "
+              f"LED {'encendido' if r.led.value() else 'apagado'}")
+    if broker is not None:
+        print(f"Broker: {broker.publicaciones} publicaciones, {broker.entregas} entregas")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("script", nargs="?", help="script a ejecutar como __main__")
+    parser.add_argument("--escenario", type=int, choices=sorted(CONTROLADORES))
+    parser.add_argument("--robots", type=int, default=2)
+    parser.add_argument("--tipos", default=",".join(TIPOS_ESCENARIO4),
+                        help="tipos de movimiento que se reparten entre los robots (Escenario 4)")
+    parser.add_argument("--duracion", type=float, default=60,
+                        help="segundos máximos de ejecución del escenario")
+    parser.add_argument("--escalonado", type=float, default=0.2,
+                        help="segundos entre el arranque de dos robots")
+    parser.add_argument("--traza", action="store_true", help="muestra cada publicación del broker")
+    parser.add_argument("--broker", default="memoria",
+                        help="memoria (por defecto), tcp (broker_mqtt.py en el proceso) o host:puerto")
+    parser.add_argument("--binarios", type=int, default=0,
+                        help="número de robots que usan el protocolo binario")
+    parser.add_argument("--fijar", action="append", default=[], metavar="NOMBRE=valor",
+                        help="constante de los scripts a cambiar antes de arrancarlos")
+    args = parser.parse_args()
+    constantes = leer_constantes(args.fijar)
+
+    if args.script:
+        instalar_sustitutos()
+        preparar_broker(args.broker)
+        if not constantes:
+            runpy.run_path(args.script, run_name="__main__")
+            return
+        modulo = cargar(args.script)
+        for nombre in constantes:
+            if not hasattr(modulo, nombre):
+                parser.error(f"{args.script} no define {nombre}")
+        fijar(modulo, constantes)
+        modulo.main()
+    elif args.escenario:
+        ejecutar_escenario(args.escenario, args.robots, args.tipos.split(","),
+                           args.duracion, args.traza, args.escalonado, args.broker,
+                           args.binarios, constantes)
+    else:
+        parser.error("indica un script o --escenario")
+
+
+if __name__ == "__main__":
+    main()
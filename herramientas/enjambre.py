@@ -0,0 +1,529 @@
+"""Generador de carga: un enjambre de robots virtuales contra un controlador.
+
+Cada robot virtual repite el ciclo de robot_escenario*.py con el mismo
+protocolo: se conecta con su último deseo, pide paso (`robotX:solicitud` o
+`robotX:<tipo>` en el Escenario 4, con `#<número>` detrás en los Escenarios
+3 y 4 salvo con --sin-numero), espera el `pasar`, ocupa el cruce un
+tiempo y envía `llego` y `cruce_liberado`. Al final se muestran los
+percentiles de latencia entre la solicitud y el permiso, los cruces por
+minuto y los mensajes que el broker entrega a los robots por cada cruce.
+Cada robot escucha sus respuestas en `cruce/respuesta/<id>`; con --compartido
+escuchan todos `cruce/respuesta`, como el firmware anterior, y el controlador
+lanzado con --lanzar publica también allí (MODO_COMPATIBLE).
+
+Contra un broker y un controlador ya en marcha:
+
+    python herramientas/enjambre.py --escenario 3 --broker 127.0.0.1:1883 --robots 500
+
+Arrancando broker_mqtt.py y el controlador del escenario en procesos aparte:
+
+    python herramientas/enjambre.py --escenario 4 --lanzar --robots 1000 --llegadas poisson --tasa 50
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+from broker_mqtt import (CONNACK, CONNECT, DISCONNECT, PUBACK, PUBLISH, SUBACK, SUBSCRIBE,
+                         cadena, leer_cadena, leer_paquete, paquete, paquete_publish)
+from entorno import CONTROLADORES, RAIZ
+
+HERRAMIENTAS = RAIZ / "herramientas"
+
+TIPOS_ESCENARIO4 = ("vertical_A", "vertical_B", "horizontal")
+
+
+def topicos(cruce_id):
+    # Los mismos que configurar_topicos() en los scripts: solicitud,
+    # respuesta, reportes y solicitar_estado.
+    cruce = b"cruce/" + cruce_id.encode() + b"/" if cruce_id else b"cruce/"
+    robots = b"robots/" + cruce_id.encode() + b"/" if cruce_id else b"robots/"
+    return cruce + b"solicitud", cruce + b"respuesta", cruce + b"reportes", robots + b"solicitar_estado"
+
+
+class ClienteMQTT:
+    """Cliente MQTT 3.1.1 mínimo sobre asyncio para los robots virtuales."""
+
+    def __init__(self, host, puerto, client_id, al_mensaje):
+        self.host = host
+        self.puerto = puerto
+        self.client_id = client_id
+        self.al_mensaje = al_mensaje
+        self.writer = None
+        self._acks = {}
+        self._pid = 0
+
+    async def conectar(self, limpia=True, will=None, keepalive=60):
+        reader, self.writer = await asyncio.open_connection(self.host, self.puerto)
+        flags = limpia << 1
+        cola = cadena(self.client_id)
+        if will is not None:
+            topic, msg, qos, retain = will
+            flags |= 0x04 | qos << 3 | retain << 5
+            cola += cadena(topic) + cadena(msg)
+        self.writer.write(paquete(CONNECT, 0, cadena(b"MQTT") + bytes((4, flags))
+                                  + struct.pack("!H", keepalive) + cola))
+        tipo, _, cuerpo = await leer_paquete(reader)
+        if tipo != CONNACK or cuerpo[1]:
+            raise ConnectionError("CONNACK rechazado")
+        self._tarea = asyncio.create_task(self._recibir(reader))
+
+    async def _recibir(self, reader):
+        try:
+            while True:
+                tipo, flags, cuerpo = await leer_paquete(reader)
+                if tipo == PUBLISH:
+                    topic, i = leer_cadena(cuerpo, 0)
+                    if flags & 0x06:
+                        self.writer.write(paquete(PUBACK, 0, cuerpo[i:i + 2]))
+                        i += 2
+                    self.al_mensaje(topic, bytes(cuerpo[i:]))
+                elif tipo in (PUBACK, SUBACK):
+                    futuro = self._acks.pop(struct.unpack_from("!H", cuerpo)[0], None)
+                    if futuro is not None and not futuro.done():
+                        futuro.set_result(None)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        finally:
+            for futuro in self._acks.values():
+                if not futuro.done():
+                    futuro.set_exception(ConnectionError("conexión perdida"))
+            self._acks.clear()
+
+    def _nuevo_ack(self):
+        self._pid = self._pid % 65535 + 1
+        futuro = asyncio.get_running_loop().create_future()
+        self._acks[self._pid] = futuro
+        return self._pid, futuro
+
+    async def suscribir(self, topic, qos=0):
+        pid, futuro = self._nuevo_ack()
+        self.writer.write(paquete(SUBSCRIBE, 2, struct.pack("!H", pid) + cadena(topic) + bytes((qos,))))
+        await futuro
+
+    async def publicar(self, topic, msg, qos=0, retain=False):
+        if self.writer is None or self.writer.is_closing():
+            raise ConnectionError("sin conexión")
+        if not qos:
+            self.writer.write(paquete_publish(topic, msg, 0, retain))
+            return
+        pid, futuro = self._nuevo_ack()
+        self.writer.write(paquete_publish(topic, msg, qos, retain, pid))
+        await futuro
+
+    def cortar(self):
+        # Sin DISCONNECT: el broker lo trata como una caída y publica el LWT.
+        if self.writer is not None:
+            self.writer.transport.abort()
+
+    async def desconectar(self):
+        # Se espera a que el broker cierre: cerrar antes con datos sin leer
+        # provoca un RST que puede descartar las últimas publicaciones.
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(paquete(DISCONNECT, 0))
+            try:
+                await asyncio.wait_for(asyncio.shield(self._tarea), 5)
+            except asyncio.TimeoutError:
+                pass
+            self.writer.close()
+
+
+class Metricas:
+    def __init__(self):
+        self.latencias = []
+        self.solicitudes = 0
+        self.reenvios = 0
+        self.cruces = 0
+        self.cortes = 0
+        self.expulsiones = 0
+        self.errores = 0
+        self.entregas = 0
+        self.por_cruce = {}
+
+
+class RobotVirtual:
+    def __init__(self, enjambre, nombre, tipo, cruce_id=""):
+        self.e = enjambre
+        self.nombre = nombre
+        self.id = nombre.encode()
+        self.cruce_id = cruce_id
+        self.topico_solicitud, respuesta, self.topico_reportes, self.topico_sync = topicos(cruce_id)
+        self.topico = respuesta if enjambre.compartido else respuesta + b"/" + self.id
+        self.tipo = tipo
+        self.numero = random.getrandbits(16)
+        self.esperando = False
+        self.permiso = asyncio.Event()
+        self.expulsado = False
+        self.cliente = ClienteMQTT(enjambre.host, enjambre.puerto, self.id, self.al_mensaje)
+
+    @property
+    def persistente(self):
+        return self.e.escenario >= 3
+
+    def al_mensaje(self, topic, msg):
+        self.e.metricas.entregas += 1
+        if topic == self.topico:
+            who, _, orden = msg.partition(b":")
+            if who != self.id:
+                return
+            if orden == b"pasar":
+                self.permiso.set()
+            elif orden == b"expulsado":
+                self.expulsado = True
+                self.permiso.set()
+        elif topic == self.topico_sync and self.esperando:
+            asyncio.ensure_future(self.resincronizar(msg))
+
+    async def resincronizar(self, msg):
+        # Como los scripts: "reanunciar[:<ventana ms>[:<robots recuperados>]]".
+        # Los recuperados no repiten la solicitud; los demás, tras un retardo
+        # al azar dentro de la ventana.
+        partes = msg.split(b":", 2)
+        if len(partes) > 2 and self.id in partes[2].split(b","):
+            return
+        ventana = int(partes[1]) if len(partes) > 1 and partes[1].isdigit() else 0
+        await asyncio.sleep(random.uniform(0, ventana / 1000))
+        if self.esperando:
+            await self.solicitar(reenvio=True)
+
+    async def conectar(self, reconexion=False):
+        if self.persistente:
+            will = (self.topico_reportes, self.id + b":offline", 1, True)
+            await self.cliente.conectar(limpia=False, will=will)
+            await self.cliente.suscribir(self.topico, 1)
+            await self.cliente.suscribir(self.topico_sync, 1)
+            if reconexion and self.esperando:
+                await self.solicitar(reenvio=True)
+            if reconexion or self.e.escenario == 4:
+                await self.cliente.publicar(self.topico_reportes, self.id + b":online", 1, True)
+        else:
+            await self.cliente.conectar()
+            await self.cliente.suscribir(self.topico)
+            if reconexion and self.esperando:
+                await self.solicitar(reenvio=True)
+
+    async def solicitar(self, reenvio=False):
+        if self.e.escenario == 4:
+            msg = self.id + b":" + self.tipo.encode()
+        else:
+            msg = self.id + b":solicitud"
+        if self.e.numerar and self.persistente:
+            msg += b"#%d" % self.numero
+        m = self.e.metricas
+        if reenvio:
+            m.reenvios += 1
+        else:
+            m.solicitudes += 1
+        try:
+            await self.cliente.publicar(self.topico_solicitud, msg, 1 if self.persistente else 0)
+        except ConnectionError:
+            pass
+
+    async def caer_y_volver(self):
+        self.e.metricas.cortes += 1
+        self.cliente.cortar()
+        await asyncio.sleep(self.e.reconexion)
+        while True:
+            try:
+                await self.conectar(reconexion=True)
+                return
+            except (ConnectionError, OSError):
+                await asyncio.sleep(self.e.reconexion)
+
+    async def esperar_permiso(self):
+        loop = asyncio.get_running_loop()
+        reenvio = self.e.reenvio if self.persistente else None
+        corte = None
+        if random.random() < self.e.desconexiones:
+            corte = loop.time() + random.uniform(0, self.e.ventana_corte)
+        ultimo_envio = loop.time()
+        while not self.permiso.is_set():
+            plazos = [p for p in (corte, reenvio and ultimo_envio + reenvio) if p]
+            espera = max(0, min(plazos) - loop.time()) if plazos else None
+            try:
+                await asyncio.wait_for(self.permiso.wait(), espera)
+            except asyncio.TimeoutError:
+                if corte is not None and loop.time() >= corte:
+                    corte = None
+                    await self.caer_y_volver()
+                else:
+                    await self.solicitar(reenvio=True)
+                    ultimo_envio = loop.time()
+
+    async def cruzar(self):
+        loop = asyncio.get_running_loop()
+        m = self.e.metricas
+        self.permiso.clear()
+        self.expulsado = False
+        self.esperando = True
+        self.numero = (self.numero + 1) & 0xFFFF
+        inicio = loop.time()
+        await self.solicitar()
+        await self.esperar_permiso()
+        self.esperando = False
+        if self.expulsado:
+            m.expulsiones += 1
+            return
+        m.latencias.append((loop.time() - inicio) * 1000)
+        await asyncio.sleep(self.e.tiempo_cruce)
+        qos = 1 if self.persistente else 0
+        await self.cliente.publicar(self.topico_reportes, self.id + b":llego", qos)
+        await self.cliente.publicar(self.topico_reportes, self.id + b":cruce_liberado", qos)
+        m.cruces += 1
+        m.por_cruce[self.cruce_id] = m.por_cruce.get(self.cruce_id, 0) + 1
+
+    async def vivir(self):
+        try:
+            await self.conectar()
+            for ciclo in range(self.e.ciclos):
+                if ciclo:
+                    await asyncio.sleep(self.e.pausa_llegada())
+                await self.cruzar()
+            await self.cliente.desconectar()
+        except (ConnectionError, OSError):
+            self.e.metricas.errores += 1
+
+
+class Enjambre:
+    def __init__(self, escenario, host, puerto, robots=100, mezcla=None, llegadas="rafaga",
+                 tasa=10.0, ciclos=1, tiempo_cruce=0.2, reenvio=60.0, desconexiones=0.0,
+                 ventana_corte=1.0, reconexion=0.5, prefijo="robot", semilla=None, compartido=False,
+                 cruces=None, numerar=True):
+        self.escenario = escenario
+        self.host = host
+        self.puerto = puerto
+        self.robots = robots
+        self.mezcla = mezcla or {t: 1 for t in TIPOS_ESCENARIO4}
+        self.llegadas = llegadas
+        self.tasa = tasa
+        self.ciclos = ciclos
+        self.tiempo_cruce = tiempo_cruce
+        self.reenvio = reenvio
+        self.desconexiones = desconexiones
+        self.ventana_corte = ventana_corte
+        self.reconexion = reconexion
+        self.prefijo = prefijo
+        self.compartido = compartido
+        self.cruces = cruces or [""]
+        self.numerar = numerar
+        self.metricas = Metricas()
+        if semilla is not None:
+            random.seed(semilla)
+
+    def pausa_llegada(self):
+        if self.llegadas == "poisson":
+            return random.expovariate(self.tasa)
+        if self.llegadas == "uniforme":
+            return 1 / self.tasa
+        return 0
+
+    def tipo_aleatorio(self):
+        tipos = list(self.mezcla)
+        return random.choices(tipos, weights=[self.mezcla[t] for t in tipos])[0]
+
+    async def ejecutar(self, duracion):
+        loop = asyncio.get_running_loop()
+        inicio = loop.time()
+        tareas = []
+
+        async def generar():
+            for i in range(1, self.robots + 1):
+                cruce_id = self.cruces[(i - 1) % len(self.cruces)]
+                robot = RobotVirtual(self, f"{self.prefijo}{i}", self.tipo_aleatorio(), cruce_id)
+                tareas.append(asyncio.create_task(robot.vivir()))
+                pausa = self.pausa_llegada()
+                if pausa:
+                    await asyncio.sleep(pausa)
+
+        generador = asyncio.create_task(generar())
+        try:
+            await asyncio.wait_for(generador, duracion)
+            restante = duracion - (loop.time() - inicio)
+            if tareas and restante > 0:
+                await asyncio.wait(tareas, timeout=restante)
+        except asyncio.TimeoutError:
+            pass
+        fin = loop.time()
+        pendientes = [t for t in tareas if not t.done()]
+        for tarea in pendientes:
+            tarea.cancel()
+        await asyncio.gather(*pendientes, return_exceptions=True)
+        return self.informe(fin - inicio, len(tareas), len(pendientes))
+
+    def informe(self, segundos, lanzados, sin_terminar):
+        m = self.metricas
+        lat = sorted(m.latencias)
+
+        def pct(p):
+            return round(lat[min(len(lat) - 1, int(len(lat) * p))], 2) if lat else None
+
+        por_cruce = [m.por_cruce.get(c, 0) for c in self.cruces]
+        return {
+            "escenario": self.escenario,
+            "cruces_red": len(self.cruces),
+            "robots": lanzados,
+            "segundos": round(segundos, 2),
+            "solicitudes": m.solicitudes,
+            "reenvios": m.reenvios,
+            "permisos": len(lat),
+            "cruces": m.cruces,
+            "cruces_por_minuto": round(m.cruces * 60 / segundos, 1) if segundos else 0,
+            "cruces_por_cruce": {"min": min(por_cruce), "max": max(por_cruce)},
+            "latencia_ms": {"p50": pct(0.50), "p90": pct(0.90), "p99": pct(0.99),
+                            "max": round(lat[-1], 2) if lat else None},
+            "cortes": m.cortes,
+            "expulsiones": m.expulsiones,
+            "errores": m.errores,
+            "sin_terminar": sin_terminar,
+            "entregas": m.entregas,
+            "entregas_por_cruce": round(m.entregas / m.cruces, 2) if m.cruces else None,
+        }
+
+
+def esperar_puerto(host, puerto, limite=10):
+    fin = time.monotonic() + limite
+    while time.monotonic() < fin:
+        try:
+            socket.create_connection((host, puerto), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"el broker no responde en {host}:{puerto}")
+
+
+async def esperar_controladores(host, puerto, cruces, limite=30):
+    # Cada controlador de los Escenarios 3 y 4 deja retenido
+    # "<CLIENT_ID>:online" en sus reportes al terminar de arrancar.
+    pendientes = {topicos(c)[2] for c in cruces}
+    listos = asyncio.Event()
+
+    def al_mensaje(topic, msg):
+        if msg.endswith(b":online") and msg.startswith(b"controlador"):
+            pendientes.discard(topic)
+            if not pendientes:
+                listos.set()
+
+    cliente = ClienteMQTT(host, puerto, b"enjambre_espera", al_mensaje)
+    await cliente.conectar()
+    for topic in list(pendientes):
+        await cliente.suscribir(topic)
+    try:
+        await asyncio.wait_for(listos.wait(), limite)
+    except asyncio.TimeoutError:
+        raise RuntimeError(f"{len(pendientes)} cruces sin controlador tras {limite} s") from None
+    finally:
+        await cliente.desconectar()
+
+
+def lanzar_procesos(escenario, puerto, compartido=False, cruces=None, procesos=1):
+    broker = subprocess.Popen([sys.executable, str(HERRAMIENTAS / "broker_mqtt.py"),
+                               "--host", "127.0.0.1", "--puerto", str(puerto)],
+                              stdout=subprocess.DEVNULL)
+    esperar_puerto("127.0.0.1", puerto)
+    entorno = dict(os.environ, SHIM_BROKER=f"127.0.0.1:{puerto}")
+    if cruces:
+        orden = [sys.executable, str(HERRAMIENTAS / "anfitrion.py"), "--escenario", str(escenario),
+                 "--cruces", ",".join(cruces), "--procesos", str(procesos),
+                 "--broker", f"127.0.0.1:{puerto}"]
+    else:
+        orden = [sys.executable, str(HERRAMIENTAS / "ejecutar.py"), str(RAIZ / CONTROLADORES[escenario])]
+    if compartido:
+        orden += ["--fijar", "MODO_COMPATIBLE=True"]
+    controlador = subprocess.Popen(orden, env=entorno, stdout=subprocess.DEVNULL)
+    try:
+        if escenario >= 3:
+            asyncio.run(esperar_controladores("127.0.0.1", puerto, cruces or [""]))
+        else:
+            time.sleep(1.5)
+    except BaseException:
+        for proceso in (controlador, broker):
+            proceso.terminate()
+        raise
+    return [controlador, broker]
+
+
+def leer_mezcla(texto):
+    mezcla = {}
+    for parte in texto.split(","):
+        tipo, _, peso = parte.partition("=")
+        mezcla[tipo] = float(peso or 1)
+    return mezcla
+
+
+def mostrar(informe):
+    lat = informe["latencia_ms"]
+    print(f"Escenario {informe['escenario']}: {informe['robots']} robots en {informe['segundos']} s"
+          + (f" repartidos en {informe['cruces_red']} cruces" if informe["cruces_red"] > 1 else ""))
+    print(f"  Solicitudes: {informe['solicitudes']}  reenvíos: {informe['reenvios']}  "
+          f"permisos: {informe['permisos']}  cruces: {informe['cruces']} "
+          f"({informe['cruces_por_minuto']} por minuto)")
+    if informe["cruces_red"] > 1:
+        por_cruce = informe["cruces_por_cruce"]
+        print(f"  Cruces completados por cruce de la red: mín {por_cruce['min']}  máx {por_cruce['max']}")
+    print(f"  Latencia solicitud -> pasar (ms): p50 {lat['p50']}  p90 {lat['p90']}  "
+          f"p99 {lat['p99']}  máx {lat['max']}")
+    print(f"  Cortes: {informe['cortes']}  expulsiones: {informe['expulsiones']}  "
+          f"errores: {informe['errores']}  sin terminar: {informe['sin_terminar']}")
+    print(f"  Entregas a los robots: {informe['entregas']} "
+          f"({informe['entregas_por_cruce']} por cruce)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--escenario", type=int, choices=sorted(CONTROLADORES), required=True)
+    parser.add_argument("--broker", default="127.0.0.1:1883", help="host:puerto del broker")
+    parser.add_argument("--lanzar", action="store_true",
+                        help="arranca broker_mqtt.py y el controlador del escenario")
+    parser.add_argument("--robots", type=int, default=100)
+    parser.add_argument("--mezcla", default="vertical_A,vertical_B,horizontal",
+                        help="tipos del Escenario 4 con peso opcional, p. ej. vertical_A=2,horizontal=1")
+    parser.add_argument("--llegadas", choices=("rafaga", "uniforme", "poisson"), default="rafaga")
+    parser.add_argument("--tasa", type=float, default=10, help="llegadas por segundo")
+    parser.add_argument("--ciclos", type=int, default=1, help="cruces por robot")
+    parser.add_argument("--cruce", type=float, default=0.2, help="segundos ocupando el cruce")
+    parser.add_argument("--reenvio", type=float, default=60,
+                        help="segundos sin permiso antes de repetir la solicitud (Escenarios 3 y 4)")
+    parser.add_argument("--desconexiones", type=float, default=0,
+                        help="probabilidad de que un robot pierda la conexión mientras espera")
+    parser.add_argument("--ventana-corte", type=float, default=1.0)
+    parser.add_argument("--reconexion", type=float, default=0.5)
+    parser.add_argument("--duracion", type=float, default=120)
+    parser.add_argument("--prefijo", default="robot")
+    parser.add_argument("--semilla", type=int)
+    parser.add_argument("--compartido", action="store_true",
+                        help="respuestas en el topic compartido, como el firmware anterior")
+    parser.add_argument("--cruces", type=int, default=1,
+                        help="cruces de la red (c1 ... cN); los robots se reparten entre ellos")
+    parser.add_argument("--sin-numero", action="store_true",
+                        help="solicitudes sin numerar, como el firmware anterior")
+    parser.add_argument("--procesos", type=int, default=1,
+                        help="procesos del anfitrión lanzado con --lanzar cuando hay varios cruces")
+    args = parser.parse_args()
+    if args.cruces > 1 and args.lanzar and args.escenario < 3:
+        parser.error("anfitrion.py solo aloja los controladores de los Escenarios 3 y 4")
+
+    host, _, puerto = args.broker.rpartition(":")
+    host, puerto = host or "127.0.0.1", int(puerto)
+    cruces = [f"c{i}" for i in range(1, args.cruces + 1)] if args.cruces > 1 else None
+    procesos = []
+    if args.lanzar:
+        procesos = lanzar_procesos(args.escenario, puerto, args.compartido, cruces, args.procesos)
+    try:
+        enjambre = Enjambre(args.escenario, host, puerto, args.robots, leer_mezcla(args.mezcla),
+                            args.llegadas, args.tasa, args.ciclos, args.cruce, args.reenvio,
+                            args.desconexiones, args.ventana_corte, args.reconexion,
+                            args.prefijo, args.semilla, args.compartido, cruces, not args.sin_numero)
+        mostrar(asyncio.run(enjambre.ejecutar(args.duracion)))
+    finally:
+        for proceso in procesos:
+            proceso.terminate()
+            proceso.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Carga de los scripts de los escenarios en CPython.
+
+Los scripts importan machine, network y umqtt al cargarse; aquí se resuelven
+contra el shim de herramientas/shim. ClienteFalso sustituye al cliente MQTT
+en los benchmarks que alimentan los manejadores a mano.
+"""
+import collections
+import contextlib
+import importlib.util
+import os
+import pathlib
+import socket
+import sys
+
+RAIZ = pathlib.Path(__file__).resolve().parent.parent
+SHIM = str(RAIZ / "herramientas" / "shim")
+
+CONTROLADORES = {
+    1: "Escenario1/codigo/controlador/controlador_cruce_escenario1.py",
+    2: "Escenario2/codigo/controlador/controlador_cruce_escenario2.py",
+    3: "Escenario3/codigo/controlador/controlador_cruce_escenario3.py",
+    4: "Escenario4/codigo/controlador/controlador_escenario4.py",
+}
+
+ROBOTS = {
+    1: "Escenario1/codigo/robot/robot_escenario1y2.py",
+    2: "Escenario2/codigo/robot/robot_escenario1y2.py",
+    3: "Escenario3/codigo/robot/robot_escenario3.py",
+    4: "Escenario4/codigo/robot/robot_escenario4.py",
+}
+
+
+class ClienteFalso:
+    # Los mensajes entregados esperan en una cola. Mientras la cola no está
+    # vacía hay un byte pendiente en un socketpair, de modo que `sock` se
+    # puede sondear como el de umqtt.
+    def __init__(self, client_id=None, server=None, **kwargs):
+        self.client_id = client_id
+        self.publicados = []
+        self.cb = None
+        self.entrantes = collections.deque()
+        self.sock, self._aviso = socket.socketpair()
+        self.sock.setblocking(False)
+
+    def entregar(self, topic, msg):
+        self.entrantes.append((topic, msg))
+        if len(self.entrantes) == 1:
+            self._aviso.send(b"\0")
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def set_last_will(self, topic, msg, retain=False, qos=0):
+        pass
+
+    def connect(self, clean_session=True):
+        return False
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+    def ping(self):
+        pass
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        self.publicados.append((topic, msg))
+
+    def check_msg(self):
+        if not self.entrantes:
+            return None
+        topic, msg = self.entrantes.popleft()
+        if not self.entrantes:
+            self.sock.recv(1)
+        self.cb(topic, msg)
+        return None
+
+    def disconnect(self):
+        pass
+
+
+def instalar_sustitutos():
+    # Los módulos de la placa se resuelven contra herramientas/shim.
+    if SHIM not in sys.path:
+        sys.path.insert(0, SHIM)
+
+
+def cargar(ruta, nombre=None):
+    instalar_sustitutos()
+    ruta = RAIZ / ruta
+    nombre = nombre or ruta.stem
+    spec = importlib.util.spec_from_file_location(nombre, ruta)
+    modulo = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(modulo)
+    return modulo
+
+
+def cargar_robot(escenario, nombre=None):
+    modulo = cargar(ROBOTS[escenario], nombre)
+    modulo.client = ClienteFalso(modulo.CLIENT_ID)
+    modulo.client.set_callback(getattr(modulo, "procesar_mensaje", None) or modulo.on_mensaje)
+    return modulo
+
+
+def cargar_controlador(escenario, nombre=None):
+    modulo = cargar(CONTROLADORES[escenario], nombre)
+    modulo.client = ClienteFalso()
+    return modulo
+
+
+@contextlib.contextmanager
+def silencio():
+    with open(os.devnull, "w") as nulo, contextlib.redirect_stdout(nulo):
+        yield
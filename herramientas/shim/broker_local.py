@@ -0,0 +1,114 @@
+"""Broker MQTT en memoria para los clientes del shim de umqtt.
+
+Da servicio a todos los clientes de un mismo proceso (controlador y robots
+en hilos distintos) con lo que usa el protocolo del cruce: mensajes
+retenidos, QoS 0/1, último deseo (LWT) al caer un cliente y sesiones
+persistentes con clean_session=False, que guardan suscripciones y mensajes
+QoS 1 mientras el cliente está desconectado.
+"""
+import collections
+import threading
+
+
+def coincide(filtro, topic):
+    f = filtro.split(b"/")
+    t = topic.split(b"/")
+    for i, nivel in enumerate(f):
+        if nivel == b"#":
+            return True
+        if i >= len(t):
+            return False
+        if nivel != b"+" and nivel != t[i]:
+            return False
+    return len(f) == len(t)
+
+
+class Sesion:
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.suscripciones = {}
+        self.pendientes = collections.deque()
+        self.cliente = None
+        self.limpia = True
+
+
+class BrokerLocal:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._sesiones = {}
+        self._retenidos = {}
+        self.publicaciones = 0
+        self.entregas = 0
+        self.trazas = []
+
+    def conectar(self, cliente, clean_session):
+        with self._lock:
+            sesion = self._sesiones.get(cliente.client_id)
+            if sesion is not None and sesion.cliente is not None:
+                # Un cliente con el mismo id expulsa al anterior, como en MQTT.
+                self._caida(sesion.cliente)
+            presente = sesion is not None and not clean_session and not sesion.limpia
+            if sesion is None or clean_session:
+                sesion = Sesion(cliente.client_id)
+                self._sesiones[cliente.client_id] = sesion
+            sesion.limpia = clean_session
+            sesion.cliente = cliente
+            cliente._sesion = sesion
+            while sesion.pendientes:
+                cliente._recibir(*sesion.pendientes.popleft())
+            return presente
+
+    def desconectar(self, cliente):
+        with self._lock:
+            self._soltar(cliente)
+
+    def caida(self, cliente):
+        with self._lock:
+            self._caida(cliente)
+
+    def _caida(self, cliente):
+        if self._soltar(cliente) and cliente._will is not None:
+            self.publicar(*cliente._will)
+
+    def _soltar(self, cliente):
+        sesion = cliente._sesion
+        if sesion is None or sesion.cliente is not cliente:
+            return False
+        sesion.cliente = None
+        cliente._sesion = None
+        if sesion.limpia:
+            del self._sesiones[sesion.client_id]
+        return True
+
+    def suscribir(self, cliente, filtro, qos):
+        with self._lock:
+            cliente._sesion.suscripciones[filtro] = qos
+            for topic, msg in self._retenidos.items():
+                if coincide(filtro, topic):
+                    cliente._recibir(topic, msg, True)
+
+    def publicar(self, topic, msg, retain=False, qos=0):
+        with self._lock:
+            self.publicaciones += 1
+            for funcion in self.trazas:
+                funcion(topic, msg, retain, qos)
+            if retain:
+                if msg:
+                    self._retenidos[topic] = msg
+                else:
+                    self._retenidos.pop(topic, None)
+            for sesion in self._sesiones.values():
+                qos_sub = None
+                for filtro, q in sesion.suscripciones.items():
+                    if coincide(filtro, topic):
+                        qos_sub = q if qos_sub is None else max(qos_sub, q)
+                if qos_sub is None:
+                    continue
+                if sesion.cliente is not None:
+                    self.entregas += 1
+                    sesion.cliente._recibir(topic, msg, False)
+                elif min(qos, qos_sub) > 0:
+                    sesion.pendientes.append((topic, msg, False))
+
+
+broker = BrokerLocal()
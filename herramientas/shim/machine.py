@@ -0,0 +1,119 @@
+"""Sustituto de `machine` para ejecutar los scripts en CPython.
+
+Pin y PWM guardan el historial de cambios para poder inspeccionar después
+qué hizo el robot (LED encendido, duty de cada servo).
+"""
+import threading
+import time
+
+pines = {}
+pwms = []
+
+
+def _ahora_ms():
+    return int(time.monotonic() * 1000)
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 2
+    PULL_DOWN = 3
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.modo = mode
+        self._valor = 0 if value is None else int(bool(value))
+        self.historial = []
+        pines[id] = self
+
+    def value(self, v=None):
+        if v is None:
+            return self._valor
+        self._valor = int(bool(v))
+        self.historial.append((_ahora_ms(), self._valor))
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def __call__(self, v=None):
+        return self.value(v)
+
+    def __repr__(self):
+        return f"Pin({self.id})"
+
+
+class PWM:
+    def __init__(self, pin, freq=0, duty_u16=None):
+        self.pin = pin
+        self._freq = freq
+        self._duty = 0
+        self.historial = []
+        pwms.append(self)
+        if duty_u16 is not None:
+            self.duty_u16(duty_u16)
+
+    def freq(self, f=None):
+        if f is None:
+            return self._freq
+        self._freq = f
+
+    def duty_u16(self, d=None):
+        if d is None:
+            return self._duty
+        self._duty = d
+        self.historial.append((_ahora_ms(), d))
+
+    def deinit(self):
+        pass
+
+    def __repr__(self):
+        return f"PWM({self.pin!r}, freq={self._freq}, duty_u16={self._duty})"
+
+
+class WDT:
+    # No reinicia nada: avisa si pasa el plazo sin un feed().
+    def __init__(self, id=0, timeout=5000):
+        self.timeout = timeout
+        self.vencimientos = 0
+        self._temporizador = None
+        self.feed()
+
+    def _vencido(self):
+        self.vencimientos += 1
+        print(f"[shim] WDT: {self.timeout} ms sin feed(); la placa se habría reiniciado")
+
+    def feed(self):
+        if self._temporizador is not None:
+            self._temporizador.cancel()
+        self._temporizador = threading.Timer(self.timeout / 1000, self._vencido)
+        self._temporizador.daemon = True
+        self._temporizador.start()
+
+
+class DeepSleep(SystemExit):
+    pass
+
+
+def deepsleep(ms=0):
+    # En la placa no se vuelve de aquí; en el PC termina el hilo o el proceso.
+    raise DeepSleep(f"deepsleep({ms})")
+
+
+def lightsleep(ms=0):
+    time.sleep(ms / 1000)
+
+
+def reset():
+    raise SystemExit("reset()")
+
+
+def unique_id():
+    return b"\x00shim\x00"
+
+
+def freq(hz=None):
+    return 240000000
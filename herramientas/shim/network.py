@@ -0,0 +1,87 @@
+"""Sustituto de `network` para ejecutar los scripts en CPython.
+
+El enlace WiFi es común a todo el proceso. simular_caida() lo corta (y avisa
+a los clientes MQTT del shim, que pierden la conexión como en la placa) y
+simular_conexion() lo restablece.
+"""
+import os
+import threading
+
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_GOT_IP = 1010
+
+RETARDO_CONEXION_S = float(os.environ.get("SHIM_WIFI_RETARDO", "0"))
+
+_enlace = threading.Event()
+_enlace.set()
+_oyentes = []
+
+
+def enlace_activo():
+    return _enlace.is_set()
+
+
+def al_caer(funcion):
+    _oyentes.append(funcion)
+
+
+def simular_caida(segundos=None):
+    _enlace.clear()
+    for funcion in list(_oyentes):
+        funcion()
+    if segundos is not None:
+        threading.Timer(segundos, simular_conexion).start()
+
+
+def simular_conexion():
+    _enlace.set()
+
+
+class WLAN:
+    # Como en la placa, WLAN(STA_IF) devuelve siempre la misma interfaz.
+    _interfaces = {}
+
+    def __new__(cls, interfaz=STA_IF):
+        if interfaz not in cls._interfaces:
+            wlan = super().__new__(cls)
+            wlan.interfaz = interfaz
+            wlan._activa = False
+            wlan._asociada = False
+            cls._interfaces[interfaz] = wlan
+        return cls._interfaces[interfaz]
+
+    def active(self, activa=None):
+        if activa is None:
+            return self._activa
+        self._activa = bool(activa)
+
+    def connect(self, ssid=None, key=None, **kwargs):
+        if self.isconnected():
+            return
+        self._asociada = False
+        if RETARDO_CONEXION_S:
+            threading.Timer(RETARDO_CONEXION_S, self._asociar).start()
+        else:
+            self._asociar()
+
+    def _asociar(self):
+        self._asociada = True
+
+    def disconnect(self):
+        self._asociada = False
+
+    def isconnected(self):
+        return self._activa and self._asociada and _enlace.is_set()
+
+    def status(self, *args):
+        return STAT_GOT_IP if self.isconnected() else STAT_IDLE
+
+    def ifconfig(self, *args):
+        return ("127.0.0.1", "255.0.0.0", "127.0.0.1", "127.0.0.1")
+
+    def config(self, *args, **kwargs):
+        return None
@@ -0,0 +1,321 @@
+"""Sustituto de `umqtt.simple` sobre el broker en memoria del shim.
+
+Tiene la misma interfaz que el cliente de micropython-lib. Los mensajes
+recibidos esperan en una cola y, mientras hay alguno, queda un byte
+pendiente en `sock`, así que select.poll y asyncio lo sondean igual que el
+socket real.
+
+Con SHIM_BROKER=host:puerto, MQTTClient habla MQTT por TCP con ese broker
+(por ejemplo herramientas/broker_mqtt.py) en lugar del broker en memoria,
+sea cual sea la dirección que indique el script.
+"""
+import collections
+import os
+import socket
+import struct
+import threading
+
+import network
+from broker_local import broker
+
+
+class MQTTException(Exception):
+    pass
+
+
+def _bytes(valor):
+    return valor.encode() if isinstance(valor, str) else bytes(valor)
+
+
+class MQTTClient:
+    def __init__(self, client_id, server, port=0, user=None, password=None,
+                 keepalive=0, ssl=False, ssl_params={}):
+        self.client_id = _bytes(client_id)
+        self.server = server
+        self.port = port or 1883
+        self.keepalive = keepalive
+        self.cb = None
+        self.sock = None
+        self._aviso = None
+        self._will = None
+        self._sesion = None
+        self._entrantes = collections.deque()
+        self._lock = threading.Lock()
+        self._pid = 0
+        network.al_caer(self._caer)
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def set_last_will(self, topic, msg, retain=False, qos=0):
+        self._will = (_bytes(topic), _bytes(msg), retain, qos)
+
+    def _comprobar(self):
+        if self.sock is None or self._sesion is None or not network.enlace_activo():
+            raise OSError(-1)
+
+    def connect(self, clean_session=True):
+        if not network.enlace_activo():
+            raise OSError(113)
+        self._cerrar_socket()
+        self.sock, self._aviso = socket.socketpair()
+        self.sock.setblocking(False)
+        self._entrantes.clear()
+        return broker.conectar(self, clean_session)
+
+    def disconnect(self):
+        broker.desconectar(self)
+        self._cerrar_socket()
+
+    def _caer(self):
+        # Corte de red o expulsión: el broker publica el último deseo.
+        broker.caida(self)
+        with self._lock:
+            if self._aviso is not None and not self._entrantes:
+                self._aviso.send(b"\0")
+
+    def simular_caida(self):
+        self._caer()
+
+    def _cerrar_socket(self):
+        for s in (self.sock, self._aviso):
+            if s is not None:
+                s.close()
+        self.sock = self._aviso = None
+
+    def _recibir(self, topic, msg, retenido):
+        with self._lock:
+            self._entrantes.append((topic, msg))
+            if len(self._entrantes) == 1 and self._aviso is not None:
+                self._aviso.send(b"\0")
+
+    def ping(self):
+        self._comprobar()
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        self._comprobar()
+        if qos:
+            self._pid = self._pid % 65535 + 1
+        broker.publicar(_bytes(topic), _bytes(msg), retain, qos)
+
+    def subscribe(self, topic, qos=0):
+        self._comprobar()
+        broker.suscribir(self, _bytes(topic), qos)
+
+    def _siguiente(self, bloquear):
+        while True:
+            with self._lock:
+                if self._entrantes:
+                    topic, msg = self._entrantes.popleft()
+                    if not self._entrantes:
+                        self.sock.recv(1)
+                    return topic, msg
+            self._comprobar()
+            if not bloquear:
+                return None
+            self.sock.setblocking(True)
+            try:
+                self.sock.recv(1, socket.MSG_PEEK)
+            finally:
+                self.sock.setblocking(False)
+
+    def wait_msg(self):
+        return self._atender(self._siguiente(True))
+
+    def check_msg(self):
+        return self._atender(self._siguiente(False))
+
+    def _atender(self, mensaje):
+        if mensaje is not None:
+            self.cb(*mensaje)
+        return None
+
+
+
+class ClienteTCP:
+    # Misma lógica que umqtt.simple de micropython-lib, sobre un socket de
+    # CPython. Un corte de red simulado cierra el socket sin DISCONNECT, así
+    # que el broker publica el último deseo.
+    def __init__(self, client_id, server, port=0, user=None, password=None,
+                 keepalive=0, ssl=False, ssl_params={}):
+        self.client_id = _bytes(client_id)
+        self.server = server
+        self.keepalive = keepalive
+        self.user = user
+        self.pswd = password
+        self.cb = None
+        self.sock = None
+        self.pid = 0
+        self.lw_topic = None
+        self.lw_msg = None
+        self.lw_qos = 0
+        self.lw_retain = False
+        network.al_caer(self._caer)
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def set_last_will(self, topic, msg, retain=False, qos=0):
+        self.lw_topic = _bytes(topic)
+        self.lw_msg = _bytes(msg)
+        self.lw_qos = qos
+        self.lw_retain = retain
+
+    def _caer(self):
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def simular_caida(self):
+        self._caer()
+
+    def _leer(self, n):
+        datos = b""
+        while len(datos) < n:
+            parte = self.sock.recv(n - len(datos))
+            if not parte:
+                raise OSError(-1)
+            datos += parte
+        return datos
+
+    def _escribir(self, datos):
+        if not network.enlace_activo():
+            raise OSError(-1)
+        self.sock.sendall(datos)
+
+    def _cadena(self, s):
+        return struct.pack("!H", len(s)) + s
+
+    def _longitud(self, sz):
+        salida = bytearray()
+        while sz > 0x7F:
+            salida.append((sz & 0x7F) | 0x80)
+            sz >>= 7
+        salida.append(sz)
+        return bytes(salida)
+
+    def _recv_len(self):
+        n = 0
+        sh = 0
+        while 1:
+            b = self._leer(1)[0]
+            n |= (b & 0x7F) << sh
+            if not b & 0x80:
+                return n
+            sh += 7
+
+    def connect(self, clean_session=True):
+        if not network.enlace_activo():
+            raise OSError(113)
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = socket.create_connection(BROKER)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        flags = clean_session << 1
+        cuerpo = self._cadena(self.client_id)
+        if self.lw_topic:
+            flags |= 0x4 | (self.lw_qos & 0x3) << 3 | self.lw_retain << 5
+            cuerpo += self._cadena(self.lw_topic) + self._cadena(self.lw_msg)
+        if self.user:
+            flags |= 0xC0
+            cuerpo += self._cadena(_bytes(self.user)) + self._cadena(_bytes(self.pswd))
+        cuerpo = b"\x00\x04MQTT\x04" + struct.pack("!BH", flags, self.keepalive) + cuerpo
+        self._escribir(b"\x10" + self._longitud(len(cuerpo)) + cuerpo)
+        resp = self._leer(4)
+        assert resp[0] == 0x20 and resp[1] == 0x02
+        if resp[3] != 0:
+            raise MQTTException(resp[3])
+        return resp[2] & 1
+
+    def disconnect(self):
+        try:
+            self._escribir(b"\xe0\0")
+        finally:
+            self.sock.close()
+            self.sock = None
+
+    def ping(self):
+        self._escribir(b"\xc0\0")
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        topic = _bytes(topic)
+        msg = _bytes(msg)
+        cuerpo = self._cadena(topic)
+        if qos > 0:
+            self.pid = self.pid % 65535 + 1
+            pid = self.pid
+            cuerpo += struct.pack("!H", pid)
+        cuerpo += msg
+        self._escribir(bytes((0x30 | qos << 1 | retain,)) + self._longitud(len(cuerpo)) + cuerpo)
+        if qos == 1:
+            while 1:
+                op = self.wait_msg()
+                if op == 0x40:
+                    sz = self._leer(1)
+                    assert sz == b"\x02"
+                    rcv_pid = struct.unpack("!H", self._leer(2))[0]
+                    if pid == rcv_pid:
+                        return
+        elif qos == 2:
+            assert 0
+
+    def subscribe(self, topic, qos=0):
+        assert self.cb is not None, "Subscribe callback is not set"
+        self.pid = self.pid % 65535 + 1
+        cuerpo = struct.pack("!H", self.pid) + self._cadena(_bytes(topic)) + bytes((qos,))
+        self._escribir(b"\x82" + self._longitud(len(cuerpo)) + cuerpo)
+        while 1:
+            op = self.wait_msg()
+            if op == 0x90:
+                resp = self._leer(4)
+                assert struct.unpack("!H", resp[1:3])[0] == self.pid
+                if resp[3] == 0x80:
+                    raise MQTTException(resp[3])
+                return
+
+    def wait_msg(self):
+        if self.sock is None or not network.enlace_activo():
+            raise OSError(-1)
+        try:
+            res = self.sock.recv(1)
+        except BlockingIOError:
+            return None
+        finally:
+            self.sock.setblocking(True)
+        if res == b"":
+            raise OSError(-1)
+        if res == b"\xd0":
+            sz = self._leer(1)[0]
+            assert sz == 0
+            return None
+        op = res[0]
+        if op & 0xF0 != 0x30:
+            return op
+        sz = self._recv_len()
+        topic_len = struct.unpack("!H", self._leer(2))[0]
+        topic = self._leer(topic_len)
+        sz -= topic_len + 2
+        if op & 6:
+            pid = self._leer(2)
+            sz -= 2
+        msg = self._leer(sz)
+        self.cb(topic, msg)
+        if op & 6 == 2:
+            self._escribir(b"\x40\x02" + pid)
+        elif op & 6 == 4:
+            assert 0
+        return op
+
+    def check_msg(self):
+        if self.sock is not None:
+            self.sock.setblocking(False)
+        return self.wait_msg()
+
+
+BROKER = os.environ.get("SHIM_BROKER")
+if BROKER:
+    _host, _, _puerto = BROKER.rpartition(":")
+    BROKER = (_host or "127.0.0.1", int(_puerto))
+    MQTTClient = ClienteTCP
@@ -0,0 +1,64 @@
+"""Simulación de las franjas de reserva del Escenario 4 frente a parar y pedir.
+
+Usa la simulación de sim_politicas.py (controlador real, reloj virtual,
+población cerrada de robots). Cada robot tarda --aproximacion segundos en
+llegar a la línea. Parando, pide paso al llegar y, si tiene que esperar,
+pierde --arranque segundos en volver a ponerse en marcha. Con franja, pide
+al empezar a acercarse con su hora de llegada y su duración; si recibe
+franja entra sin pararse (o parado hasta que empiece) y si no sigue el
+camino normal. Para cada número de robots se muestran los cruces por minuto
+y el recorrido de cada robot, desde que empieza a acercarse hasta que sale
+del cruce.
+
+    python herramientas/sim_franjas.py
+    python herramientas/sim_franjas.py --robots 4,8 --arranque 2 --fijar RETRASO_MAXIMO_FRANJA_MS=6000
+"""
+import argparse
+
+from ejecutar import leer_constantes
+from sim_politicas import Simulacion, resumir
+
+
+def simular(robots, reserva, args, constantes):
+    sim = Simulacion(4, args.politica, robots, args.cruce, args.pensar, args.semilla, constantes,
+                     mezcla={}, latencia=args.latencia, aproximacion=args.aproximacion,
+                     arranque=args.arranque, reserva=reserva)
+    sim.ejecutar(args.duracion)
+    r = resumir(sim.recorridos, [])
+    permisos = len(sim.esperas[True]) + len(sim.esperas[False])
+    r["cruces_min"] = permisos * 60 / args.duracion
+    r["con_franja"] = sim.franjas / permisos if permisos else 0.0
+    return r
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--robots", default="2,4,8,16", help="tamaños de la población")
+    parser.add_argument("--politica", default="envejecimiento")
+    parser.add_argument("--cruce", type=float, default=6.0, help="segundos ocupando el cruce")
+    parser.add_argument("--aproximacion", type=float, default=2.0, help="segundos hasta la línea")
+    parser.add_argument("--arranque", type=float, default=1.0, help="segundos perdidos al arrancar parado")
+    parser.add_argument("--latencia", type=float, default=0.02, help="segundos por mensaje robot-controlador")
+    parser.add_argument("--pensar", type=float, default=10.0, help="media de la pausa entre cruces (s)")
+    parser.add_argument("--duracion", type=float, default=3600, help="segundos simulados")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--fijar", action="append", default=[], metavar="NOMBRE=valor",
+                        help="cambia una constante del controlador")
+    args = parser.parse_args()
+    constantes = leer_constantes(args.fijar)
+
+    print(f"{args.cruce} s por cruce, {args.aproximacion} s de aproximación, {args.arranque} s de arranque, "
+          f"{args.pensar} s de pausa media, {args.duracion:.0f} s simulados")
+    print(f"{'robots':>6} {'modo':<7} {'cruces/min':>10} {'mejora':>7} {'con franja':>10} "
+          f"{'recorrido p50 (s)':>17} {'p99 (s)':>8}")
+    for robots in (int(n) for n in args.robots.split(",")):
+        base = None
+        for reserva in (False, True):
+            r = simular(robots, reserva, args, constantes)
+            base = base or r["cruces_min"]
+            print(f"{robots:>6} {'franja' if reserva else 'parar':<7} {r['cruces_min']:>10.1f} "
+                  f"{r['cruces_min'] / base:>6.2f}x {r['con_franja']:>10.0%} {r['p50']:>17.1f} {r['p99']:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Simulación de los pelotones del Escenario 4 con varias mezclas de tráfico.
+
+Usa la simulación de sim_politicas.py (controlador real, reloj virtual,
+población cerrada de robots) con una diferencia: cada solicitud elige
+movimiento según los pesos de la mezcla, y cruzar cuesta --despeje segundos
+más cuando alguna de las zonas la usó por última vez otro movimiento, que es
+lo que cuesta cambiar de sentido. Para cada mezcla y cada PELOTON_MAXIMO se
+muestran los cruces por minuto y la espera entre la solicitud y el permiso
+de todos los robots (p50, p99, máximo; las esperas sin terminar cuentan con
+lo que llevan).
+
+    python herramientas/sim_pelotones.py
+    python herramientas/sim_pelotones.py --pelotones 1,4 --despeje 2 --fijar ESPERA_MAXIMA_PELOTON_MS=4000
+    python herramientas/sim_pelotones.py --mezclas uniforme --fijar CRUCE=CRUCE_4_ACCESOS
+"""
+import argparse
+
+from ejecutar import leer_constantes
+from sim_politicas import Simulacion, resumir
+
+# Pesos por movimiento del cruce del Escenario 4; los que no aparecen pesan 1,
+# así que "uniforme" vale para cualquier CRUCE.
+MEZCLAS = {
+    "uniforme": {},
+    "vertical": {"vertical_A": 3, "vertical_B": 3, "horizontal": 1},
+    "horizontal": {"vertical_A": 1, "vertical_B": 1, "horizontal": 4},
+    "solo_A": {"vertical_A": 4, "vertical_B": 1, "horizontal": 2},
+}
+
+
+def simular(mezcla, peloton, args, constantes):
+    constantes = dict(constantes, PELOTON_MAXIMO=peloton)
+    sim = Simulacion(4, args.politica, args.robots, args.cruce, args.pensar, args.semilla,
+                     constantes, mezcla=MEZCLAS[mezcla], despeje=args.despeje)
+    sim.ejecutar(args.duracion)
+    esperas = sim.esperas[True] + sim.esperas[False]
+    pendientes = [args.duracion - inicio for inicio in sim.solicitado.values()]
+    return resumir(esperas, pendientes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mezclas", default=",".join(MEZCLAS))
+    parser.add_argument("--pelotones", default="1,2,4,8", help="valores de PELOTON_MAXIMO")
+    parser.add_argument("--politica", default="envejecimiento")
+    parser.add_argument("--robots", type=int, default=12)
+    parser.add_argument("--cruce", type=float, default=1.0, help="segundos ocupando el cruce")
+    parser.add_argument("--despeje", type=float, default=1.0, help="segundos de más al cambiar de sentido")
+    parser.add_argument("--pensar", type=float, default=2.0, help="media de la pausa entre cruces (s)")
+    parser.add_argument("--duracion", type=float, default=3600, help="segundos simulados")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--fijar", action="append", default=[], metavar="NOMBRE=valor",
+                        help="cambia una constante del controlador, p. ej. ESPERA_MAXIMA_PELOTON_MS=4000")
+    args = parser.parse_args()
+    constantes = leer_constantes(args.fijar)
+
+    print(f"{args.robots} robots, {args.cruce} s por cruce, {args.despeje} s de despeje, "
+          f"{args.pensar} s de pausa media, {args.duracion:.0f} s simulados, política {args.politica}")
+    print(f"{'mezcla':<11} {'pelotón':>7} {'cruces/min':>10} {'mejora':>7} {'p50 (s)':>8} "
+          f"{'p99 (s)':>8} {'máx (s)':>8}")
+    for mezcla in args.mezclas.split(","):
+        base = None
+        for peloton in (int(p) for p in args.pelotones.split(",")):
+            r = simular(mezcla, peloton, args, constantes)
+            por_minuto = r["permisos"] * 60 / args.duracion
+            base = base or por_minuto
+            print(f"{mezcla:<11} {peloton:>7} {por_minuto:>10.1f} {por_minuto / base:>6.2f}x "
+                  f"{r['p50']:>8.1f} {r['p99']:>8.1f} {r['max']:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""Simulación de las políticas de la cola de espera de los Escenarios 2, 3 y 4.
+
+Alimenta el controlador real con un reloj virtual y una población cerrada de
+robots: robot1 ... robot4 tienen las prioridades 1 a 4 de `prioridades` y el
+resto ninguna. Cada robot pide paso, cruza durante --cruce segundos, piensa
+un tiempo exponencial de media --pensar segundos y vuelve a pedir. Para cada
+política (POLITICA = "prioridad", "fifo" o "envejecimiento") se muestran los
+percentiles p50 y p99 y el máximo de la espera entre la solicitud y el
+permiso, aparte para los robots con y sin prioridad. Una espera que no ha
+terminado al acabar la simulación cuenta con lo que lleva, así que la
+inanición se ve en el máximo y en la columna de robots sin servir.
+
+    python herramientas/sim_politicas.py
+    python herramientas/sim_politicas.py --escenarios 3 --robots 20 --fijar ADELANTO_MAXIMO_MS=5000
+"""
+import argparse
+import heapq
+import random
+
+from ejecutar import fijar, leer_constantes
+from entorno import cargar_controlador
+
+POLITICAS = ("prioridad", "fifo", "envejecimiento")
+TIPOS_ESCENARIO4 = ("vertical_A", "vertical_B", "horizontal")
+
+
+class Simulacion:
+    # mezcla: pesos por movimiento del Escenario 4 (1 los que no aparecen);
+    # con ella cada solicitud elige movimiento y sin ella cada robot tiene uno
+    # fijo. despeje: segundos que se suman al cruce cuando alguna de sus zonas
+    # la usó por última vez otro movimiento (hay que esperar a que el cruce se
+    # vacíe). latencia: segundos que tarda cada mensaje entre un robot y el
+    # controlador, pasando por el broker. reaccion: lo que tarda un robot en
+    # arrancar tras el pasar si no está armado por un prepararse. aviso:
+    # segundos antes del final del cruce en que el robot manda llego (None,
+    # no lo manda). aproximacion: segundos que tarda el robot en llegar a la
+    # línea; sin reserva pide paso al llegar y con reserva (Escenario 4) pide
+    # franja al empezar a acercarse. arranque: lo que pierde un robot parado
+    # en la línea en volver a ponerse en marcha.
+    def __init__(self, escenario, politica, robots, cruce, pensar, semilla, constantes,
+                 mezcla=None, despeje=0.0, latencia=0.0, reaccion=0.0, aviso=None,
+                 aproximacion=0.0, arranque=0.0, reserva=False):
+        self.escenario = escenario
+        self.c = cargar_controlador(escenario, f"c{escenario}_sim_{politica}")
+        self.c.print = lambda *args, **kwargs: None
+        fijar(self.c, constantes)
+        self.c.POLITICA = politica
+        if escenario == 4:
+            self.c.configurar_cruce(self.c.CRUCE)
+        # El reloj del controlador avanza con el de la simulación.
+        base = self.c.ticks_ms()
+        self.ahora = 0.0
+        self.c.ticks_ms = lambda: base + int(self.ahora * 1000)
+        self.c.client.publish = self._publicar
+        self.atender = self.c.sub_cb if escenario == 2 else self.c.procesar_mensaje
+        self.cruce = cruce
+        self.pensar = pensar
+        self.rnd = random.Random(semilla)
+        self.robots = [f"robot{i}" for i in range(1, robots + 1)]
+        self.tipos = {r: self.rnd.choice(TIPOS_ESCENARIO4) for r in self.robots}
+        if mezcla is not None:
+            self.movimientos = self.c.movimientos
+            self.pesos = [mezcla.get(m, 1) for m in self.movimientos]
+        self.mezcla = mezcla
+        self.despeje = despeje
+        self.ultimo_movimiento = {}
+        self.latencia = latencia
+        self.reaccion = reaccion
+        self.aviso = aviso
+        self.armados = set()
+        self.pedido = {}
+        self.aproximacion = aproximacion
+        self.arranque = arranque
+        self.reserva = reserva
+        self.partida = {}
+        self.en_linea = {}
+        self.recorridos = []
+        self.franjas = 0
+        # Relevos: desde que una zona queda libre hasta que entra en ella
+        # alguien que ya la esperaba.
+        self.libre_desde = {}
+        self.huecos = []
+        self.eventos = []
+        self.orden = 0
+        self.solicitado = {}
+        self.esperas = {True: [], False: []}
+
+    def programar(self, retraso, accion, robot_id):
+        self.orden += 1
+        heapq.heappush(self.eventos, (self.ahora + retraso, self.orden, accion, robot_id))
+
+    def enviar(self, accion, robot_id):
+        # Un mensaje entre robot y controlador: llega tras la latencia.
+        if self.latencia:
+            self.programar(self.latencia, accion, robot_id)
+        else:
+            getattr(self, accion)(robot_id)
+
+    def entregar(self, topic, msg):
+        self.atender(topic, msg)
+        if self.escenario >= 3:
+            self.c.enviar_salida()
+            self.c.volcar_estado()
+
+    def _publicar(self, topic, msg, retain=False, qos=0):
+        if topic.startswith(self.c.TOPICO_RESPUESTA) and msg.endswith(b":pasar"):
+            robot_id = msg[:-6].decode()
+            inicio = self.solicitado.pop(robot_id, None)
+            if inicio is not None:
+                self.esperas[robot_id in self.c.prioridades].append(self.ahora - inicio)
+                self.pedido[robot_id] = inicio
+                recibido = self.ahora + self.latencia
+                if recibido < self.en_linea[robot_id]:
+                    # Aún se acerca: entra al llegar, sin pararse.
+                    retraso = self.en_linea[robot_id] - self.ahora
+                else:
+                    # El prepararse salió antes que el pasar, así que también llega antes.
+                    retraso = self.latencia + (0.0 if robot_id in self.armados else self.reaccion)
+                    retraso += self.arranque
+                if retraso:
+                    self.programar(retraso, "entrar", robot_id)
+                else:
+                    self.entrar(robot_id)
+        elif topic.startswith(self.c.TOPICO_RESPUESTA) and msg.endswith(b":prepararse"):
+            self.armados.add(msg[:-11].decode())
+        elif topic.startswith(self.c.TOPICO_RESPUESTA) and b":franja:" in msg:
+            robot_id, _, espera = msg.decode().split(":")
+            inicio = self.solicitado.pop(robot_id, None)
+            if inicio is not None:
+                self.franjas += 1
+                self.esperas[robot_id in self.c.prioridades].append(self.ahora - inicio)
+                self.pedido[robot_id] = inicio
+                # Si la franja empieza después de que llegue, espera parado en la línea.
+                retraso = int(espera) / 1000
+                if self.ahora + retraso > self.en_linea[robot_id]:
+                    retraso += self.arranque
+                self.programar(retraso, "entrar", robot_id)
+
+    def zonas(self, robot_id):
+        if self.escenario != 4:
+            return ("cruce",)
+        return self.c.zonas_movimiento[self.c.indice_movimiento[self.tipos[robot_id]]]
+
+    def entrar(self, robot_id):
+        self.armados.discard(robot_id)
+        hueco = None
+        for zona in self.zonas(robot_id):
+            libre = self.libre_desde.get(zona)
+            if libre is not None and self.pedido[robot_id] <= libre:
+                hueco = max(hueco or 0.0, self.ahora - libre)
+        if hueco is not None:
+            self.huecos.append(hueco)
+        duracion = self.cruce + self.despejar(robot_id)
+        if self.aviso is not None and self.aviso < duracion:
+            self.programar(duracion - self.aviso, "avisar_llegada", robot_id)
+        self.programar(duracion, "liberar", robot_id)
+
+    def avisar_llegada(self, robot_id):
+        self.enviar("recibir_llegada", robot_id)
+
+    def recibir_llegada(self, robot_id):
+        self.entregar(self.c.TOPICO_REPORTES, f"{robot_id}:llego".encode())
+
+    def despejar(self, robot_id):
+        if self.escenario != 4:
+            return 0.0
+        tipo = self.tipos[robot_id]
+        cambio = False
+        for zona in self.zonas(robot_id):
+            cambio = cambio or self.ultimo_movimiento.get(zona, tipo) != tipo
+            self.ultimo_movimiento[zona] = tipo
+        return self.despeje if cambio else 0.0
+
+    def solicitar(self, robot_id):
+        # El robot termina su pausa y se acerca al cruce.
+        self.partida[robot_id] = self.ahora
+        self.en_linea[robot_id] = self.ahora + self.aproximacion
+        if self.mezcla is not None:
+            self.tipos[robot_id] = self.rnd.choices(self.movimientos, self.pesos)[0]
+        if self.reserva:
+            self.solicitado[robot_id] = self.ahora
+            self.enviar("recibir_reserva", robot_id)
+        elif self.aproximacion:
+            self.programar(self.aproximacion, "pedir", robot_id)
+        else:
+            self.pedir(robot_id)
+
+    def pedir(self, robot_id):
+        self.solicitado[robot_id] = self.ahora
+        self.enviar("recibir_solicitud", robot_id)
+
+    def recibir_solicitud(self, robot_id):
+        pedido = self.tipos[robot_id] if self.escenario == 4 else "solicitud"
+        self.entregar(self.c.TOPICO_SOLICITUD, f"{robot_id}:{pedido}".encode())
+
+    def recibir_reserva(self, robot_id):
+        # La llegada que anuncia el robot ya descuenta lo que tardó el mensaje.
+        eta = max(0, round((self.en_linea[robot_id] - self.ahora) * 1000))
+        pedido = f"{robot_id}:{self.tipos[robot_id]}@{eta}+{round(self.cruce * 1000)}"
+        self.entregar(self.c.TOPICO_SOLICITUD, pedido.encode())
+
+    def liberar(self, robot_id):
+        for zona in self.zonas(robot_id):
+            self.libre_desde[zona] = self.ahora
+        self.recorridos.append(self.ahora - self.partida[robot_id])
+        self.enviar("recibir_liberado", robot_id)
+        self.programar(self.rnd.expovariate(1 / self.pensar), "solicitar", robot_id)
+
+    def recibir_liberado(self, robot_id):
+        self.entregar(self.c.TOPICO_REPORTES, f"{robot_id}:cruce_liberado".encode())
+
+    def ejecutar(self, duracion):
+        for robot_id in self.robots:
+            self.programar(self.rnd.uniform(0, self.pensar), "solicitar", robot_id)
+        while self.eventos and self.eventos[0][0] <= duracion:
+            self.ahora, _, accion, robot_id = heapq.heappop(self.eventos)
+            getattr(self, accion)(robot_id)
+        self.ahora = duracion
+        pendientes = {True: [], False: []}
+        for robot_id, inicio in self.solicitado.items():
+            pendientes[robot_id in self.c.prioridades].append(self.ahora - inicio)
+        return {grupo: resumir(self.esperas[grupo], pendientes[grupo]) for grupo in (True, False)}
+
+
+def resumir(esperas, pendientes):
+    valores = sorted(esperas + pendientes)
+    if not valores:
+        return None
+    n = len(valores)
+    return {
+        "permisos": len(esperas),
+        "sin_servir": len(pendientes),
+        "p50": valores[n // 2],
+        "p99": valores[min(n - 1, int(n * 0.99))],
+        "max": valores[-1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--escenarios", default="2,3,4")
+    parser.add_argument("--politicas", default=",".join(POLITICAS))
+    parser.add_argument("--robots", type=int, default=12, help="robots en total; los 4 primeros con prioridad")
+    parser.add_argument("--cruce", type=float, default=1.0, help="segundos ocupando el cruce")
+    parser.add_argument("--pensar", type=float, default=2.0, help="media de la pausa entre cruces (s)")
+    parser.add_argument("--duracion", type=float, default=3600, help="segundos simulados")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--fijar", action="append", default=[], metavar="NOMBRE=valor",
+                        help="cambia una constante del controlador, p. ej. ADELANTO_MAXIMO_MS=5000")
+    args = parser.parse_args()
+    constantes = leer_constantes(args.fijar)
+
+    print(f"{args.robots} robots, {args.cruce} s por cruce, {args.pensar} s de pausa media, "
+          f"{args.duracion:.0f} s simulados")
+    print(f"{'esc':>3} {'política':<15} {'grupo':<14} {'permisos':>8} {'p50 (s)':>8} {'p99 (s)':>8} "
+          f"{'máx (s)':>8} {'sin servir':>10}")
+    for escenario in (int(e) for e in args.escenarios.split(",")):
+        for politica in args.politicas.split(","):
+            sim = Simulacion(escenario, politica, args.robots, args.cruce, args.pensar,
+                             args.semilla, constantes)
+            for grupo, r in sim.ejecutar(args.duracion).items():
+                if r is None:
+                    continue
+                nombre = "con prioridad" if grupo else "sin prioridad"
+                print(f"{escenario:>3} {politica:<15} {nombre:<14} {r['permisos']:>8} {r['p50']:>8.1f} "
+                      f"{r['p99']:>8.1f} {r['max']:>8.1f} {r['sin_servir']:>10}")
+
+
+if __name__ == "__main__":
+    main()
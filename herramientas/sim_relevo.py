@@ -0,0 +1,68 @@
+"""Simulación del relevo en el cruce con y sin aviso `prepararse`.
+
+Usa la simulación de sim_politicas.py (controlador real, reloj virtual,
+población cerrada de robots) con la red y el robot en medio: cada mensaje
+entre un robot y el controlador tarda --latencia segundos, y un robot tarda
+--reaccion segundos en arrancar tras el pasar salvo que esté armado. Con
+aviso, el activo manda `llego` --aviso segundos antes de salir del cruce y
+el controlador contesta con `prepararse` al siguiente, que queda armado y
+arranca en cuanto le llega el pasar. El hueco de un relevo es el tiempo que
+una zona pasa vacía entre que sale un robot y entra otro que ya esperaba;
+su mínimo es el viaje de ida y vuelta del cruce_liberado y del pasar. En el
+Escenario 4 el p99 recoge además las zonas que quedan reservadas, vacías,
+para un movimiento que espera a otra zona.
+
+    python herramientas/sim_relevo.py
+    python herramientas/sim_relevo.py --escenarios 4 --latencia 0.05 --reaccion 0.2
+"""
+import argparse
+
+from ejecutar import leer_constantes
+from sim_politicas import Simulacion
+
+
+def simular(escenario, aviso, args, constantes):
+    sim = Simulacion(escenario, args.politica, args.robots, args.cruce, args.pensar, args.semilla,
+                     constantes, latencia=args.latencia, reaccion=args.reaccion, aviso=aviso)
+    sim.ejecutar(args.duracion)
+    huecos = sorted(sim.huecos)
+    n = len(huecos)
+    permisos = len(sim.esperas[True]) + len(sim.esperas[False])
+    return {
+        "cruces_min": permisos * 60 / args.duracion,
+        "relevos": n,
+        "p50_ms": huecos[n // 2] * 1000 if n else 0.0,
+        "p99_ms": huecos[min(n - 1, int(n * 0.99))] * 1000 if n else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--escenarios", default="3,4")
+    parser.add_argument("--politica", default="envejecimiento")
+    parser.add_argument("--robots", type=int, default=12)
+    parser.add_argument("--cruce", type=float, default=4.0, help="segundos ocupando el cruce")
+    parser.add_argument("--pensar", type=float, default=8.0, help="media de la pausa entre cruces (s)")
+    parser.add_argument("--latencia", type=float, default=0.02, help="segundos por mensaje robot-controlador")
+    parser.add_argument("--reaccion", type=float, default=0.1, help="segundos en arrancar sin estar armado")
+    parser.add_argument("--aviso", type=float, default=1.0, help="segundos antes del final en que se manda llego")
+    parser.add_argument("--duracion", type=float, default=3600, help="segundos simulados")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--fijar", action="append", default=[], metavar="NOMBRE=valor",
+                        help="cambia una constante del controlador")
+    args = parser.parse_args()
+    constantes = leer_constantes(args.fijar)
+
+    print(f"{args.robots} robots, {args.cruce} s por cruce, {args.latencia * 1000:.0f} ms por mensaje, "
+          f"{args.reaccion * 1000:.0f} ms de reacción, {args.duracion:.0f} s simulados")
+    print(f"{'esc':>3} {'prepararse':<10} {'cruces/min':>10} {'relevos':>8} {'hueco p50 (ms)':>15} "
+          f"{'hueco p99 (ms)':>15}")
+    for escenario in (int(e) for e in args.escenarios.split(",")):
+        for aviso in (None, args.aviso):
+            r = simular(escenario, aviso, args, constantes)
+            print(f"{escenario:>3} {'sí' if aviso is not None else 'no':<10} {r['cruces_min']:>10.1f} "
+                  f"{r['relevos']:>8} {r['p50_ms']:>15.0f} {r['p99_ms']:>15.0f}")
+
+
+if __name__ == "__main__":
+    main()